@@ -30,6 +30,7 @@ Commands
   * **login**            - login to Synapse and (optionally) cache credentials
   * **get**              - download an entity and associated data
   * **add**              - add or modify content to Synapse
+  * **sync**             - mirror a local directory into a Synapse project or folder
   * **delete**           - removes a dataset from Synapse
   * **mv**               - move a dataset in Synapse
   * **query**            - performs SQL like queries on Synapse
@@ -40,6 +41,7 @@ Commands
   * **get-annotations**  - show annotations
   * **show**             - show metadata for an entity
   * **onweb**            - opens Synapse website for Entity
+  * **cache**            - report the size of the local file cache or remove files from it
   * **show**             - Displays information about a Entity
 
 A few more commands (cat, create, update, associate)
@@ -56,6 +58,9 @@ from synapseclient import Activity
 import utils
 import signal
 import json
+import time
+import threading
+from multiprocessing.dummy import Pool as ThreadPool
 from synapseclient.exceptions import *
 
 
@@ -96,36 +101,138 @@ def _getIdsFromQuery(queryString, syn):
     return ids
 
 
-def _recursiveGet(id, path, syn):
-    """Traverses a heirarchy and download files and create subfolders as necessary."""
+def _recursiveGet(id, path, syn, max_workers=None):
+    """
+    Traverses a heirarchy and download files and create subfolders as necessary.
+
+    Folders are listed concurrently and each file is handed to a bounded pool of
+    downloads as soon as it is found, rather than after the whole heirarchy is walked.
+    Files that are already up to date in the destination are found in the cache without
+    asking Synapse for them, and files that are up to date elsewhere in the cache are not
+    downloaded again.  The destination is created if it does not exist.
+
+    :param max_workers: How many folders to list and files to download at once.
+                        Defaults to syn.max_threads.
+
+    :returns: A dictionary summarizing the download, with counts of 'folders', 'files'
+              and 'downloaded' files, the 'bytes' downloaded, the 'seconds' taken and a
+              list of ('errors') as (Synapse ID, exception) pairs
+    """
     from synapseclient.entity import is_container
 
-    results = syn.chunkedQuery("select id, name, concreteType from entity where entity.parentId=='%s'" %id)
-    for result in results:
-        if is_container(result):
-            new_path = os.path.join(path, result['entity.name'])
-            try:
-                os.mkdir(new_path)
-            except OSError as err:
-                if err.errno!=17:
-                    raise
-            print 'making dir', new_path
-            _recursiveGet(result['entity.id'], new_path, syn)
-        else:
-            syn.get(result['entity.id'], downloadLocation=path)
+    max_workers = max_workers or syn.max_threads
+    listers = ThreadPool(max_workers)
+    downloaders = ThreadPool(max_workers)
+    lock = threading.Condition()
+    summary = {'folders': 0, 'files': 0, 'downloaded': 0, 'bytes': 0, 'errors': []}
+    pending = {'listings': 0}
+    transfers = threading.local()
+
+    def count_transfer(event):
+        # Metrics hooks are called on the thread making the call, so each download counts only its own
+        if event['kind'] == 'download' and hasattr(transfers, 'bytes'):
+            transfers.files += 1
+            transfers.bytes += event['bytes_received'] or 0
+
+    def download(id, path, fileHandleId):
+        try:
+            transfers.files, transfers.bytes = 0, 0
+            if fileHandleId is None or not _isCachedIn(fileHandleId, path):
+                syn.get(id, downloadLocation=path)
+            with lock:
+                summary['files'] += 1
+                if transfers.files:
+                    summary['downloaded'] += 1
+                    summary['bytes'] += transfers.bytes
+        except Exception as ex:
+            with lock:
+                summary['errors'].append((id, ex))
+
+    def list_folder(id, path):
+        try:
+            results = syn.chunkedQuery("select id, name, concreteType, dataFileHandleId from entity where entity.parentId=='%s'" %id)
+            for result in results:
+                if is_container(result):
+                    new_path = os.path.join(path, result['entity.name'])
+                    try:
+                        os.mkdir(new_path)
+                    except OSError as err:
+                        if err.errno!=17:
+                            raise
+                    print 'making dir', new_path
+                    with lock:
+                        summary['folders'] += 1
+                    submit_listing(result['entity.id'], new_path)
+                else:
+                    downloaders.apply_async(download, (result['entity.id'], path, result.get('entity.dataFileHandleId', None)))
+        except Exception as ex:
+            with lock:
+                summary['errors'].append((id, ex))
+        finally:
+            with lock:
+                pending['listings'] -= 1
+                lock.notify_all()
+
+    def submit_listing(id, path):
+        with lock:
+            pending['listings'] += 1
+        listers.apply_async(list_folder, (id, path))
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    start = time.time()
+    syn.addMetricsHook(count_transfer)
+    try:
+        submit_listing(id, path)
+        with lock:
+            while pending['listings'] > 0:
+                # Waiting with a timeout keeps the wait interruptible by Ctrl-C
+                lock.wait(1)
+        downloaders.close()
+        downloaders.join()
+    finally:
+        listers.terminate()
+        downloaders.terminate()
+        syn.removeMetricsHook(count_transfer)
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def _isCachedIn(fileHandleId, directory):
+    """Returns whether an unmodified copy of the file is in the directory, according to the cache."""
+
+    directory = utils.normalize_path(directory)
+    for path, cacheTime, fileMTime in synapseclient.cache.iterator_over_cache_map(synapseclient.cache.determine_cache_directory(str(fileHandleId))):
+        if os.path.dirname(path) == directory and fileMTime == cacheTime:
+            return True
+    return False
+
+
+def _printDownloadSummary(summary):
+    seconds = max(summary['seconds'], 0.001)
+    print '\nDownloaded %d of %d files (%s) in %d folders in %s, %s/s' % (
+        summary['downloaded'], summary['files'], utils.humanizeBytes(summary['bytes']), summary['folders'],
+        utils.format_time_interval(seconds), utils.humanizeBytes(summary['bytes'] / seconds))
+    for id, ex in summary['errors']:
+        sys.stderr.write('Failed to get %s: %s\n' % (id, ex))
 
 
 def get(args, syn):
     if args.recursive:
         if args.version is not None:
             raise ValueError('You cannot specify a version making a recursive download.')
-        _recursiveGet(args.id, '.', syn)  #Todo should be updated with destination folder instead of '.'
+        summary = _recursiveGet(args.id, args.downloadLocation, syn)
+        _printDownloadSummary(summary)
+        if summary['errors']:
+            raise summary['errors'][0][1]
     elif args.queryString is not None:
         if args.version is not None or args.id is not None:
             raise ValueError('You cannot specify a version or id when you are dowloading a query.')
         ids = _getIdsFromQuery(args.queryString, syn)
-        for id in ids:
-            syn.get(id, downloadLocation='.')
+        if not os.path.exists(args.downloadLocation):
+            os.makedirs(args.downloadLocation)
+        for entity in syn.getMany(ids, downloadLocation=args.downloadLocation):
+            pass
     else:
         entity = syn.get(args.id, version=args.version, limitSearch=args.limitSearch)
         ## TODO: Is this part even necessary?
@@ -133,7 +240,7 @@ def get(args, syn):
         if 'files' in entity:
             for fp in entity['files']:
                 src = os.path.join(entity['cacheDir'], fp)
-                dst = os.path.join('.', fp.replace(".R_OBJECTS/",""))
+                dst = os.path.join(args.downloadLocation, fp.replace(".R_OBJECTS/",""))
                 print 'Creating %s' % dst
                 if not os.path.exists(os.path.dirname(dst)):
                     os.mkdir(dst)
@@ -189,6 +296,155 @@ def move(args, syn):
     print 'Moved %s to %s' %(ent.id, ent.parentId)
 
 
+def _listChildren(parentId, syn):
+    """Returns a dictionary mapping the names of a container's children to their IDs and whether they are containers."""
+    from synapseclient.entity import is_container
+
+    results = syn.chunkedQuery("select id, name, concreteType from entity where entity.parentId=='%s'" % parentId)
+    return dict((result['entity.name'], (result['entity.id'], is_container(result))) for result in results)
+
+
+def _localFileHasChanged(bundle, path):
+    """
+    Compares a local file with the File in Synapse.  The size and modification time of the
+    file are checked against the file cache first, so the file is only hashed if the cache
+    has no record of this version of it.
+    """
+    fileHandles = [handle for handle in bundle['fileHandles'] if handle['id'] == bundle['entity']['dataFileHandleId']]
+    if not fileHandles or fileHandles[0].get('contentSize', None) != os.path.getsize(path):
+        return True
+    fileHandle = fileHandles[0]
+
+    path = utils.normalize_path(path)
+    modified = synapseclient.cache.get_modification_time(path)
+    for cachedPath, cacheTime, _ in synapseclient.cache.iterator_over_cache_map(synapseclient.cache.determine_cache_directory(fileHandle['id'])):
+        if cachedPath == path and cacheTime == modified:
+            return False
+
+    if fileHandle.get('contentMd5', None) != synapseclient.cache.md5_for_file(path):
+        return True
+    # Remember the file, so the next sync needn't hash it again
+    synapseclient.cache.add_local_file_to_cache(path=path, **bundle['entity'])
+    return False
+
+
+def _syncDirectory(localdir, parentId, syn, max_workers=None):
+    """
+    Mirrors a local directory into a Synapse project or folder, creating the folders that are
+    missing and storing the files that are new or have changed since they were last stored.
+
+    Folders are created one level of the tree at a time, with the folders of each level
+    listed and created concurrently.  Files are stored with :py:func:`synapseclient.Synapse.storeMany`.
+
+    A local file whose name is taken by a folder in Synapse, or a local directory whose name is
+    taken by a file, is reported as failed and left alone, as is the content of such a directory.
+
+    :returns: A manifest, listing a dictionary with the local 'path', Synapse 'id', 'action'
+              ('created', 'updated', 'unchanged' or 'failed') and 'error' of each file and folder
+    """
+    from synapseclient.entity import Entity, File, Folder
+    from synapseclient.annotations import from_synapse_annotations
+
+    max_workers = max_workers or syn.max_threads
+    manifest = []
+    pool = ThreadPool(max_workers)
+    try:
+        # Mirror the folders, creating the ones missing from each level before moving on to the next
+        localdir = os.path.abspath(localdir)
+        remoteIds = {localdir: parentId}
+        level = [localdir]
+        files = []
+        while level:
+            listings = pool.map(lambda path: _listChildren(remoteIds[path], syn), level)
+            subdirs = []
+            newFolders = []
+            for path, listing in zip(level, listings):
+                for name in sorted(os.listdir(path)):
+                    childPath = os.path.join(path, name)
+                    existingId, isContainer = listing.get(name, (None, None))
+                    if os.path.isdir(childPath):
+                        if existingId and not isContainer:
+                            manifest.append({'path': childPath, 'id': existingId, 'action': 'failed',
+                                             'error': '%s is a directory, but %s is not a folder' % (childPath, existingId)})
+                            continue
+                        subdirs.append(childPath)
+                        if existingId:
+                            remoteIds[childPath] = existingId
+                            manifest.append({'path': childPath, 'id': existingId, 'action': 'unchanged', 'error': None})
+                        else:
+                            newFolders.append((childPath, Folder(name, parentId=remoteIds[path])))
+                    elif os.path.isfile(childPath):
+                        if existingId and isContainer:
+                            manifest.append({'path': childPath, 'id': existingId, 'action': 'failed',
+                                             'error': '%s is a file, but %s is a folder' % (childPath, existingId)})
+                            continue
+                        files.append((childPath, remoteIds[path], existingId))
+
+            results = syn.storeMany([folder for _, folder in newFolders], max_workers=max_workers)
+            for (path, _), result in zip(newFolders, results):
+                if isinstance(result, Exception):
+                    manifest.append({'path': path, 'id': None, 'action': 'failed', 'error': str(result)})
+                else:
+                    remoteIds[path] = result.id
+                    manifest.append({'path': path, 'id': result.id, 'action': 'created', 'error': None})
+            # The contents of folders that could not be created are left out
+            level = [path for path in subdirs if path in remoteIds]
+
+        # Decide which files to store, looking up the ones already in Synapse concurrently
+        def plan(item):
+            path, folderId, existingId = item
+            if existingId is None:
+                return 'created', File(path, parentId=folderId)
+            bundle = syn._getEntityBundle(existingId, bitFlags=0x800 | 0x2 | 0x1)
+            if not _localFileHasChanged(bundle, path):
+                return 'unchanged', existingId
+            entity = Entity.create(bundle['entity'], from_synapse_annotations(bundle['annotations']))
+            entity.path = path
+            return 'updated', entity
+
+        def safe_plan(item):
+            try:
+                return plan(item)
+            except Exception as ex:
+                return 'failed', ex
+
+        toStore = []
+        for (path, _, _), (action, result) in zip(files, pool.map(safe_plan, files)):
+            if action == 'unchanged':
+                manifest.append({'path': path, 'id': result, 'action': action, 'error': None})
+            elif action == 'failed':
+                manifest.append({'path': path, 'id': None, 'action': action, 'error': str(result)})
+            else:
+                toStore.append((path, action, result))
+
+        results = syn.storeMany([entity for _, _, entity in toStore], max_workers=max_workers)
+        for (path, action, _), result in zip(toStore, results):
+            if isinstance(result, Exception):
+                manifest.append({'path': path, 'id': None, 'action': 'failed', 'error': str(result)})
+            else:
+                manifest.append({'path': path, 'id': result.id, 'action': action, 'error': None})
+    finally:
+        pool.terminate()
+    return manifest
+
+
+def sync(args, syn):
+    manifest = _syncDirectory(args.localdir, args.parentid, syn)
+
+    out = open(args.manifest, 'w') if args.manifest else sys.stdout
+    try:
+        out.write('path\tid\taction\terror\n')
+        for item in manifest:
+            out.write('%s\t%s\t%s\t%s\n' % (item['path'], item['id'] or '', item['action'], item['error'] or ''))
+    finally:
+        if args.manifest:
+            out.close()
+
+    counts = collections.Counter(item['action'] for item in manifest)
+    sys.stderr.write('Created %d, updated %d, unchanged %d, failed %d\n'
+                     % (counts['created'], counts['updated'], counts['unchanged'], counts['failed']))
+
+
 def associate(args, syn):
     if args.r:
         files = [os.path.join(dp, f) for dp, dn, filenames in
@@ -406,6 +662,26 @@ def submit(args, syn):
         % (submission['id'], submission['entityId'], submission['name'], submission['evaluationId']))
 
 
+def cache(args, syn):
+    """Report the size of the file cache, or remove the least recently used files from it"""
+
+    maxSize = None if args.max_size is None else utils.parse_bytes(args.max_size)
+    accessedBefore = None if args.older_than is None else time.time() - args.older_than*24*60*60
+    if maxSize is not None or accessedBefore is not None:
+        removed = synapseclient.cache.purge_cache(max_size=maxSize, accessed_before=accessedBefore, dry_run=args.dry_run)
+        for path, size in removed:
+            print '%s %s (%s)' % ('Would remove' if args.dry_run else 'Removed', path, utils.humanizeBytes(size))
+        print '%s %d files, %s\n' % ('Would remove' if args.dry_run else 'Removed', len(removed),
+                                     utils.humanizeBytes(sum(size for _, size in removed)))
+
+    files = list(synapseclient.cache.iterator_over_cached_files())
+    print 'Cache directory: %s' % synapseclient.cache.CACHE_DIR
+    print 'Cached files:    %d' % len(files)
+    print 'Total size:      %s' % utils.humanizeBytes(sum(size for _, _, size, _ in files))
+    if syn.cache_max_size is not None:
+        print 'Maximum size:    %s' % utils.humanizeBytes(syn.cache_max_size)
+
+
 def login(args, syn):
     """Log in to Synapse, optionally caching credentials"""
     syn.login(args.synapseUser, args.synapsePassword, rememberMe=args.rememberMe)
@@ -439,6 +715,8 @@ def build_parser():
             help='Fetches content in Synapse recursively contained in the parentId specified by id.')
     parser_get.add_argument('--limitSearch', metavar='projId', type=str,
             help='Synapse ID of a container such as project or folder to limit search for files if using a path.')
+    parser_get.add_argument('--downloadLocation', metavar='path', type=str, default='.',
+            help='Directory to download files to. Defaults to the current directory.')
     parser_get.add_argument('id',  metavar='syn123', nargs='?', type=str,
             help='Synapse ID of form syn123 of desired data object.')
     parser_get.set_defaults(func=get)
@@ -503,6 +781,16 @@ def build_parser():
             help='file to be added to synapse.')
     parser_add.set_defaults(func=store)
 
+    parser_sync = subparsers.add_parser('sync',
+            help='mirror a local directory into a Synapse project or folder, storing only new and changed files')
+    parser_sync.add_argument('localdir', metavar='LOCAL_DIR', type=str,
+            help='local directory to mirror')
+    parser_sync.add_argument('parentid', metavar='syn123', type=str,
+            help='Synapse ID of the project or folder to mirror the directory into')
+    parser_sync.add_argument('--manifest', metavar='FILE', type=str, default=None,
+            help='write the manifest of created, updated and unchanged files to FILE rather than standard output')
+    parser_sync.set_defaults(func=sync)
+
     parser_mv = subparsers.add_parser('mv',
             help='Moves a file/folder in Synapse')
     parser_mv.add_argument('--id', metavar='syn123', type=str, required=True,
@@ -666,6 +954,16 @@ def build_parser():
     parser_onweb.add_argument('id', type=str, help='Synapse id')
     parser_onweb.set_defaults(func=onweb)
 
+    parser_cache = subparsers.add_parser('cache',
+            help='report the size of the local file cache or remove files from it')
+    parser_cache.add_argument('--max-size', metavar='SIZE', type=str, dest='max_size',
+            help='remove the least recently used files until the cache is no larger than SIZE, e.g. 100GB')
+    parser_cache.add_argument('--older-than', metavar='DAYS', type=float, dest='older_than',
+            help='remove files that have not been used in the last DAYS days')
+    parser_cache.add_argument('--dry-run', action='store_true', default=False, dest='dry_run',
+            help='list the files that would be removed without removing them')
+    parser_cache.set_defaults(func=cache)
+
     ## the purpose of the login command (as opposed to just using the -u and -p args) is
     ## to allow the command line user to cache credentials
     parser_login = subparsers.add_parser( 'login',
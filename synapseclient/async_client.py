@@ -0,0 +1,96 @@
+"""
+**************************
+Asynchronous Synapse Calls
+**************************
+
+:py:class:`AsyncSynapse` runs the calls of a :py:class:`synapseclient.Synapse` object in the
+background, so that a program can have many requests in flight at once and carry on with other
+work while they complete.  Each call returns immediately with a
+`multiprocessing AsyncResult <https://docs.python.org/2/library/multiprocessing.html#multiprocessing.pool.AsyncResult>`_,
+whose *get()* waits for and returns the result of the call, or raises its exception.  A *callback*
+keyword argument may be given to any call, to be called with the result once it is ready.
+
+Example::
+
+    import synapseclient
+    from synapseclient.async_client import AsyncSynapse
+
+    syn = synapseclient.login()
+    with AsyncSynapse(syn, max_workers=20) as async_syn:
+        pending = [async_syn.get(id, downloadFile=False) for id in ids]
+        entities = [result.get() for result in pending]
+
+The calls share the signing, retry policies, connection pool and file cache of the wrapped
+Synapse object.
+
+.. autoclass:: synapseclient.async_client.AsyncSynapse
+   :members:
+
+"""
+
+from multiprocessing.dummy import Pool as ThreadPool
+
+
+def _in_background(name):
+    def method(self, *args, **kwargs):
+        return self.submit(getattr(self.syn, name), *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = ("Runs :py:func:`synapseclient.Synapse.%s` in the background, "
+                      "returning an AsyncResult." % name)
+    return method
+
+
+class AsyncSynapse(object):
+    """
+    Runs the calls of a Synapse object on a pool of threads.
+
+    :param syn:         A :py:class:`synapseclient.Synapse` object, logged in if need be
+    :param max_workers: How many calls may be in flight at once.  Defaults to the
+                        size of the Synapse object's connection pool.
+    """
+
+    def __init__(self, syn, max_workers=None):
+        self.syn = syn
+        self.max_workers = max_workers or syn.pool_size
+        self._pool = ThreadPool(self.max_workers)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Calls function(\*args, \*\*kwargs) in the background.
+
+        :param callback: Optionally, a function to be called with the result, if the call succeeds
+
+        :returns: An AsyncResult
+        """
+        callback = kwargs.pop('callback', None)
+        return self._pool.apply_async(function, args, kwargs, callback)
+
+    restGET = _in_background('restGET')
+    restPOST = _in_background('restPOST')
+    restPUT = _in_background('restPUT')
+    restDELETE = _in_background('restDELETE')
+    get = _in_background('get')
+    store = _in_background('store')
+    delete = _in_background('delete')
+    tableQuery = _in_background('tableQuery')
+    downloadTableFile = _in_background('downloadTableFile')
+    uploadFileHandle = _in_background('_uploadToFileHandleService')
+
+    def chunkedQuery(self, *args, **kwargs):
+        """
+        Runs :py:func:`synapseclient.Synapse.chunkedQuery` in the background, returning an
+        AsyncResult whose value is the list of all of the query's results.
+        """
+        callback = kwargs.pop('callback', None)
+        return self.submit(lambda: list(self.syn.chunkedQuery(*args, **kwargs)), callback=callback)
+
+    def close(self):
+        """Waits for the calls in flight to finish, then stops the threads."""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
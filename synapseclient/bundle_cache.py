@@ -0,0 +1,110 @@
+"""
+*******************
+Entity Bundle Cache
+*******************
+
+An in-memory cache of entity bundles, used by :py:func:`synapseclient.Synapse._getEntityBundle`
+once enabled by :py:func:`synapseclient.Synapse.enableEntityBundleCache`.
+
+.. autoclass:: synapseclient.bundle_cache.EntityBundleCache
+   :members:
+
+"""
+
+import copy
+import time
+import collections
+import threading
+
+
+class EntityBundleCache(object):
+    """
+    A bounded, least recently used cache of entity bundles that expire after a time to live.
+
+    Bundles are copied on the way in and out, so callers are free to modify the bundles they get.
+
+    :param max_entries: How many bundles to keep
+    :param ttl:         How many seconds a bundle is used for before it is considered stale
+    :param revalidate:  Whether stale bundles are checked against the etag of the entity,
+                        rather than fetched again
+    """
+
+    def __init__(self, max_entries=1000, ttl=300, revalidate=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self._bundles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def get(self, key, fetch, fetch_etag=None):
+        """
+        Returns the bundle cached under the key, calling fetch() to get it if it is missing or stale.
+
+        :param key:        A tuple of the Synapse ID, version and bit flags of the bundle
+        :param fetch:      Function without arguments returning the bundle from Synapse
+        :param fetch_etag: Function without arguments returning the current etag of the entity,
+                           used to revalidate stale bundles
+        """
+
+        with self._lock:
+            entry = self._bundles.pop(key, None)
+            if entry is not None:
+                self._bundles[key] = entry
+        if entry is not None:
+            cachedAt, bundle = entry
+            if time.time() - cachedAt < self.ttl:
+                with self._lock:
+                    self.hits += 1
+                return copy.deepcopy(bundle)
+            if self.revalidate and fetch_etag is not None and 'entity' in bundle \
+                    and fetch_etag() == bundle['entity'].get('etag', None):
+                with self._lock:
+                    self.revalidations += 1
+                    if key in self._bundles:
+                        self._bundles[key] = (time.time(), bundle)
+                return copy.deepcopy(bundle)
+
+        with self._lock:
+            self.misses += 1
+        bundle = fetch()
+        if bundle is not None:
+            self.put(key, bundle)
+        return bundle
+
+    def put(self, key, bundle):
+        """Caches a copy of the bundle under the key, evicting the least recently used bundles if full."""
+
+        bundle = copy.deepcopy(bundle)
+        with self._lock:
+            self._bundles.pop(key, None)
+            self._bundles[key] = (time.time(), bundle)
+            while len(self._bundles) > self.max_entries:
+                self._bundles.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, synId):
+        """Forgets every cached bundle of the entity, whatever its version or bit flags."""
+
+        with self._lock:
+            for key in [key for key in self._bundles if key[0] == synId]:
+                del self._bundles[key]
+
+    def clear(self):
+        with self._lock:
+            self._bundles.clear()
+
+    def stats(self):
+        """Returns a dictionary of counts of hits, misses, revalidations, evictions and cached bundles."""
+
+        with self._lock:
+            lookups = self.hits + self.revalidations + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'revalidations': self.revalidations,
+                    'evictions': self.evictions,
+                    'size': len(self._bundles),
+                    'hit_rate': float(self.hits + self.revalidations) / lookups if lookups else 0.0}
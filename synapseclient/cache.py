@@ -10,6 +10,9 @@ File Caching
 .. automethod:: synapseclient.cache.remove_local_file_from_cache
 .. automethod:: synapseclient.cache.retrieve_local_file_info
 .. automethod:: synapseclient.cache.get_alternate_file_name
+.. automethod:: synapseclient.cache.iterator_over_cached_files
+.. automethod:: synapseclient.cache.purge_cache
+.. automethod:: synapseclient.cache.transfer_in_progress
 
 ~~~~~~~
 Helpers
@@ -24,15 +27,64 @@ Helpers
 .. automethod:: synapseclient.cache.parse_cache_entry_into_seconds
 .. automethod:: synapseclient.cache.get_modification_time
 
+~~~~~~~~~~~
+Cache Index
+~~~~~~~~~~~
+
+.. autoclass:: synapseclient.cache.CacheIndex
+.. automethod:: synapseclient.cache.get_cache_index
+
+~~~~~~~~~
+MD5 Cache
+~~~~~~~~~
+
+.. automethod:: synapseclient.cache.md5_for_file
+.. automethod:: synapseclient.cache.md5_for_files
+.. autoclass:: synapseclient.cache.Md5Cache
+.. automethod:: synapseclient.cache.get_md5_cache
+.. automethod:: synapseclient.cache.md5_cache_key
+.. automethod:: synapseclient.cache.lookup_md5
+.. automethod:: synapseclient.cache.record_md5
+
+~~~~~~~~~~~~~~~
+User Name Cache
+~~~~~~~~~~~~~~~
+
+.. autoclass:: synapseclient.cache.UserNameCache
+.. automethod:: synapseclient.cache.get_user_name_cache
+
+~~~~~~~~~~~~~~~
+Upload Journals
+~~~~~~~~~~~~~~~
+
+.. automethod:: synapseclient.cache.upload_journal_path
+.. automethod:: synapseclient.cache.read_upload_journal
+.. automethod:: synapseclient.cache.write_upload_journal
+.. automethod:: synapseclient.cache.remove_upload_journal
+
+~~~~~~~~~~~~~~~~~
+Partial Downloads
+~~~~~~~~~~~~~~~~~
+
+.. automethod:: synapseclient.cache.read_partial_download
+.. automethod:: synapseclient.cache.write_partial_download
+.. automethod:: synapseclient.cache.remove_partial_download
+
 """
 
 import os, sys, re
 import time, calendar
 import errno, shutil
-import json, urlparse
+import json, urlparse, hashlib
+import collections
+import contextlib
+import sqlite3
+import warnings
+import multiprocessing
 import synapseclient.utils as utils
 from synapseclient.exceptions import *
-from threading import Lock
+from threading import Lock, local
+from multiprocessing.dummy import Pool as ThreadPool
 
 CACHE_DIR = os.path.join(os.path.expanduser('~'), '.synapseCache')
 CACHE_FANOUT = 1000
@@ -41,6 +93,23 @@ CACHE_LOCK_TIME = 10
 CACHE_UNLOCK_WAIT_TIME = 0.5
 CACHE_MAP_NAME = '.cacheMap'
 CACHE_LOCK_SUFFIX = '.lock'
+UPLOAD_JOURNAL_DIR_NAME = '.uploads'
+PARTIAL_DOWNLOAD_SUFFIX = '.partial'
+CACHE_INDEX_NAME = '.cacheIndex.sqlite'
+
+# When enabled, cache entries are kept in a single SQLite database in CACHE_DIR
+# rather than in a '.cacheMap' per file handle, see CacheIndex
+CACHE_INDEX_ENABLED = False
+
+# The MD5s of local files are remembered in a SQLite database in CACHE_DIR, see Md5Cache
+MD5_CACHE_NAME = '.md5Cache.sqlite'
+MD5_CACHE_ENABLED = True
+MD5_CACHE_MIN_AGE = 2
+
+# The display names of users and teams are remembered for a week in a SQLite database in CACHE_DIR,
+# see UserNameCache
+USER_NAME_CACHE_NAME = '.userNames.sqlite'
+USER_NAME_CACHE_TTL = 7 * 24 * 60 * 60
 
 
 def local_file_has_changed(entityBundle, checkIndirect, path=None):
@@ -134,16 +203,181 @@ def add_local_file_to_cache(**entity):
                 break
 
     # Update the cache
-    if os.path.exists(entity['path']):
+    index = get_cache_index()
+    if os.path.exists(entity['path']) and index is not None:
+        index.add(entity['dataFileHandleId'], entity['path'], get_modification_time(entity['path']))
+    elif os.path.exists(entity['path']):
         cache = obtain_lock_and_read_cache(cacheDir)
         cache[entity['path']] = time.strftime(utils.ISO_FORMAT, time.gmtime(os.path.getmtime(entity['path'])))
         write_cache_then_release_lock(cacheDir, cache)
+        if _is_in_cache_directory(entity['path']):
+            with _cache_sizes_lock:
+                if CACHE_DIR in _cache_sizes:
+                    _cache_sizes[CACHE_DIR] += _size_of(entity['path']) or 0
 
 
 def remove_local_file_from_cache(path, fileHandle):
-    """TODO_Sphinx"""
+    """
+    Removes the cache entry recording the file as a copy of the file handle.
+    If the file is stored within the cache directory, the file itself is deleted too.
+    Files elsewhere, such as ones downloaded to a 'downloadLocation', are left alone.
 
-    raise NotImplementedError("Behavior or usage of this method has not been decided yet")
+    :param path:       Path to the file
+    :param fileHandle: The file handle or its ID
+    """
+
+    fileHandleId = str(fileHandle['id'] if isinstance(fileHandle, collections.Mapping) else fileHandle)
+    path = utils.normalize_path(path)
+
+    index = get_cache_index()
+    if index is not None:
+        index.remove(fileHandleId, path)
+    else:
+        cacheDir = determine_cache_directory(fileHandleId)
+        if os.path.exists(os.path.join(cacheDir, CACHE_MAP_NAME)):
+            cache = obtain_lock_and_read_cache(cacheDir)
+            cache.pop(path, None)
+            write_cache_then_release_lock(cacheDir, cache)
+
+    if _is_in_cache_directory(path):
+        _remove_if_exists(path)
+        if os.path.isdir(path + '_unpacked'):
+            shutil.rmtree(path + '_unpacked')
+
+
+def iterator_over_cached_files():
+    """
+    Returns an iterator over the files stored within the cache directory, giving the
+    file handle ID, path, size in bytes and time of last access (in seconds from the
+    UNIX epoch) of each.  The last access is taken from the cache index when it is
+    enabled and from the file system otherwise.
+    """
+
+    index = get_cache_index()
+    if not os.path.isdir(CACHE_DIR):
+        return
+    for fanout in os.listdir(CACHE_DIR):
+        fanoutDir = os.path.join(CACHE_DIR, fanout)
+        if not fanout.isdigit() or not os.path.isdir(fanoutDir):
+            continue
+        for fileHandleId in os.listdir(fanoutDir):
+            cacheDir = os.path.join(fanoutDir, fileHandleId)
+            if not os.path.isdir(cacheDir):
+                continue
+            for name in os.listdir(cacheDir):
+                # Skip the '.cacheMap', its lock, the sidecars and temporary files of transfers
+                # and unpacked zip files, which go along with their zip file
+                path = utils.normalize_path(os.path.join(cacheDir, name))
+                if name.startswith(CACHE_MAP_NAME) or name.endswith(_TRANSFER_SUFFIXES) or not os.path.isfile(path):
+                    continue
+                size = os.path.getsize(path)
+                if os.path.isdir(path + '_unpacked'):
+                    size += _directory_size(path + '_unpacked')
+                lastAccess = index.last_access(path) if index is not None else None
+                if lastAccess is None:
+                    lastAccess = max(os.path.getatime(path), os.path.getmtime(path))
+                yield fileHandleId, path, size, lastAccess
+
+
+_TRANSFER_SUFFIXES = (PARTIAL_DOWNLOAD_SUFFIX, '.tmp')
+
+_transfers = collections.Counter()
+_transfers_lock = Lock()
+
+@contextlib.contextmanager
+def transfer_in_progress(path):
+    """
+    Marks the file at the path as being written for the duration of a with block,
+    so that :py:func:`purge_cache` leaves it alone::
+
+        with cache.transfer_in_progress(destination):
+            ...
+    """
+
+    path = utils.normalize_path(path)
+    with _transfers_lock:
+        _transfers[path] += 1
+    try:
+        yield
+    finally:
+        with _transfers_lock:
+            _transfers[path] -= 1
+            if _transfers[path] <= 0:
+                del _transfers[path]
+
+
+def _is_being_transferred(path):
+    # Transfers by this process are registered, those of other processes leave a sidecar
+    with _transfers_lock:
+        if path in _transfers:
+            return True
+    return os.path.exists(path + PARTIAL_DOWNLOAD_SUFFIX)
+
+
+## Without the index, the bytes held in each cache directory as of its last walk,
+## plus the files added since, so that the cache is only walked once it may be too big.
+## Files removed meanwhile only make the count too high, which costs an extra walk.
+_cache_sizes = {}
+_cache_sizes_lock = Lock()
+
+_purge_lock = Lock()
+def purge_cache(max_size=None, accessed_before=None, keep=(), dry_run=False):
+    """
+    Removes files from the cache directory, least recently used first.  Files that are
+    being downloaded are left alone.  Purges are done one at a time.
+
+    When the cache index is enabled, the files and their last access are taken from the
+    index, so that checking whether a purge is needed does not walk the cache directory.
+    Otherwise the size of the cache is counted as files are added to it, and the cache
+    directory is only walked when the count goes over *max_size*.
+
+    :param max_size:        Remove files until the cache holds no more than this many bytes
+    :param accessed_before: Remove files last used before this time, in seconds from the UNIX epoch
+    :param keep:            Paths of files that must not be removed
+    :param dry_run:         Only report which files would be removed
+
+    :returns: A list of (path, size in bytes) of the removed files
+    """
+
+    keep = set(utils.normalize_path(path) for path in keep)
+    with _purge_lock:
+        index = get_cache_index()
+        if index is not None:
+            totalSize = index.total_size(CACHE_DIR)
+            if accessed_before is None and (max_size is None or totalSize <= max_size):
+                return []
+            files = index.files_by_last_access(CACHE_DIR)
+        else:
+            with _cache_sizes_lock:
+                knownSize = _cache_sizes.get(CACHE_DIR, None)
+            if accessed_before is None and max_size is not None and knownSize is not None and knownSize <= max_size:
+                return []
+            files = sorted(iterator_over_cached_files(), key=lambda f: f[3])
+            totalSize = walkedSize = sum(size for _, _, size, _ in files)
+
+        removed = []
+        for fileHandleId, path, size, lastAccess in files:
+            tooOld = accessed_before is not None and lastAccess < accessed_before
+            tooBig = max_size is not None and totalSize > max_size
+            if not tooOld and not tooBig:
+                # Files are in order of last access, so nothing further is too old either
+                break
+            if index is not None and not os.path.isfile(path):
+                # Forget files removed behind the cache's back
+                if not dry_run:
+                    index.remove(fileHandleId, path)
+                totalSize -= size
+                continue
+            if path in keep or _is_being_transferred(path):
+                continue
+            if not dry_run:
+                remove_local_file_from_cache(path, fileHandleId)
+            totalSize -= size
+            removed.append((path, size))
+        if index is None:
+            with _cache_sizes_lock:
+                _cache_sizes[CACHE_DIR] = walkedSize if dry_run else totalSize
+        return removed
 
 
 def retrieve_local_file_info(entityBundle, path=None):
@@ -312,12 +546,16 @@ def iterator_over_cache_map(cacheDir):
     Values are only returned for paths that exist.
     """
 
-    # Read the '.cacheMap'
-    cache = obtain_lock_and_read_cache(cacheDir)
-    write_cache_then_release_lock(cacheDir)
+    index = get_cache_index()
+    if index is not None:
+        entries = index.entries(os.path.basename(cacheDir))
+    else:
+        # Read the '.cacheMap'
+        cache = obtain_lock_and_read_cache(cacheDir)
+        write_cache_then_release_lock(cacheDir)
+        entries = [(file, parse_cache_entry_into_seconds(cache[file])) for file in cache.keys()]
 
-    for file in cache.keys():
-        cacheTime = parse_cache_entry_into_seconds(cache[file])
+    for file, cacheTime in entries:
         if os.path.exists(file):
             fileMTime = get_modification_time(file)
             yield file, cacheTime, fileMTime
@@ -359,6 +597,15 @@ def parse_cache_entry_into_seconds(isoTime):
     return calendar.timegm(cacheTime)
 
 
+def _is_in_cache_directory(path):
+    cacheRoot = utils.normalize_path(CACHE_DIR).rstrip('/') + '/'
+    return utils.normalize_path(path).startswith(cacheRoot)
+
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
 def get_modification_time(path):
     """
     Returns the modification time of the path in the number of seconds from the UNIX epoch.
@@ -367,3 +614,587 @@ def get_modification_time(path):
 
     if not os.path.exists(path): return None
     return calendar.timegm(time.gmtime(os.path.getmtime(path)))
+
+
+#################
+## Cache index ##
+#################
+
+class CacheIndex(object):
+    """
+    Keeps the entries of the file cache in one SQLite database, indexed by file handle ID
+    and path, in place of a '.cacheMap' in each file handle's cache directory.
+    The database is opened in write-ahead-log mode, so several processes sharing
+    a cache can read it while another writes to it, without taking lock directories.
+
+    The '.cacheMap' of a file handle is copied into the index the first time the
+    file handle is looked up, or when the size of the cache is first asked for.
+    After that, its '.cacheMap' is no longer read or updated.
+
+    :param cacheRoot: The cache directory holding the database, typically CACHE_DIR
+    """
+
+    def __init__(self, cacheRoot):
+        self.cacheRoot = cacheRoot
+        self.path = os.path.join(cacheRoot, CACHE_INDEX_NAME)
+        self._local = local()
+        self._migrated_all = False
+
+    def _connection(self):
+        # SQLite connections may not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = _open_database(self.path)
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS cache_entries ('
+                                   'file_handle_id TEXT NOT NULL, '
+                                   'path TEXT NOT NULL, '
+                                   'cache_time INTEGER NOT NULL, '
+                                   'last_access REAL, '
+                                   'PRIMARY KEY (file_handle_id, path))')
+                columns = [row[1] for row in connection.execute('PRAGMA table_info(cache_entries)')]
+                if 'last_access' not in columns:
+                    connection.execute('ALTER TABLE cache_entries ADD COLUMN last_access REAL')
+                if 'size' not in columns:
+                    connection.execute('ALTER TABLE cache_entries ADD COLUMN size INTEGER')
+                connection.execute('CREATE INDEX IF NOT EXISTS cache_entries_by_path ON cache_entries (path)')
+                connection.execute('CREATE INDEX IF NOT EXISTS cache_entries_by_last_access ON cache_entries (last_access)')
+                connection.execute('CREATE TABLE IF NOT EXISTS migrated_cache_maps ('
+                                   'file_handle_id TEXT PRIMARY KEY)')
+            self._local.connection = connection
+        return connection
+
+    def entries(self, fileHandleId):
+        """Returns a list of (path, cache time in seconds from the UNIX epoch) cached for the file handle."""
+
+        connection = self._connection()
+        self._migrate(connection, str(fileHandleId))
+        return connection.execute('SELECT path, cache_time FROM cache_entries WHERE file_handle_id = ?',
+                                  (str(fileHandleId),)).fetchall()
+
+    def add(self, fileHandleId, path, cacheTime):
+        """
+        Records that the file at the path is a copy of the file handle, last modified at cacheTime.
+        The file is also marked as accessed now.
+        """
+
+        connection = self._connection()
+        self._migrate(connection, str(fileHandleId))
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO cache_entries '
+                               '(file_handle_id, path, cache_time, last_access, size) VALUES (?, ?, ?, ?, ?)',
+                               (str(fileHandleId), _as_text(path), cacheTime, time.time(), _size_of(path)))
+
+    def last_access(self, path):
+        """Returns when the file at the path was last added to the cache, or None if it is not in the index."""
+
+        return self._connection().execute('SELECT MAX(last_access) FROM cache_entries WHERE path = ?',
+                                          (_as_text(path),)).fetchone()[0]
+
+    def total_size(self, cacheRoot):
+        """Returns the number of bytes taken by the files in the index that are within the cache directory."""
+
+        connection = self._connection()
+        prefix = _as_text(utils.normalize_path(cacheRoot).rstrip('/') + '/')
+        self._migrate_all(connection)
+        self._fill_in_sizes(connection, prefix)
+        return connection.execute('SELECT SUM(size) FROM (SELECT MAX(size) AS size FROM cache_entries '
+                                  'WHERE substr(path, 1, ?) = ? GROUP BY path)',
+                                  (len(prefix), prefix)).fetchone()[0] or 0
+
+    def files_by_last_access(self, cacheRoot):
+        """
+        Returns a list of the file handle ID, path, size in bytes and time of last access of each
+        file in the index that is within the cache directory, least recently accessed first.
+        """
+
+        connection = self._connection()
+        prefix = _as_text(utils.normalize_path(cacheRoot).rstrip('/') + '/')
+        self._migrate_all(connection)
+        self._fill_in_sizes(connection, prefix)
+        return connection.execute('SELECT file_handle_id, path, MAX(size), '
+                                  'MAX(COALESCE(last_access, cache_time)) AS accessed FROM cache_entries '
+                                  'WHERE substr(path, 1, ?) = ? GROUP BY path ORDER BY accessed',
+                                  (len(prefix), prefix)).fetchall()
+
+    def _migrate_all(self, connection):
+        # The files of '.cacheMap's not yet copied into the index would be left out of its totals,
+        # so they are all copied once in the life of the index, in case a client without the
+        # index has added to the cache
+        if self._migrated_all:
+            return
+        migrated = set(row[0] for row in connection.execute('SELECT file_handle_id FROM migrated_cache_maps'))
+        if os.path.isdir(self.cacheRoot):
+            for fanout in os.listdir(self.cacheRoot):
+                fanoutDir = os.path.join(self.cacheRoot, fanout)
+                if not fanout.isdigit() or not os.path.isdir(fanoutDir):
+                    continue
+                for fileHandleId in os.listdir(fanoutDir):
+                    if fileHandleId not in migrated and os.path.exists(os.path.join(fanoutDir, fileHandleId, CACHE_MAP_NAME)):
+                        self._migrate(connection, fileHandleId)
+        self._migrated_all = True
+
+    def _fill_in_sizes(self, connection, prefix):
+        # Entries copied from '.cacheMap's were recorded without a size
+        missing = connection.execute('SELECT DISTINCT path FROM cache_entries WHERE size IS NULL '
+                                     'AND substr(path, 1, ?) = ?', (len(prefix), prefix)).fetchall()
+        if missing:
+            with connection:
+                connection.executemany('UPDATE cache_entries SET size = ? WHERE path = ?',
+                                       [(_size_of(path) or 0, path) for path, in missing])
+
+    def remove(self, fileHandleId, path):
+        """Removes the entry for the path from the file handle's entries."""
+
+        connection = self._connection()
+        self._migrate(connection, str(fileHandleId))
+        with connection:
+            connection.execute('DELETE FROM cache_entries WHERE file_handle_id = ? AND path = ?',
+                               (str(fileHandleId), _as_text(path)))
+
+    def _migrate(self, connection, fileHandleId):
+        if connection.execute('SELECT 1 FROM migrated_cache_maps WHERE file_handle_id = ?',
+                              (fileHandleId,)).fetchone():
+            return
+        cacheMap = {}
+        cacheDir = determine_cache_directory(fileHandleId)
+        if os.path.exists(os.path.join(cacheDir, CACHE_MAP_NAME)):
+            cacheMap = obtain_lock_and_read_cache(cacheDir)
+            write_cache_then_release_lock(cacheDir)
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO migrated_cache_maps VALUES (?)', (fileHandleId,))
+            connection.executemany('INSERT OR IGNORE INTO cache_entries (file_handle_id, path, cache_time) VALUES (?, ?, ?)',
+                                   [(fileHandleId, path, parse_cache_entry_into_seconds(isoTime))
+                                    for path, isoTime in cacheMap.items()])
+
+
+def _open_database(path):
+    cacheRoot = os.path.dirname(path)
+    if not os.path.exists(cacheRoot):
+        try:
+            os.makedirs(cacheRoot)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    connection = sqlite3.connect(path, timeout=CACHE_MAX_LOCK_TRY_TIME)
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
+def _size_of(path):
+    # The size of a cached file, including its unpacked contents if it is a zip file
+    if not os.path.isfile(path):
+        return None
+    size = os.path.getsize(path)
+    if os.path.isdir(path + '_unpacked'):
+        size += _directory_size(path + '_unpacked')
+    return size
+
+
+def _as_text(path):
+    # SQLite refuses byte strings that are not ASCII
+    if isinstance(path, str):
+        return path.decode(sys.getfilesystemencoding() or 'utf-8')
+    return path
+
+
+_cache_index = None
+_cache_index_lock = Lock()
+def get_cache_index():
+    """
+    Returns the :py:class:`CacheIndex` of CACHE_DIR, or None unless CACHE_INDEX_ENABLED
+    is set, which it is by the 'index' option of the [cache] section of the config file::
+
+        [cache]
+        index = sqlite
+    """
+
+    global _cache_index
+    if not CACHE_INDEX_ENABLED:
+        return None
+    with _cache_index_lock:
+        if _cache_index is None or _cache_index.cacheRoot != CACHE_DIR:
+            _cache_index = CacheIndex(CACHE_DIR)
+        return _cache_index
+
+
+###############
+## MD5 cache ##
+###############
+
+class Md5Cache(object):
+    """
+    Remembers the MD5s of local files in a SQLite database, so unchanged files need not be hashed again.
+
+    Entries are keyed on the device, inode, size and modification time (in nanoseconds) of the file,
+    rather than on its path, so a file keeps its entry when it is renamed and loses it when it is
+    modified or replaced.
+
+    :param cacheRoot: The cache directory holding the database, typically CACHE_DIR
+    """
+
+    def __init__(self, cacheRoot):
+        self.cacheRoot = cacheRoot
+        self.path = os.path.join(cacheRoot, MD5_CACHE_NAME)
+        self._local = local()
+
+    def _connection(self):
+        # SQLite connections may not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = _open_database(self.path)
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS md5s ('
+                                   'device INTEGER NOT NULL, '
+                                   'inode INTEGER NOT NULL, '
+                                   'size INTEGER NOT NULL, '
+                                   'mtime_ns INTEGER NOT NULL, '
+                                   'md5 TEXT NOT NULL, '
+                                   'PRIMARY KEY (device, inode, size, mtime_ns))')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        """Returns the MD5 recorded for the key returned by :py:func:`md5_cache_key`, or None."""
+
+        row = self._connection().execute('SELECT md5 FROM md5s WHERE device = ? AND inode = ? '
+                                         'AND size = ? AND mtime_ns = ?', key).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, md5):
+        """Records the MD5 of the file with the given key, forgetting older versions of the file."""
+
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM md5s WHERE device = ? AND inode = ?', key[:2])
+            connection.execute('INSERT INTO md5s VALUES (?, ?, ?, ?, ?)', tuple(key) + (md5,))
+
+
+def md5_cache_key(path):
+    """
+    Returns the (device, inode, size, modification time in nanoseconds) of the file, or None for
+    files whose inode is unknown, such as on file systems that do not have them.
+    """
+
+    st = os.stat(path)
+    if not st.st_ino:
+        return None
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 10**9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+_md5_cache = None
+_md5_cache_lock = Lock()
+def get_md5_cache():
+    """
+    Returns the :py:class:`Md5Cache` of CACHE_DIR, or None if MD5_CACHE_ENABLED has been
+    turned off by the 'md5_cache' option of the [cache] section of the config file::
+
+        [cache]
+        md5_cache = false
+    """
+
+    global _md5_cache
+    if not MD5_CACHE_ENABLED:
+        return None
+    with _md5_cache_lock:
+        if _md5_cache is None or _md5_cache.cacheRoot != CACHE_DIR:
+            _md5_cache = Md5Cache(CACHE_DIR)
+        return _md5_cache
+
+
+def lookup_md5(path):
+    """Returns the hexadecimal MD5 of the file if it is in the MD5 cache, or None."""
+
+    md5Cache = get_md5_cache()
+    key = md5_cache_key(path) if md5Cache else None
+    return _cached_md5(md5Cache, key) if key else None
+
+
+def _cached_md5(md5Cache, key):
+    # An MD5 cache that can't be used, say in a read-only directory or on a file system
+    # without the locking SQLite needs, is no reason to fail: the file is hashed instead
+    try:
+        return md5Cache.get(key)
+    except (sqlite3.Error, EnvironmentError) as ex:
+        warnings.warn('Could not read the MD5 cache: %s' % ex)
+        return None
+
+
+def record_md5(path, md5, key):
+    """
+    Records the MD5 of a file in the MD5 cache.
+
+    :param path: The file
+    :param md5:  Its hexadecimal MD5
+    :param key:  Its :py:func:`md5_cache_key`, taken before hashing it.
+                 Nothing is recorded if the file has changed since.
+    """
+
+    md5Cache = get_md5_cache()
+    if md5Cache is None or key is None:
+        return
+    if md5_cache_key(path) != key:
+        return
+    # A file modified again within the resolution of its modification time would keep its key,
+    # so files modified moments ago are left for the next time they are hashed
+    if time.time() - key[3] / 10.0**9 < MD5_CACHE_MIN_AGE:
+        return
+    try:
+        md5Cache.put(key, md5)
+    except (sqlite3.Error, EnvironmentError) as ex:
+        warnings.warn('Could not update the MD5 cache: %s' % ex)
+
+
+def md5_for_file(path):
+    """
+    Returns the hexadecimal MD5 of the file, from the MD5 cache if this version
+    of the file has been hashed before, else by hashing the file.
+    """
+
+    md5Cache = get_md5_cache()
+    key = md5_cache_key(path) if md5Cache else None
+    md5 = _cached_md5(md5Cache, key) if key else None
+    if md5 is None:
+        md5 = _hash_file(path)
+        record_md5(path, md5, key)
+    return md5
+
+
+def md5_for_files(paths, max_threads=None):
+    """
+    Returns a dictionary of the hexadecimal MD5s of many files.  Files that are not
+    in the MD5 cache are hashed in parallel, by a pool of threads; hashlib releases
+    the interpreter lock while it hashes each block.
+
+    :param paths:       The files
+    :param max_threads: How many files to hash at once, defaulting to the number of CPUs
+    """
+
+    md5s = {}
+    keys = {}
+    md5Cache = get_md5_cache()
+    for path in paths:
+        key = md5_cache_key(path) if md5Cache else None
+        md5 = _cached_md5(md5Cache, key) if key else None
+        if md5 is None:
+            keys[path] = key
+        else:
+            md5s[path] = md5
+
+    toHash = list(collections.OrderedDict.fromkeys(path for path in paths if path in keys))
+    if len(toHash) > 1 and max_threads != 1:
+        pool = ThreadPool(min(max_threads or multiprocessing.cpu_count(), len(toHash)))
+        try:
+            hashed = pool.map(_hash_file, toHash)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        hashed = [_hash_file(path) for path in toHash]
+
+    for path, md5 in zip(toHash, hashed):
+        record_md5(path, md5, keys[path])
+        md5s[path] = md5
+    return md5s
+
+
+def _hash_file(path):
+    return utils.md5_for_file(path).hexdigest()
+
+
+#####################
+## User name cache ##
+#####################
+
+class UserNameCache(object):
+    """
+    Remembers the display names of principals, that is users and teams, in a SQLite database,
+    so that listings need not look them up again each time they are run.  Names are kept
+    per repository endpoint, as principal IDs are only unique within one Synapse stack.
+
+    :param cacheRoot: The cache directory holding the database, typically CACHE_DIR
+    :param ttl:       How many seconds a name is used for before it is looked up again
+    """
+
+    def __init__(self, cacheRoot, ttl=USER_NAME_CACHE_TTL):
+        self.cacheRoot = cacheRoot
+        self.path = os.path.join(cacheRoot, USER_NAME_CACHE_NAME)
+        self.ttl = ttl
+        self._local = local()
+
+    def _connection(self):
+        # SQLite connections may not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = _open_database(self.path)
+            with connection:
+                ## Names recorded without their endpoint can't be trusted
+                connection.execute('DROP TABLE IF EXISTS user_names')
+                connection.execute('CREATE TABLE IF NOT EXISTS principal_names ('
+                                   'endpoint TEXT NOT NULL, '
+                                   'principal_id TEXT NOT NULL, '
+                                   'name TEXT NOT NULL, '
+                                   'fetched_at REAL NOT NULL, '
+                                   'PRIMARY KEY (endpoint, principal_id))')
+            self._local.connection = connection
+        return connection
+
+    def get_many(self, principalIds, endpoint):
+        """
+        Returns a dictionary of the names recorded, less than ttl seconds ago, for the principal IDs.
+
+        :param principalIds: The principal IDs to look up
+        :param endpoint:     The repository endpoint the principals belong to
+        """
+
+        principalIds = [str(principalId) for principalId in principalIds]
+        names = {}
+        connection = self._connection()
+        ## Stay well within SQLite's limit of 999 parameters to a statement
+        for i in range(0, len(principalIds), 500):
+            batch = principalIds[i:i+500]
+            names.update(connection.execute('SELECT principal_id, name FROM principal_names '
+                                            'WHERE endpoint = ? AND fetched_at > ? '
+                                            'AND principal_id IN (%s)' % ','.join('?' * len(batch)),
+                                            [endpoint, time.time() - self.ttl] + batch).fetchall())
+        return names
+
+    def put_many(self, names, endpoint):
+        """Records a dictionary of names by principal ID, for the given repository endpoint."""
+
+        connection = self._connection()
+        now = time.time()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO principal_names VALUES (?, ?, ?, ?)',
+                                   [(endpoint, str(principalId), name, now)
+                                    for principalId, name in names.items()])
+
+
+_user_name_cache = None
+_user_name_cache_lock = Lock()
+def get_user_name_cache():
+    """Returns the :py:class:`UserNameCache` of CACHE_DIR."""
+
+    global _user_name_cache
+    with _user_name_cache_lock:
+        if _user_name_cache is None or _user_name_cache.cacheRoot != CACHE_DIR:
+            _user_name_cache = UserNameCache(CACHE_DIR)
+        return _user_name_cache
+
+
+def upload_journal_path(filepath, chunksize, mimetype):
+    """
+    Returns the path of the journal that tracks a chunked upload of the given file.
+    Journals live in the cache directory and are keyed on the absolute path of the file,
+    along with the chunk size and mime-type, which must match for chunks to be reused.
+    """
+
+    key = json.dumps([os.path.abspath(filepath), chunksize, mimetype])
+    return os.path.join(CACHE_DIR, UPLOAD_JOURNAL_DIR_NAME, hashlib.md5(key).hexdigest() + '.json')
+
+
+def read_upload_journal(journalPath, fingerprint):
+    """
+    Reads an upload journal written by :py:func:`write_upload_journal`.
+
+    :param journalPath: Path returned by :py:func:`upload_journal_path`
+    :param fingerprint: A dictionary with the 'size', 'mtime' and 'md5' of the file
+                        as it is now
+
+    :returns: The journal, or None if there is no journal or it was written for
+              a different version of the file, in which case it is removed
+    """
+
+    if not os.path.exists(journalPath):
+        return None
+    try:
+        with open(journalPath, 'r') as f:
+            journal = json.load(f)
+    except ValueError:
+        journal = None
+    if journal is None or journal.get('fingerprint') != fingerprint:
+        remove_upload_journal(journalPath)
+        return None
+    return journal
+
+
+def write_upload_journal(journalPath, journal):
+    """
+    Writes an upload journal, replacing the previous one.  The journal is
+    written to a temporary file first, so an interrupted write leaves the
+    previous journal intact.
+    """
+
+    journalDir = os.path.dirname(journalPath)
+    if not os.path.exists(journalDir):
+        try:
+            os.makedirs(journalDir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    _write_json_file(journalPath, journal)
+
+
+def remove_upload_journal(journalPath):
+    """Removes an upload journal, if it exists."""
+
+    _remove_if_exists(journalPath)
+
+
+def read_partial_download(path, record):
+    """
+    Reads the '.partial' sidecar kept next to a file that is being downloaded in ranges.
+
+    :param path:   The destination of the download
+    :param record: A dictionary describing the download, such as its size, part size and MD5,
+                   which must match the one the sidecar was written with, so that the parts
+                   of one version of a file are never resumed into another
+
+    :returns: The list of completed parts, or None if the download cannot be resumed
+    """
+
+    sidecarPath = path + PARTIAL_DOWNLOAD_SUFFIX
+    if not os.path.exists(sidecarPath) or not os.path.exists(path):
+        return None
+    try:
+        with open(sidecarPath, 'r') as f:
+            sidecar = json.load(f)
+    except ValueError:
+        return None
+    if sidecar.get('download') != record:
+        return None
+    return sidecar['completedParts']
+
+
+def write_partial_download(path, record, completedParts):
+    """Records the parts of a download that have been written to disk, see :py:func:`read_partial_download`."""
+
+    _write_json_file(path + PARTIAL_DOWNLOAD_SUFFIX, {'download': record, 'completedParts': completedParts})
+
+
+def remove_partial_download(path):
+    """Removes the '.partial' sidecar of a completed download, if it exists."""
+
+    _remove_if_exists(path + PARTIAL_DOWNLOAD_SUFFIX)
+
+
+def _write_json_file(path, obj):
+    # Write to a temporary file first, so an interrupted write leaves the previous version intact
+    tempPath = path + '.tmp'
+    with open(tempPath, 'w') as f:
+        json.dump(obj, f)
+    # Renaming onto an existing file fails on Windows
+    if os.path.exists(path) and sys.platform == 'win32':
+        os.remove(path)
+    os.rename(tempPath, path)
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
@@ -31,6 +31,7 @@ See also the `Synapse API documentation <http://rest.synapse.org>`_.
 
 import ConfigParser
 import collections
+import itertools
 import os, sys, stat, re, json, time
 import os.path
 import base64, hashlib, hmac
@@ -40,6 +41,9 @@ import mimetypes
 import tempfile
 import warnings
 import getpass
+import threading
+import sqlite3
+from multiprocessing.dummy import Pool as ThreadPool
 
 import synapseclient
 import synapseclient.utils as utils
@@ -52,11 +56,14 @@ from synapseclient.annotations import from_synapse_annotations, to_synapse_annot
 from synapseclient.annotations import to_submission_status_annotations, from_submission_status_annotations
 from synapseclient.activity import Activity
 from synapseclient.entity import Entity, File, Project, Folder, split_entity_namespaces, is_versionable, is_container
-from synapseclient.table import Schema, Column, RowSet, Row, TableQueryResult, CsvFileTable
+from synapseclient.table import Schema, Column, RowSet, Row, TableQueryResult, CsvFileTable, csv_parts, as_table_columns
 from synapseclient.dict_object import DictObject
 from synapseclient.evaluation import Evaluation, Submission, SubmissionStatus
 from synapseclient.wiki import Wiki, WikiAttachment
 from synapseclient.retry import _with_retry
+from synapseclient.bundle_cache import EntityBundleCache
+from synapseclient.metrics import MetricsRegistry, uri_template
+from synapseclient.throttle import Throttle, is_throttled
 
 
 PRODUCTION_ENDPOINTS = {'repoEndpoint':'https://repo-prod.prod.sagebase.org/repo/v1',
@@ -75,6 +82,9 @@ FILE_BUFFER_SIZE = 4*KB
 CHUNK_SIZE = 5*MB
 QUERY_LIMIT = 1000
 CHUNK_UPLOAD_POLL_INTERVAL = 1 # second
+CONNECTION_POOL_SIZE = 10
+MAX_THREADS = 8
+TABLE_PART_SIZE = 100*MB
 ROOT_ENTITY = 'syn4489'
 PUBLIC = 273949  #PrincipalId of public "user"
 AUTHENTICATED_USERS = 273948
@@ -84,7 +94,7 @@ DEBUG_DEFAULT = False
 # Defines the standard retry policy applied to the rest methods
 ## The retry period needs to span a minute because sending
 ## messages is limited to 10 per 60 seconds.
-STANDARD_RETRY_PARAMS = {"retry_status_codes": [502,503,504],
+STANDARD_RETRY_PARAMS = {"retry_status_codes": [429,502,503,504],
                          "retry_errors"      : ["proxy error", "slow down", "timeout", "timed out",
                                                 "connection reset by peer", "unknown ssl protocol error",
                                                 "couldn't connect to host", "slowdown", "try again"],
@@ -158,6 +168,18 @@ class Synapse:
     :param skip_checks:           Skip version and endpoint checks
     :param configPath:            Path to config File with setting for Synapse
                                   defaults to ~/.synapseConfig
+    :param requests_session:      A `requests.Session <http://docs.python-requests.org/en/latest/user/advanced/#session-objects>`_
+                                  to send all HTTP traffic through. Defaults to a new session owned by this object.
+    :param pool_size:             Maximum number of persistent connections kept open to each host.
+                                  Defaults to the 'pool_size' option of the [connection] section of the config
+                                  file or 10.
+    :param keep_alive:            Whether connections are reused between requests. Defaults to the 'keep_alive'
+                                  option of the [connection] section of the config file or True.
+    :param rate_limit:            Maximum number of requests per second sent to each endpoint. Defaults to the
+                                  'rate_limit' option of the [connection] section of the config file or no limit.
+    :param max_concurrency:       Maximum number of requests in flight to each endpoint, cut while Synapse is
+                                  throttling the client, see :py:mod:`synapseclient.throttle`. Defaults to the
+                                  'max_concurrency' option of the [connection] section of the config file or pool_size.
 
     Typically, no parameters are needed::
 
@@ -171,16 +193,37 @@ class Synapse:
     """
 
     def __init__(self, repoEndpoint=None, authEndpoint=None, fileHandleEndpoint=None, portalEndpoint=None,
-                 debug=DEBUG_DEFAULT, skip_checks=False, configPath=CONFIG_FILE):
+                 debug=DEBUG_DEFAULT, skip_checks=False, configPath=CONFIG_FILE, requests_session=None,
+                 pool_size=None, keep_alive=None, rate_limit=None, max_concurrency=None):
         # Check for a config file
         self.configPath=configPath
+        max_threads = MAX_THREADS
+        cache_max_size = None
         if os.path.isfile(configPath):
             config = self.getConfigFile(configPath)
             if config.has_option('cache', 'location'):
                 cache.CACHE_DIR = os.path.expanduser(config.get('cache', 'location'))
+            if config.has_option('cache', 'index'):
+                cache.CACHE_INDEX_ENABLED = config.get('cache', 'index').lower() == 'sqlite'
+            if config.has_option('cache', 'md5_cache'):
+                cache.MD5_CACHE_ENABLED = config.getboolean('cache', 'md5_cache')
+            if config.has_option('cache', 'max_size'):
+                cache_max_size = utils.parse_bytes(config.get('cache', 'max_size'))
 
             if config.has_section('debug'):
                 debug = True
+
+            if pool_size is None and config.has_option('connection', 'pool_size'):
+                pool_size = config.getint('connection', 'pool_size')
+            if keep_alive is None and config.has_option('connection', 'keep_alive'):
+                keep_alive = config.getboolean('connection', 'keep_alive')
+            if rate_limit is None and config.has_option('connection', 'rate_limit'):
+                rate_limit = config.getfloat('connection', 'rate_limit')
+            if max_concurrency is None and config.has_option('connection', 'max_concurrency'):
+                max_concurrency = config.getint('connection', 'max_concurrency')
+
+            if config.has_option('transfer', 'max_threads'):
+                max_threads = config.getint('transfer', 'max_threads')
         elif debug:
             # Alert the user if no config is found
             sys.stderr.write("Could not find a config file (%s).  Using defaults." % os.path.abspath(configPath))
@@ -192,6 +235,13 @@ class Synapse:
             if exception.errno != os.errno.EEXIST:
                 raise
 
+        # All HTTP traffic goes through a single session, so that connections
+        # (and their TCP and SSL handshakes) are reused between calls
+        self.pool_size = CONNECTION_POOL_SIZE if pool_size is None else pool_size
+        self._requests_session = requests_session or requests.Session()
+        if keep_alive is not None and not keep_alive:
+            self._requests_session.headers['Connection'] = 'close'
+
         self.setEndpoints(repoEndpoint, authEndpoint, fileHandleEndpoint, portalEndpoint, skip_checks)
 
         self.default_headers = {'content-type': 'application/json; charset=UTF-8', 'Accept': 'application/json; charset=UTF-8'}
@@ -199,11 +249,28 @@ class Synapse:
         self.apiKey = None
         self.debug = debug
         self.skip_checks = skip_checks
-
-        self.table_query_sleep = 2
-        self.table_query_backoff = 1.1
+        self.max_threads = max_threads
+        self._bundle_cache = None
+        # Set by the 'max_size' option of the [cache] section of the config file, e.g. "max_size = 100GB"
+        self.cache_max_size = cache_max_size
+
+        # How asynchronous jobs are polled, see _waitForAsync
+        self.table_query_sleep = 0.1
+        self.table_query_backoff = 1.5
         self.table_query_max_sleep = 20
         self.table_query_timeout = 60
+        self._async_job_stats = {}
+        self._async_job_stats_lock = threading.Lock()
+
+        # Events describing calls to Synapse, see synapseclient.metrics
+        self._metrics = MetricsRegistry()
+        self._metrics_hooks = []
+
+        # Requests to each endpoint are paced by a Throttle shared by all threads, see synapseclient.throttle
+        self.rate_limit = rate_limit
+        self.max_concurrency = self.pool_size if max_concurrency is None else max_concurrency
+        self._throttles = {}
+        self._throttles_lock = threading.Lock()
 
 
 
@@ -254,7 +321,7 @@ class Synapse:
 
             # Update endpoints if we get redirected
             if not skip_checks:
-                response = requests.get(endpoints[point], allow_redirects=False, headers=synapseclient.USER_AGENT)
+                response = self._requests_session.get(endpoints[point], allow_redirects=False, headers=synapseclient.USER_AGENT)
                 if response.status_code == 301:
                     endpoints[point] = response.headers['location']
 
@@ -263,6 +330,23 @@ class Synapse:
         self.fileHandleEndpoint = endpoints['fileHandleEndpoint']
         self.portalEndpoint     = endpoints['portalEndpoint']
 
+        self._mount_connection_pools()
+
+
+    def _mount_connection_pools(self):
+        """
+        Gives each of the repo, auth and file handle services its own pool of
+        persistent connections, so that heavy traffic to one service can't starve
+        the others. Everything else, for example signed S3 URLs, shares a default pool.
+        """
+
+        for prefix in ['https://', 'http://']:
+            self._requests_session.mount(prefix, requests.adapters.HTTPAdapter(
+                pool_connections=CONNECTION_POOL_SIZE, pool_maxsize=self.pool_size))
+        for endpoint in set([self.repoEndpoint, self.authEndpoint, self.fileHandleEndpoint]):
+            self._requests_session.mount(endpoint, requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size))
+
 
     def login(self, email=None, password=None, apiKey=None, sessionToken=None, rememberMe=False, silent=False):
         """
@@ -649,6 +733,56 @@ class Synapse:
         return self._getWithEntityBundle(entityBundle=bundle, entity=entity, **kwargs)
 
 
+    def getMany(self, entities, max_workers=None, **kwargs):
+        """
+        Gets many Synapse entities, fetching several of them at once over pooled connections.
+
+        :param entities:    Synapse IDs, Entity objects or anything else accepted by :py:func:`get`
+        :param max_workers: How many entities to fetch concurrently. Defaults to self.max_threads.
+        :param kwargs:      Passed on to :py:func:`get` for each entity, for example downloadFile,
+                            downloadLocation or ifcollision
+
+        :returns: A generator of Entity objects in the same order as the given entities.
+                  Each distinct entity is only fetched once, so an entity that is listed
+                  more than once is returned as the same object each time.
+
+        Example::
+
+            for entity in syn.getMany(['syn1906479', 'syn1906480'], downloadFile=False):
+                print entity.id, entity.name
+        """
+        if max_workers is None:
+            max_workers = self.max_threads
+
+        def key_of(entity):
+            return entity if isinstance(entity, basestring) else id_of(entity)
+
+        entities = list(entities)
+        remaining = collections.Counter(key_of(entity) for entity in entities)
+        unique = collections.OrderedDict()
+        for entity in entities:
+            unique.setdefault(key_of(entity), entity)
+        if not unique:
+            return
+
+        pool = ThreadPool(max(1, min(max_workers, len(unique))))
+        try:
+            # imap hands back results in the order requested while later ones are still being fetched
+            fetched = pool.imap(lambda entity: self.get(entity, **kwargs), unique.values())
+            results = {}
+            for entity in entities:
+                key = key_of(entity)
+                if key not in results:
+                    results[key] = next(fetched)
+                result = results[key]
+                remaining[key] -= 1
+                if remaining[key] == 0:
+                    del results[key]
+                yield result
+        finally:
+            pool.terminate()
+
+
     def __getFromFile(self, filepath, limitSearch=None):
         """
         Gets a Synapse entityBundle based on the md5 of a local file
@@ -657,7 +791,7 @@ class Synapse:
         :param filepath: path to local file
         :param limitSearch:   Limits the places in Synapse where the file is searched for.
         """
-        results = self.restGET('/entity/md5/%s' %utils.md5_for_file(filepath).hexdigest())['results']
+        results = self.restGET('/entity/md5/%s' %cache.md5_for_file(filepath))['results']
         if limitSearch is not None:
             #Go through and find the path of every entity found
             paths = [self.restGET('/entity/%s/path' %ent['id']) for ent in results]
@@ -784,6 +918,10 @@ class Synapse:
                 cache.add_local_file_to_cache(path=entity['path'], **entity)
             elif downloadPath is not None:
                 cache.add_local_file_to_cache(path=downloadPath, **entity)
+
+            # Make room for the new download by evicting the least recently used files
+            if downloadFile and self.cache_max_size is not None:
+                cache.purge_cache(max_size=self.cache_max_size, keep=[entity.get('path', None) or downloadPath])
         return entity
 
 
@@ -836,6 +974,16 @@ class Synapse:
             test_entity = syn.store(test_entity, activity=activity)
 
         """
+        return self._store(obj, kwargs)
+
+
+    def _store(self, obj, kwargs, saveActivity=None):
+        """
+        Stores an object as :py:func:`store` does, given its keyword arguments as a dictionary.
+
+        :param saveActivity: Function saving the Activity and returning it with its ID, once the
+                             Entity has been stored.  Defaults to :py:func:`_saveActivity`.
+        """
         createOrUpdate = kwargs.get('createOrUpdate', True)
         forceVersion = kwargs.get('forceVersion', True)
         versionLabel = kwargs.get('versionLabel', None)
@@ -940,12 +1088,84 @@ class Synapse:
         if isRestricted:
             self._createAccessRequirementIfNone(properties)
 
-        # Update annotations
+        # Update annotations, whose response carries the Entity's new etag
         annotations['etag'] = properties['etag']
         annotations = self.setAnnotations(properties, annotations)
         properties['etag'] = annotations['etag']
 
         # If the parameters 'used' or 'executed' are given, create an Activity object
+        activity = self._activityFromStoreArguments(kwargs)
+
+        # If we have an Activity, set it as the Entity's provenance record
+        if activity:
+            activity = self._linkProvenance(properties, (saveActivity or self._saveActivity)(activity))
+
+            # Setting the provenance changes the etag without returning it, so get the new Entity.
+            # Without provenance, the etag from the annotations is current and nothing is fetched.
+            properties = self._getEntity(properties)
+
+        # Return the updated Entity object
+        return Entity.create(properties, annotations, local_state)
+
+
+    def storeMany(self, objs, max_workers=None, **kwargs):
+        """
+        Stores many Entities, several at a time.  Uploads and metadata requests for
+        different Entities run concurrently over pooled connections.
+
+        :param objs:        Entities to store
+        :param max_workers: How many Entities to store concurrently. Defaults to self.max_threads.
+        :param kwargs:      Passed on to :py:func:`store` for each Entity.  Provenance given
+                            as *activity* or *used* and *executed* is saved as a single Activity,
+                            once the first Entity has been stored, and shared by all of the Entities.
+
+        :returns: A list in the same order as objs, holding either the stored Entity or
+                  the exception raised while storing it.  One failure does not stop the others.
+
+        Example::
+
+            files = [File(path, parent=project) for path in paths]
+            results = syn.storeMany(files, used='syn1906480', executed='syn1917825')
+            failures = [(f, r) for f, r in zip(files, results) if isinstance(r, Exception)]
+        """
+        if max_workers is None:
+            max_workers = self.max_threads
+        objs = list(objs)
+        if not objs:
+            return []
+
+        activity = self._activityFromStoreArguments(kwargs)
+        if activity:
+            kwargs = dict(kwargs, activity=activity)
+            for key in ['used', 'executed', 'activityName', 'activityDescription']:
+                kwargs.pop(key, None)
+
+        lock = threading.Lock()
+        savedActivity = []
+        def save_activity_once(activity):
+            with lock:
+                if not savedActivity:
+                    savedActivity.append(self._saveActivity(activity))
+                return savedActivity[0]
+
+        def store_one(obj):
+            try:
+                if activity:
+                    return self._store(obj, kwargs, save_activity_once)
+                return self.store(obj, **kwargs)
+            except Exception as ex:
+                return ex
+
+        pool = ThreadPool(max(1, min(max_workers, len(objs))))
+        try:
+            return pool.map(store_one, objs)
+        finally:
+            pool.terminate()
+
+
+    def _activityFromStoreArguments(self, kwargs):
+        """Returns the Activity given to :py:func:`store` as *activity* or as *used* and *executed* items."""
+
         activity = kwargs.get('activity', None)
         used = kwargs.get('used', None)
         executed = kwargs.get('executed', None)
@@ -956,16 +1176,7 @@ class Synapse:
             activityName = kwargs.get('activityName', None)
             activityDescription = kwargs.get('activityDescription', None)
             activity = Activity(name=activityName, description=activityDescription, used=used, executed=executed)
-
-        # If we have an Activity, set it as the Entity's provenance record
-        if activity:
-            activity = self.setProvenance(properties, activity)
-
-            # 'etag' has changed, so get the new Entity
-            properties = self._getEntity(properties)
-
-        # Return the updated Entity object
-        return Entity.create(properties, annotations, local_state)
+        return activity
 
 
     def _createAccessRequirementIfNone(self, entity):
@@ -1023,9 +1234,120 @@ class Synapse:
             uri = '/entity/%s/version/%d/bundle?mask=%d' %(id_of(entity), version, bitFlags)
         else:
             uri = '/entity/%s/bundle?mask=%d' %(id_of(entity), bitFlags)
-        bundle = self.restGET(uri)
 
-        return bundle
+        if self._bundle_cache is None:
+            return self.restGET(uri)
+        return self._bundle_cache.get((id_of(entity), version, bitFlags),
+                                      fetch=lambda: self.restGET(uri),
+                                      fetch_etag=lambda: self._getEntity(entity, version).get('etag', None))
+
+
+    def enableEntityBundleCache(self, max_entries=1000, ttl=300, revalidate=False):
+        """
+        Keeps the entity bundles fetched by :py:func:`get` and :py:func:`store` in memory,
+        so that repeatedly getting the same Entities does not go back to Synapse each time.
+        Bundles are forgotten when the Entity is stored, deleted or annotated through this object,
+        but changes made elsewhere go unnoticed until the bundle expires.
+
+        :param max_entries: How many bundles to keep, dropping the least recently used ones first
+        :param ttl:         How many seconds a bundle is used for before it expires
+        :param revalidate:  Rather than fetching expired bundles again, check whether the
+                            Entity's etag has changed, which is a cheaper request
+
+        See :py:func:`entityBundleCacheStats`.
+        """
+        self._bundle_cache = EntityBundleCache(max_entries=max_entries, ttl=ttl, revalidate=revalidate)
+
+
+    def disableEntityBundleCache(self):
+        """Stops caching entity bundles and forgets the ones cached."""
+        self._bundle_cache = None
+
+
+    def entityBundleCacheStats(self):
+        """
+        Returns a dictionary with counts of 'hits', 'misses', 'revalidations' and 'evictions'
+        of the entity bundle cache, the number of bundles it holds as 'size' and its 'hit_rate',
+        or None if the cache is not enabled.
+        """
+        return None if self._bundle_cache is None else self._bundle_cache.stats()
+
+
+    def _invalidateEntityBundle(self, entity):
+        """
+        Drops the cached bundles of an Entity that is being changed.
+
+        Writers call this both before and after the change: before, so that no stale bundle is
+        served while the request is in flight, and after, so that a bundle fetched by another
+        thread during the request is not kept.
+        """
+        if self._bundle_cache is not None:
+            try:
+                self._bundle_cache.invalidate(id_of(entity))
+            except ValueError:
+                pass
+
+
+    def addMetricsHook(self, hook):
+        """
+        Registers a function to be called with an event describing each call to Synapse,
+        asynchronous job and transfer.  See :py:mod:`synapseclient.metrics` for the contents
+        of the events.  Hooks are called on the thread making the call, so should be quick.
+        """
+        self._metrics_hooks.append(hook)
+
+
+    def removeMetricsHook(self, hook):
+        """Unregisters a function registered by :py:func:`addMetricsHook`."""
+        self._metrics_hooks.remove(hook)
+
+
+    def metrics(self, reset=False):
+        """
+        Returns a snapshot of the counts, errors, retries, bytes and latency percentiles of the
+        calls made by this Synapse object, keyed by operation, e.g. 'GET /entity/{id}/bundle'.
+        See :py:func:`synapseclient.metrics.MetricsRegistry.snapshot`.
+
+        :param reset: Whether to start counting afresh
+        """
+        return self._metrics.snapshot(reset)
+
+
+    def _throttle(self, endpoint):
+        """Returns the :py:class:`synapseclient.throttle.Throttle` of the endpoint."""
+        with self._throttles_lock:
+            throttle = self._throttles.get(endpoint)
+            if throttle is None:
+                throttle = self._throttles[endpoint] = Throttle(rate=self.rate_limit, max_concurrency=self.max_concurrency)
+            return throttle
+
+
+    def throttleStats(self):
+        """
+        Returns a dictionary keyed by endpoint of the counts of requests sent and throttled by
+        Synapse, the seconds spent waiting to send them, and the current concurrency limit and
+        requests in flight.  See :py:mod:`synapseclient.throttle`.
+        """
+        with self._throttles_lock:
+            return dict((endpoint, throttle.stats()) for endpoint, throttle in self._throttles.items())
+
+
+    def _emitMetric(self, kind, method, uri, endpoint=None, status=None, bytes_sent=None, bytes_received=None,
+                    latency=None, retries=0, error=None, timestamp=None, template=None):
+        event = {'kind': kind, 'method': method, 'uri': uri,
+                 'uri_template': template or uri_template(uri, endpoint),
+                 'endpoint': endpoint, 'status': status,
+                 'bytes_sent': bytes_sent, 'bytes_received': bytes_received,
+                 'latency': latency, 'retries': retries,
+                 'error': error.__class__.__name__ if isinstance(error, BaseException) else error,
+                 'timestamp': timestamp}
+        self._metrics.record(event)
+        for hook in list(self._metrics_hooks):
+            try:
+                hook(event)
+            except Exception as ex:
+                warnings.warn('Metrics hook %r failed: %s' % (hook, ex))
+
 
     def delete(self, obj):
         """
@@ -1035,64 +1357,137 @@ class Synapse:
                     such as Evaluation, File, Project, WikiPage etc
         """
 
-        # Handle all strings as the Entity ID for backward compatibility
-        if isinstance(obj, basestring):
-            self.restDELETE(uri='/entity/%s' % id_of(obj))
-        elif hasattr(obj, "_synapse_delete"):
-            return obj._synapse_delete(self)
-        else:
-            try:
-                self.restDELETE(obj.deleteURI())
-            except AttributeError as ex1:
-                SynapseError("Can't delete a %s" % type(obj))
+        isEntity = isinstance(obj, Entity) or isinstance(obj, basestring)
+        if isEntity:
+            self._invalidateEntityBundle(obj)
+        try:
+            # Handle all strings as the Entity ID for backward compatibility
+            if isinstance(obj, basestring):
+                self.restDELETE(uri='/entity/%s' % id_of(obj))
+            elif hasattr(obj, "_synapse_delete"):
+                return obj._synapse_delete(self)
+            else:
+                try:
+                    self.restDELETE(obj.deleteURI())
+                except AttributeError as ex1:
+                    SynapseError("Can't delete a %s" % type(obj))
+        finally:
+            # Invalidate again, in case a bundle was fetched while the delete was in flight
+            if isEntity:
+                self._invalidateEntityBundle(obj)
 
     _user_name_cache = {}
+    _user_name_cache_lock = threading.Lock()
     def _get_user_name(self, user_id):
-        if user_id not in self._user_name_cache:
-            self._user_name_cache[user_id] = utils.extract_user_name(self.getUserProfile(user_id))
-        return self._user_name_cache[user_id]
+        return self._get_user_names([user_id])[str(user_id)]
+
+
+    def _get_user_names(self, principalIds):
+        """
+        Returns a dictionary of display names keyed by principal ID (as a string).  Names are
+        looked up in memory, then in the persistent :py:class:`synapseclient.cache.UserNameCache`,
+        then fetched from Synapse a hundred at a time.  Both caches are keyed by repoEndpoint.
+        """
+
+        principalIds = set(str(principalId) for principalId in principalIds)
+        with self._user_name_cache_lock:
+            names = dict((principalId, self._user_name_cache[(self.repoEndpoint, principalId)])
+                         for principalId in principalIds
+                         if (self.repoEndpoint, principalId) in self._user_name_cache)
+        missing = sorted(principalIds - set(names))
+        if not missing:
+            return names
+
+        try:
+            userNameCache = cache.get_user_name_cache()
+            found = userNameCache.get_many(missing, self.repoEndpoint)
+        except (sqlite3.Error, EnvironmentError) as ex:
+            warnings.warn('Could not read the user name cache: %s' % ex)
+            userNameCache, found = None, {}
+        missing = [principalId for principalId in missing if principalId not in found]
+
+        fetched = {}
+        for i in range(0, len(missing), 100):
+            batch = missing[i:i+100]
+            headers = self.restGET('/userGroupHeaders/batch?ids=%s' % ','.join(batch))['children']
+            fetched.update((str(header['ownerId']), utils.extract_user_name(header)) for header in headers)
+            ## Principals without a header, if any, are looked up one by one
+            for principalId in batch:
+                if principalId not in fetched:
+                    fetched[principalId] = utils.extract_user_name(self.getUserProfile(principalId))
+        if fetched and userNameCache is not None:
+            try:
+                userNameCache.put_many(fetched, self.repoEndpoint)
+            except (sqlite3.Error, EnvironmentError) as ex:
+                warnings.warn('Could not update the user name cache: %s' % ex)
+
+        found.update(fetched)
+        with self._user_name_cache_lock:
+            self._user_name_cache.update(((self.repoEndpoint, principalId), name)
+                                         for principalId, name in found.items())
+        names.update(found)
+        return names
 
 
-    def _list(self, parent, recursive=False, long_format=False, show_modified=False, indent=0, out=sys.stdout):
+    def _list(self, parent, recursive=False, long_format=False, show_modified=False, indent=0, out=sys.stdout, max_threads=None):
         """
         List child objects of the given parent, recursively if requested.
+
+        The children of containers are queried, and the names of the users who created and
+        modified them looked up, by a pool of max_threads threads, defaulting to self.max_threads,
+        while the listing is written out depth first.
         """
         fields = ['id', 'name', 'nodeType']
         if long_format:
             fields.extend(['createdByPrincipalId','createdOn','versionNumber'])
         if show_modified:
             fields.extend(['modifiedByPrincipalId', 'modifiedOn'])
-        query = 'select ' + ','.join(fields) + \
-                ' from entity where %s=="%s"' % ('id' if indent==0 else 'parentId', id_of(parent))
-        results = self.chunkedQuery(query)
-
-        results_found = False
-        for result in results:
-            results_found = True
-
-            fmt_fields = {'name' : result['entity.name'],
-                          'id' : result['entity.id'],
-                          'padding' : ' ' * indent,
-                          'slash_or_not' : '/' if is_container(result) else ''}
-            fmt_string = "{id}"
-
-            if long_format:
-                fmt_fields['createdOn'] = utils.from_unix_epoch_time(result['entity.createdOn']).strftime("%Y-%m-%d %H:%M")
-                fmt_fields['createdBy'] = self._get_user_name(result['entity.createdByPrincipalId'])[:18]
-                fmt_fields['version']   = result['entity.versionNumber']
-                fmt_string += " {version:3}  {createdBy:>18} {createdOn}"
-            if show_modified:
-                fmt_fields['modifiedOn'] = utils.from_unix_epoch_time(result['entity.modifiedOn']).strftime("%Y-%m-%d %H:%M")
-                fmt_fields['modifiedBy'] = self._get_user_name(result['entity.modifiedByPrincipalId'])[:18]
-                fmt_string += "  {modifiedBy:>18} {modifiedOn}"
-
-            fmt_string += "  {padding}{name}{slash_or_not}\n"
-            out.write(fmt_string.format(**fmt_fields))
-
-            if (indent==0 or recursive) and is_container(result):
-                self._list(result['entity.id'], recursive=recursive, long_format=long_format, show_modified=show_modified, indent=indent+2, out=out)
-
-        if indent==0 and not results_found:
+
+        def query(id, byParent):
+            results = list(self.chunkedQuery('select ' + ','.join(fields) + \
+                                             ' from entity where %s=="%s"' % ('parentId' if byParent else 'id', id)))
+            principalIds = [result[field] for result in results for field in
+                            ('entity.createdByPrincipalId', 'entity.modifiedByPrincipalId') if field in result]
+            return results, self._get_user_names(principalIds) if principalIds else {}
+
+        def write(listing, indent):
+            results, userNames = listing
+            ## Query the children of containers in the background, so sibling
+            ## containers are listed at once while this one is written out
+            children = [pool.apply_async(query, (result['entity.id'], True))
+                        if (indent==0 or recursive) and is_container(result) else None
+                        for result in results]
+            for result, childListing in zip(results, children):
+                fmt_fields = {'name' : result['entity.name'],
+                              'id' : result['entity.id'],
+                              'padding' : ' ' * indent,
+                              'slash_or_not' : '/' if is_container(result) else ''}
+                fmt_string = "{id}"
+
+                if long_format:
+                    fmt_fields['createdOn'] = utils.from_unix_epoch_time(result['entity.createdOn']).strftime("%Y-%m-%d %H:%M")
+                    fmt_fields['createdBy'] = userNames[str(result['entity.createdByPrincipalId'])][:18]
+                    fmt_fields['version']   = result['entity.versionNumber']
+                    fmt_string += " {version:3}  {createdBy:>18} {createdOn}"
+                if show_modified:
+                    fmt_fields['modifiedOn'] = utils.from_unix_epoch_time(result['entity.modifiedOn']).strftime("%Y-%m-%d %H:%M")
+                    fmt_fields['modifiedBy'] = userNames[str(result['entity.modifiedByPrincipalId'])][:18]
+                    fmt_string += "  {modifiedBy:>18} {modifiedOn}"
+
+                fmt_string += "  {padding}{name}{slash_or_not}\n"
+                out.write(fmt_string.format(**fmt_fields))
+
+                if childListing is not None:
+                    write(childListing.get(), indent+2)
+
+        pool = ThreadPool(max_threads or self.max_threads)
+        try:
+            listing = query(id_of(parent), indent!=0)
+            write(listing, indent)
+        finally:
+            pool.terminate()
+
+        if indent==0 and not listing[0]:
             out.write('No results visible to {username} found for id {id}\n'.format(username=self.username, id=id_of(parent)))
 
 
@@ -1229,7 +1624,11 @@ class Synapse:
         if 'etag' in entity and 'etag' not in synapseAnnos:
             synapseAnnos['etag'] = entity['etag']
 
-        return from_synapse_annotations(self.restPUT(uri, body=json.dumps(synapseAnnos)))
+        self._invalidateEntityBundle(entity)
+        try:
+            return from_synapse_annotations(self.restPUT(uri, body=json.dumps(synapseAnnos)))
+        finally:
+            self._invalidateEntityBundle(entity)
 
 
 
@@ -1255,12 +1654,16 @@ class Synapse:
         return self.restGET('/query?query=' + urllib.quote(queryStr))
 
 
-    def chunkedQuery(self, queryStr):
+    def chunkedQuery(self, queryStr, max_threads=1):
         """
         Query for Synapse Entities.
         More robust than :py:func:`synapseclient.Synapse.query`.
         See the `query language documentation <https://sagebionetworks.jira.com/wiki/display/PLFM/Repository+Service+API#RepositoryServiceAPI-QueryAPI>`_.
 
+        :param max_threads: How many pages to fetch at once.  With more than one, the pages after
+                            the first are fetched concurrently, once the first has told how many
+                            results there are.  Results are yielded in order either way.
+
         :returns: An iterator that will break up large queries into managable pieces.
 
         Example::
@@ -1299,6 +1702,10 @@ class Synapse:
         # Continue querying until the entire query has been fetched (or crash out)
         limit = options['limit'] if options['limit'] < QUERY_LIMIT else QUERY_LIMIT
         offset = options['offset']
+        if max_threads > 1:
+            for res in self._parallelQuery(queryStr, offset, options['offset'] + options['limit'], limit, max_threads):
+                yield res
+            return
         while True:
             remaining = options['limit'] + options['offset'] - offset
 
@@ -1346,6 +1753,60 @@ class Synapse:
                     raise
 
 
+    def _queryPage(self, queryStr, offset, limit):
+        """
+        Fetches the results of a query from offset up to offset + limit, splitting the page in
+        two whenever its results exceed the maximum size of a response.
+
+        :returns: A tuple of the results and the total number of results of the query, if known
+        """
+
+        subqueryStr = "%s limit %d offset %d" % (queryStr, limit, offset)
+        try:
+            response = self.restGET('/query?query=' + urllib.quote(subqueryStr))
+            return response['results'], response.get('totalNumberOfResults', None)
+        except SynapseHTTPError as err:
+            ## TODO: Change the error check when PLFM-1990 is resolved
+            if err.response.status_code == 400 and ('The results of this query exceeded the max' in err.response.json()['reason']):
+                if limit == 1:
+                    sys.stderr.write("A single row (offset %s) of this query "
+                                     "exceeds the maximum size.  Consider "
+                                     "limiting the columns returned "
+                                     "in the select clause.  Skipping...\n" % offset)
+                    return [], None
+                half = limit / 2
+                first, total = self._queryPage(queryStr, offset, half)
+                second, _ = self._queryPage(queryStr, offset + half, limit - half)
+                return first + second, total
+            raise
+
+
+    def _parallelQuery(self, queryStr, offset, end, limit, max_threads):
+        """
+        Yields the results of a query from offset up to, but not including, end.  The first page
+        gives the total number of results, after which the remaining pages are fetched by a pool
+        of threads, no more than two pages per thread ahead of the results yielded so far.
+        """
+
+        results, total = self._queryPage(queryStr, offset, min(limit, end - offset))
+        for res in results:
+            yield res
+        if total is not None:
+            ## Offsets start at 1
+            end = min(end, total + 1)
+        elif len(results) < limit:
+            return
+        offsets = xrange(offset + limit, end, limit) if end != float('inf') else itertools.count(offset + limit, limit)
+
+        fetch = lambda start: self._queryPage(queryStr, start, min(limit, end - start))[0]
+        for results in utils.imap_ordered(fetch, offsets, max_threads):
+            for res in results:
+                yield res
+            ## Without a total, stop at the first page to come back short
+            if total is None and len(results) < limit:
+                break
+
+
     def md5Query(self, md5):
         """
         Find the Entities with attached file(s) with the given MD5 hash.
@@ -1564,21 +2025,33 @@ class Synapse:
         :returns: An updated :py:class:`synapseclient.activity.Activity` object
         """
 
-        # Assert that the entity was generated by a given Activity.
-        if 'id' in activity:
-            # We're updating provenance
-            uri = '/activity/%s' % activity['id']
-            activity = Activity(data=self.restPUT(uri, json.dumps(activity)))
-        else:
-            activity = self.restPOST('/activity', body=json.dumps(activity))
+        return self._linkProvenance(entity, self._saveActivity(activity))
+
+
+    def _linkProvenance(self, entity, activity):
+        """Records that the entity was generated by an Activity that has been saved."""
 
         # assert that an entity is generated by an activity
         uri = '/entity/%s/generatedBy?generatedBy=%s' % (id_of(entity), activity['id'])
-        activity = Activity(data=self.restPUT(uri))
+        self._invalidateEntityBundle(entity)
+        try:
+            activity = Activity(data=self.restPUT(uri))
+        finally:
+            self._invalidateEntityBundle(entity)
 
         return activity
 
 
+    def _saveActivity(self, activity):
+        """Creates the Activity in Synapse, or updates it if it already has an ID."""
+
+        if 'id' in activity:
+            # We're updating provenance
+            uri = '/activity/%s' % activity['id']
+            return Activity(data=self.restPUT(uri, json.dumps(activity)))
+        return self.restPOST('/activity', body=json.dumps(activity))
+
+
     def deleteProvenance(self, entity):
         """
         Removes provenance information from an Entity
@@ -1591,7 +2064,11 @@ class Synapse:
         if not activity: return
 
         uri = '/entity/%s/generatedBy' % id_of(entity)
-        self.restDELETE(uri)
+        self._invalidateEntityBundle(entity)
+        try:
+            self.restDELETE(uri)
+        finally:
+            self._invalidateEntityBundle(entity)
 
         ## TODO: what happens if the activity is shared by more than one entity?
         uri = '/activity/%s' % activity['id']
@@ -1635,15 +2112,28 @@ class Synapse:
         except OSError as exception:
             if exception.errno != os.errno.EEXIST:
                 raise
-        return self._downloadFile(url, destination)
+        return self._downloadFile(url, destination, expected_md5=entity.get('md5', None))
 
 
-    def _downloadFile(self, url, destination):
+    def _downloadFile(self, url, destination, expected_md5=None, max_threads=None):
         """
         Download a file from a URL to a the given file path.
 
+        Large files from hosts that accept byte ranges, such as S3, are fetched
+        in parts over several connections. Completed parts are recorded in a
+        '.partial' file next to the destination, so an interrupted download
+        picks up where it left off.
+
+        :param expected_md5: If given, the downloaded file must have this MD5
+        :param max_threads:  How many parts to download concurrently. Defaults to
+                             self.max_threads.
+
         :returns: A file info dictionary with keys path, cacheDir, files
         """
+        if max_threads is None:
+            max_threads = self.max_threads
+        rangeURL = None
+        start = time.time()
         def returnDict(destination):
             """internal function to cut down on code cluter by building return type."""
             return  {'path': destination,
@@ -1653,7 +2143,7 @@ class Synapse:
         #The assumption is wrong - we always try to read either the outer or inner requests.get
         #but sometimes we don't have something to read.  I.e. when the type is ftp at which point
         #we still set the cache and filepath based on destination which is wrong because nothing was fetched
-        response = requests.get(url, headers=self._generateSignedHeaders(url), allow_redirects=False)
+        response = self._requests_session.get(url, headers=self._generateSignedHeaders(url), allow_redirects=False)
         if response.status_code in [301,302,303,307,308]:
             url = response.headers['location']
             scheme = urlparse.urlparse(url).scheme
@@ -1671,7 +2161,8 @@ class Synapse:
                 return returnDict(destination)
             elif scheme == 'http' or scheme == 'https':
                 #TODO add support for username/password
-                response = requests.get(url, headers=self._generateSignedHeaders(url, {}), stream=True)
+                response = self._requests_session.get(url, headers=self._generateSignedHeaders(url, {}), stream=True)
+                rangeURL = url
 
                 ## get filename from content-disposition, if we don't have it already
                 if os.path.isdir(destination):
@@ -1691,17 +2182,95 @@ class Synapse:
                 raise SynapseError("Could not download the file at %s" % url)
             raise
 
-        # Stream the file to disk
-        toBeTransferred = float(response.headers['content-length'])
-        with open(destination, 'wb') as fd:
-            for nChunks, chunk in enumerate(response.iter_content(FILE_BUFFER_SIZE)):
-                fd.write(chunk)
-                utils.printTransferProgress(nChunks*FILE_BUFFER_SIZE ,toBeTransferred, 'Downloading ', os.path.basename(destination))
+        # Keep the file from being purged from the cache while it is written
+        with cache.transfer_in_progress(destination):
+            toBeTransferred = float(response.headers['content-length'])
+            if rangeURL and toBeTransferred > CHUNK_SIZE and response.headers.get('accept-ranges', None) == 'bytes':
+                # Fetch the file in ranges rather than over this one connection
+                response.close()
+                self._downloadFileInRanges(rangeURL, destination, int(toBeTransferred), expected_md5, max_threads)
+            else:
+                # Stream the file to disk
+                with open(destination, 'wb') as fd:
+                    for nChunks, chunk in enumerate(response.iter_content(FILE_BUFFER_SIZE)):
+                        fd.write(chunk)
+                        utils.printTransferProgress(nChunks*FILE_BUFFER_SIZE ,toBeTransferred, 'Downloading ', os.path.basename(destination))
             utils.printTransferProgress(toBeTransferred ,toBeTransferred, 'Downloaded  ', os.path.basename(destination))
+            self._emitMetric('download', 'GET', url, template='{file}', endpoint='%s://%s' % urlparse.urlparse(url)[:2],
+                             status=response.status_code, bytes_received=int(toBeTransferred),
+                             latency=time.time()-start, timestamp=start)
+
+            if expected_md5:
+                actual_md5 = cache.md5_for_file(destination)
+                if actual_md5 != expected_md5:
+                    os.remove(destination)
+                    raise SynapseMd5MismatchError("Downloaded file %s's md5 %s does not match expected MD5 of %s"
+                                                  % (destination, actual_md5, expected_md5))
         destination = os.path.abspath(destination)
         return returnDict(destination)
 
 
+    def _downloadFileInRanges(self, url, destination, fileSize, expected_md5, max_threads):
+        """
+        Downloads a file in parts of CHUNK_SIZE bytes using HTTP range requests,
+        writing each part into its place in a preallocated file.
+        See :py:func:`synapseclient.cache.read_partial_download`.
+        """
+        partSize = CHUNK_SIZE
+        record = {'size': fileSize, 'partSize': partSize, 'md5': expected_md5}
+        # Without an MD5 there is no telling whether the parts on disk belong to this version of the file
+        completedParts = cache.read_partial_download(destination, record) if expected_md5 else None
+        if completedParts is None:
+            completedParts = []
+            with open(destination, 'wb') as fd:
+                fd.truncate(fileSize)
+            cache.write_partial_download(destination, record, completedParts)
+
+        retry_policy = self._build_retry_policy({
+            "retry_status_codes": [429,500,502,503,504],
+            "retry_exceptions"  : ['ConnectionError', 'ChunkedEncodingError', 'Timeout', 'timeout'],
+            "retries"           : 6})
+
+        def get_range(start, end):
+            response = self._requests_session.get(url, headers={'Range': 'bytes=%d-%d' % (start, end)})
+            exceptions._raise_for_status(response, verbose=self.debug)
+            return response
+
+        # Parts finish in any order, so progress and the sidecar are updated under a lock
+        lock = threading.Lock()
+        downloaded = {'bytes': sum(min(partSize, fileSize-i*partSize) for i in completedParts)}
+
+        def download_part(i):
+            start = i*partSize
+            end = min(start+partSize, fileSize) - 1
+            response = _with_retry(lambda: get_range(start, end), verbose=self.debug, **retry_policy)
+            if response.status_code != 206 or len(response.content) != end-start+1:
+                raise SynapseError('Expected bytes %d-%d of %s but got a %d response of %d bytes'
+                                   % (start, end, destination, response.status_code, len(response.content)))
+            with open(destination, 'r+b') as fd:
+                fd.seek(start)
+                fd.write(response.content)
+            with lock:
+                completedParts.append(i)
+                cache.write_partial_download(destination, record, completedParts)
+                downloaded['bytes'] += end-start+1
+                utils.printTransferProgress(downloaded['bytes'], fileSize, 'Downloading ', os.path.basename(destination))
+
+        nParts = (fileSize + partSize - 1) // partSize
+        done = set(completedParts)
+        remainingParts = [i for i in range(nParts) if i not in done]
+        if max_threads > 1 and len(remainingParts) > 1:
+            pool = ThreadPool(min(max_threads, len(remainingParts)))
+            try:
+                pool.map(download_part, remainingParts)
+            finally:
+                pool.terminate()
+        else:
+            map(download_part, remainingParts)
+
+        cache.remove_partial_download(destination)
+
+
     def _uploadToFileHandleService(self, filename, synapseStore=True, mimetype=None):
         """
         Create and return a fileHandle, by either uploading a local file or
@@ -1761,14 +2330,17 @@ class Synapse:
         return fileHandle
 
 
-    def _createChunkedFileUploadToken(self, filepath, mimetype):
+    def _createChunkedFileUploadToken(self, filepath, mimetype, md5=None):
         """
         This is the first step in uploading a large file. The resulting
         ChunkedFileToken will be required for all remaining chunk file requests.
 
+        :param md5: The hexadecimal MD5 of the file, if already known
+
         :returns: a `ChunkedFileToken <http://rest.synapse.org/org/sagebionetworks/repo/model/file/ChunkedFileToken.html>`_
         """
-        md5 = utils.md5_for_file(filepath).hexdigest()
+        if md5 is None:
+            md5 = cache.md5_for_file(filepath)
         fileName = utils.guess_file_name(filepath)
         return self._createChunkedUploadToken(md5, fileName, mimetype)
 
@@ -1823,7 +2395,7 @@ class Synapse:
         # Get the signed S3 URL
         url = self._createChunkedFileUploadChunkURL(i, token)
         chunk_record['url'] = url
-        response = requests.put(url, data=chunk, headers=headers)
+        response = self._requests_session.put(url, data=chunk, headers=headers)
         # Is requests closing response stream? Let's make sure:
         # "Note that connections are only released back to
         #  the pool for reuse once all body data has been
@@ -1838,21 +2410,28 @@ class Synapse:
         return response
 
 
-    def _chunkedUploadFile(self, filepath, chunksize=CHUNK_SIZE, progress=True, mimetype=None):
+    def _chunkedUploadFile(self, filepath, chunksize=CHUNK_SIZE, progress=True, mimetype=None, max_threads=None, resume=True):
         """
         Upload a file to be stored in Synapse, dividing large files into chunks.
 
         :param filepath: The file to be uploaded
         :param chunksize: Chop the file into chunks of this many bytes.
                           The default value is 5MB, which is also the minimum value.
+        :param max_threads: How many chunks to upload concurrently. Defaults to
+                            self.max_threads, which can be set by the 'max_threads'
+                            option of the [transfer] section of the config file.
+        :param resume:    Record the progress of the upload in a journal in the
+                          cache directory, so that an interrupted upload of the
+                          same, unmodified file picks up where it left off.
 
         :returns: An `S3 FileHandle <http://rest.synapse.org/org/sagebionetworks/repo/model/file/S3FileHandle.html>`_
         """
-        from functools import partial
         if chunksize < 5*MB:
             raise ValueError('Minimum chunksize is 5 MB.')
         if filepath is None or not os.path.exists(filepath):
             raise ValueError('File not found: ' + str(filepath))
+        if max_threads is None:
+            max_threads = self.max_threads
 
         # Start timing
         diagnostics = {'start-time': time.time()}
@@ -1877,9 +2456,29 @@ class Synapse:
         headers.update(synapseclient.USER_AGENT)
         diagnostics['User-Agent'] = synapseclient.USER_AGENT
 
+        reader = None
+        journalPath = None
         try:
-            # Get token
-            token = self._createChunkedFileUploadToken(filepath, mimetype)
+            # The token needs the MD5 of the whole file, so it is looked up or hashed before any chunk is read
+            fileSize = os.stat(filepath).st_size
+            fileModified = os.path.getmtime(filepath)
+            md5 = cache.md5_for_file(filepath)
+
+            # Pick up an interrupted upload of the same file from its journal
+            # or else get a new token
+            fingerprint = {'size': fileSize, 'mtime': fileModified, 'md5': md5}
+            journal = None
+            if resume:
+                journalPath = cache.upload_journal_path(filepath, chunksize, mimetype)
+                journal = cache.read_upload_journal(journalPath, fingerprint)
+            if journal:
+                diagnostics['resumed-chunks'] = journal['completedChunks']
+            else:
+                token = self._createChunkedFileUploadToken(filepath, mimetype, md5=md5)
+                journal = {'fingerprint': fingerprint, 'token': token, 'completedChunks': []}
+                if journalPath:
+                    cache.write_upload_journal(journalPath, journal)
+            token = journal['token']
             diagnostics['token'] = token
 
             retry_policy=self._build_retry_policy({
@@ -1898,22 +2497,85 @@ class Synapse:
                 ## RequestTimeout comes from S3 during put operations
 
             diagnostics['chunks'] = []
-            fileSize = os.stat(filepath).st_size
-            for i in range(1, nchunks(filepath, chunksize=chunksize)+1):
-                chunk = get_chunk(filepath, i, chunksize=chunksize)
+            reader = utils.ChunkReader(filepath, chunksize=chunksize)
+
+            # Chunks may finish in any order, so progress, diagnostics and the
+            # journal are updated under a lock
+            lock = threading.Lock()
+            uploaded = {'bytes': 0}
+
+            def upload_chunk(i):
+                chunk = reader.read(i)
                 chunk_record = {'chunk-number':i}
 
                 # PUT the chunk to S3
-                put_chunk = partial(self.__put_chunk_to_S3, i, chunk, token, headers, chunk_record)
-                response = _with_retry(put_chunk, verbose=True, **retry_policy)
-                utils.printTransferProgress((i-1)*chunksize, fileSize, prefix = 'Uploading', postfix=filepath)
+                attempts = [0]
+                def put_chunk():
+                    attempts[0] += 1
+                    return self.__put_chunk_to_S3(i, chunk, token, headers, chunk_record)
+                start = time.time()
+                response, error = None, None
+                try:
+                    response = _with_retry(put_chunk, verbose=True, **retry_policy)
+                except Exception as ex:
+                    error = ex
+                    response = getattr(ex, 'response', None)
+                    raise
+                finally:
+                    url = chunk_record.get('url', '')
+                    self._emitMetric('upload_chunk', 'PUT', url, template='{chunk}',
+                                     endpoint='%s://%s' % urlparse.urlparse(url)[:2] if url else None,
+                                     status=getattr(response, 'status_code', None), bytes_sent=len(chunk),
+                                     latency=time.time()-start, retries=max(0, attempts[0]-1),
+                                     error=error, timestamp=start)
 
                 chunk_record['response-status-code'] = response.status_code
                 chunk_record['response-headers'] = response.headers
                 if response.text:
                     chunk_record['response-body'] = response.text
-                diagnostics['chunks'].append(chunk_record)
+                with lock:
+                    diagnostics['chunks'].append(chunk_record)
+                    uploaded['bytes'] += len(chunk)
+                    utils.printTransferProgress(uploaded['bytes'], fileSize, prefix = 'Uploading', postfix=filepath)
                 exceptions._raise_for_status(response, verbose=True)
+                with lock:
+                    journal['completedChunks'].append(i)
+                    if journalPath:
+                        cache.write_upload_journal(journalPath, journal)
+                return i
+
+            def upload_chunks():
+                done = set(journal['completedChunks'])
+                uploaded['bytes'] = sum(min(chunksize, fileSize-(i-1)*chunksize) for i in done)
+                chunkNumbers = [i for i in range(1, nchunks(filepath, chunksize=chunksize)+1) if i not in done]
+                if max_threads > 1 and len(chunkNumbers) > 1:
+                    pool = ThreadPool(min(max_threads, len(chunkNumbers)))
+                    try:
+                        pool.map(upload_chunk, chunkNumbers)
+                    finally:
+                        pool.terminate()
+                else:
+                    map(upload_chunk, chunkNumbers)
+
+            try:
+                upload_chunks()
+            except SynapseHTTPError as ex:
+                # Synapse may no longer accept the token of a resumed upload,
+                # in which case the upload starts over with a fresh token
+                if 'resumed-chunks' not in diagnostics or not 400 <= ex.response.status_code < 500:
+                    raise
+                sys.stderr.write('\nCould not resume upload of %s, starting over.\n' % filepath)
+                token = self._createChunkedFileUploadToken(filepath, mimetype, md5=md5)
+                journal = {'fingerprint': fingerprint, 'token': token, 'completedChunks': []}
+                if journalPath:
+                    cache.write_upload_journal(journalPath, journal)
+                diagnostics['token'] = token
+                diagnostics['chunks'] = []
+                del diagnostics['resumed-chunks']
+                upload_chunks()
+            completedChunks = sorted(journal['completedChunks'])
+            diagnostics['chunks'].sort(key=lambda record: record['chunk-number'])
+
             ## complete the upload
             utils.printTransferProgress(fileSize, fileSize, prefix = 'Uploaded Chunks', postfix=filepath)
             sleep_on_failed_time = 1
@@ -1923,7 +2585,7 @@ class Synapse:
 
             while attempt_to_complete < max_attempts_to_complete:
                 attempt_to_complete += 1
-                status = self._startCompleteUploadDaemon(chunkedFileToken=token, chunkNumbers=[a+1 for a in range(i)])
+                status = self._startCompleteUploadDaemon(chunkedFileToken=token, chunkNumbers=completedChunks)
                 diagnostics['status'] = [status]
                 # Poll until concatenating chunks is complete
                 loop = 0
@@ -1941,6 +2603,10 @@ class Synapse:
                     time.sleep(sleep_on_failed_time)
                     sleep_on_failed_time *= backoff_multiplier
 
+            # The chunks are of no further use, whether or not they were assembled
+            if journalPath:
+                cache.remove_upload_journal(journalPath)
+
             if status['state'] == 'FAILED':
                 raise SynapseError(status['errorMessage'])
 
@@ -1951,6 +2617,9 @@ class Synapse:
         except Exception as ex:
             ex.diagnostics = diagnostics
             raise sys.exc_info()[0], ex, sys.exc_info()[2]
+        finally:
+            if reader:
+                reader.close()
 
         # Print timing information
         if progress: sys.stdout.write("\rUpload completed in %s.\n" % utils.format_time_interval(time.time()-diagnostics['start-time']))
@@ -1991,7 +2660,7 @@ class Synapse:
 
             # PUT the chunk to S3
             response = _with_retry(
-                lambda: requests.put(url, data=content.encode("utf-8"), headers=headers),
+                lambda: self._requests_session.put(url, data=content.encode("utf-8"), headers=headers),
                 **retry_policy)
 
             chunk_record['response-status-code'] = response.status_code
@@ -2357,9 +3026,14 @@ class Synapse:
         self.restPOST('/evaluation/%s/participant' % id_of(evaluation), {})
 
 
-    def getParticipants(self, evaluation):
+    def getParticipants(self, evaluation, limit=20, offset=0, max_threads=1):
         """
-        :param evaluation: Evaluation to get Participants from.
+        :param evaluation:  Evaluation to get Participants from.
+        :param limit:       How many Participants to fetch in each request
+        :param offset:      Start iterating at a Participant offset from the first
+        :param max_threads: How many pages to fetch at once.  Pages after the first
+                            are fetched concurrently once the first has told how many
+                            there are.
 
         :returns: A generator over Participants (dictionary) for an Evaluation
 
@@ -2369,11 +3043,11 @@ class Synapse:
         evaluation_id = id_of(evaluation)
         url = "/evaluation/%s/participant" % evaluation_id
 
-        for result in self._GET_paginated(url):
+        for result in self._GET_paginated(url, limit=limit, offset=offset, max_threads=max_threads):
             yield result
 
 
-    def getSubmissions(self, evaluation, status=None, myOwn=False, limit=100, offset=0):
+    def getSubmissions(self, evaluation, status=None, myOwn=False, limit=100, offset=0, max_threads=1):
         """
         :param evaluation: Evaluation to get submissions from.
         :param status:     Optionally filter submissions for a specific status.
@@ -2388,6 +3062,9 @@ class Synapse:
                            missions returned in total.
         :param offset:     Start iterating at a submission offset from the first
                            submission.
+        :param max_threads: How many requests to make at once.  Pages after the first
+                           are fetched concurrently once the first has told how many
+                           submissions there are.
 
         :returns: A generator over :py:class:`synapseclient.evaluation.Submission` objects for an Evaluation
 
@@ -2407,11 +3084,11 @@ class Synapse:
 #                raise SynapseError('Status must be one of {OPEN, CLOSED, SCORED, INVALID}')
             uri += "?status=%s" % status
 
-        for result in self._GET_paginated(uri, limit=limit, offset=offset):
+        for result in self._GET_paginated(uri, limit=limit, offset=offset, max_threads=max_threads):
             yield Submission(**result)
 
 
-    def _getSubmissionBundles(self, evaluation, status=None, myOwn=False, limit=100, offset=0):
+    def _getSubmissionBundles(self, evaluation, status=None, myOwn=False, limit=100, offset=0, max_threads=1):
         """
         :param evaluation: Evaluation to get submissions from.
         :param status:     Optionally filter submissions for a specific status.
@@ -2422,6 +3099,7 @@ class Synapse:
                            service in a single response.
         :param offset:     Start iterating at a submission offset from the first
                            submission.
+        :param max_threads: How many requests to make at once
 
         :returns: A generator over dictionaries with keys 'submission' and 'submissionStatus'.
 
@@ -2444,10 +3122,10 @@ class Synapse:
         if status != None:
             url += "?status=%s" % status
 
-        return self._GET_paginated(url, limit=limit, offset=offset)
+        return self._GET_paginated(url, limit=limit, offset=offset, max_threads=max_threads)
 
 
-    def getSubmissionBundles(self, evaluation, status=None, myOwn=False, limit=100, offset=0):
+    def getSubmissionBundles(self, evaluation, status=None, myOwn=False, limit=100, offset=0, max_threads=1):
         """
         :param evaluation: Evaluation to get submissions from.
         :param status:     Optionally filter submissions for a specific status.
@@ -2458,6 +3136,9 @@ class Synapse:
                            service in a single response.
         :param offset:     Start iterating at a submission offset from the first
                            submission.
+        :param max_threads: How many requests to make at once.  Pages after the first
+                           are fetched concurrently once the first has told how many
+                           submissions there are.
 
         :returns: A generator over tuples containing a :py:class:`synapseclient.evaluation.Submission`
                   and a :py:class:`synapseclient.evaluation.SubmissionStatus`.
@@ -2475,18 +3156,21 @@ class Synapse:
 
         See: :py:mod:`synapseclient.evaluation`
         """
-        for bundle in self._getSubmissionBundles(evaluation, status=status, myOwn=myOwn, limit=limit, offset=offset):
+        for bundle in self._getSubmissionBundles(evaluation, status=status, myOwn=myOwn, limit=limit, offset=offset, max_threads=max_threads):
             yield (Submission(**bundle['submission']), SubmissionStatus(**bundle['submissionStatus']))
 
 
-    def _GET_paginated(self, uri, limit=20, offset=0):
+    def _GET_paginated(self, uri, limit=20, offset=0, max_threads=1):
         """
         :param uri: A URI that returns paginated results
         :param limit: How many records should be returned per request
         :param offset: At what record offset from the first should
                        iteration start
+        :param max_threads: How many pages to fetch at once.  With more than one,
+                            the pages after the first are fetched concurrently, once
+                            the first has told how many results there are.
 
-        :returns: A generator over some paginated results
+        :returns: A generator over some paginated results, in order
 
         The limit parameter is set at 20 by default. Using a larger limit
         results in fewer calls to the service, but if responses are large
@@ -2495,13 +3179,39 @@ class Synapse:
 
         totalNumberOfResults = sys.maxint
         while offset < totalNumberOfResults:
-            uri = utils._limit_and_offset(uri, limit=limit, offset=offset)
-            page = self.restGET(uri)
-            results = page['results'] if 'results' in page else page['children']
-            totalNumberOfResults = page.get('totalNumberOfResults', len(results))
+            results, totalNumberOfResults = self._getPage(uri, limit, offset)
             for result in results:
                 offset += 1
                 yield result
+            if max_threads > 1 and results:
+                break
+        else:
+            return
+
+        ## The service may return fewer results than asked for, so the
+        ## first page's length is taken as the size of the others
+        pageSize = len(results)
+        def fetch(start):
+            results, _ = self._getPage(uri, pageSize, start)
+            ## Fill in any part of a page that came back short
+            while results and len(results) < min(pageSize, totalNumberOfResults - start):
+                more, _ = self._getPage(uri, pageSize - len(results), start + len(results))
+                if not more:
+                    break
+                results.extend(more)
+            return results
+
+        for results in utils.imap_ordered(fetch, xrange(offset, totalNumberOfResults, pageSize), max_threads):
+            for result in results:
+                yield result
+
+
+    def _getPage(self, uri, limit, offset):
+        """Returns a page of paginated results and the total number of results."""
+
+        page = self.restGET(utils._limit_and_offset(uri, limit=limit, offset=offset))
+        results = page['results'] if 'results' in page else page['children']
+        return results, page.get('totalNumberOfResults', len(results))
 
 
     def getSubmission(self, id, **kwargs):
@@ -2661,16 +3371,37 @@ class Synapse:
     ##                     Tables                             ##
     ############################################################
 
-    def _waitForAsync(self, uri, request):
+    def _waitForAsync(self, uri, request, polling=None):
+        """
+        Starts an asynchronous job and polls for its result.  The first poll is made right away,
+        then the sleeps between polls grow geometrically from *table_query_sleep* by a factor of
+        *table_query_backoff*, up to *table_query_max_sleep*.  While the job reports progress,
+        sleeps are kept short of the time the job is expected to take to finish at its current rate.
+
+        :param polling: Optional dictionary overriding the 'sleep', 'backoff', 'max_sleep' and
+                        'timeout' of this Synapse object for this job alone
+        """
+        polling = polling or {}
+        initial_sleep = polling.get('sleep', self.table_query_sleep)
+        backoff = polling.get('backoff', self.table_query_backoff)
+        max_sleep = polling.get('max_sleep', self.table_query_max_sleep)
+        timeout = polling.get('timeout', self.table_query_timeout)
+
+        job_start_time = time.time()
         async_job_id = self.restPOST(uri+'/start', body=json.dumps(request))
 
         # http://rest.synapse.org/org/sagebionetworks/repo/model/asynch/AsynchronousJobStatus.html
-        sleep = self.table_query_sleep
+        sleep = initial_sleep
+        polls, slept = 0, 0.0
         start_time = time.time()
         lastMessage, lastProgress, lastTotal, progressed = '', 0, 1, False
-        while time.time()-start_time < self.table_query_timeout:
-            result = self.restGET(uri+'/get/%s'%async_job_id['token'])
-            if result.get('jobState', None) == 'PROCESSING':
+        firstProgress = None
+        try:
+            while True:
+                result = self.restGET(uri+'/get/%s'%async_job_id['token'])
+                polls += 1
+                if result.get('jobState', None) != 'PROCESSING':
+                    break
                 progressed=True
                 message = result.get('progressMessage', lastMessage)
                 progress = result.get('progressCurrent', lastProgress)
@@ -2681,19 +3412,78 @@ class Synapse:
                 if message != lastMessage or lastProgress != progress:
                     start_time = time.time()
                     lastMessage, lastProgress, lastTotal = message, progress, total
-                sleep = min(self.table_query_max_sleep, sleep * self.table_query_backoff)
+                elif time.time()-start_time >= timeout:
+                    self._recordAsyncJob(uri, 'timeout', polls, slept, time.time()-job_start_time)
+                    raise SynapseTimeoutError('Timeout waiting for query results: %0.1f seconds ' % (time.time()-start_time))
+
+                # Don't sleep much past when the job should finish, judging by its rate of progress
+                if firstProgress is None:
+                    firstProgress = (time.time(), progress)
+                elapsed = time.time() - firstProgress[0]
+                if progress > firstProgress[1] and total > progress and elapsed > 0:
+                    remaining = (total - progress) * elapsed / (progress - firstProgress[1])
+                    sleep = min(sleep, max(initial_sleep, remaining))
+
                 time.sleep(sleep)
-            else:
-                break
-        else:
-            raise SynapseTimeoutError('Timeout waiting for query results: %0.1f seconds ' % (time.time()-start_time))
+                slept += sleep
+                sleep = min(max_sleep, sleep * backoff)
+        except SynapseTimeoutError:
+            raise
+        except Exception:
+            self._recordAsyncJob(uri, 'error', polls, slept, time.time()-job_start_time)
+            raise
         if result.get('jobState', None) == 'FAILED':
-            raise SynapseError(result.get('errorMessage', None) + '\n' + result.get('errorDetails', None), asynchronousJobStatus=result)
+            self._recordAsyncJob(uri, 'failed', polls, slept, time.time()-job_start_time)
+            # SynapseError takes no keyword arguments, so the job status is attached afterwards
+            error = SynapseError('%s\n%s' % (result.get('errorMessage', None), result.get('errorDetails', None)))
+            error.asynchronousJobStatus = result
+            raise error
+        self._recordAsyncJob(uri, 'complete', polls, slept, time.time()-job_start_time)
         if progressed:
             utils.printTransferProgress(total ,total, message, isBytes=False)
         return result
 
 
+    def _recordAsyncJob(self, uri, outcome, polls, slept, elapsed):
+        # Jobs are grouped by their URI, less the ID of the table, e.g. '/entity/{id}/table/query/async'
+        jobType = re.sub(r'syn\d+', '{id}', uri)
+        with self._async_job_stats_lock:
+            stats = self._async_job_stats.setdefault(jobType, {
+                'jobs': 0, 'polls': 0, 'sleep_time': 0.0, 'total_time': 0.0, 'max_time': 0.0,
+                'complete': 0, 'failed': 0, 'timeout': 0, 'error': 0})
+            stats['jobs'] += 1
+            stats['polls'] += polls
+            stats['sleep_time'] += slept
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats[outcome] += 1
+        self._emitMetric('async_job', 'ASYNC', uri, endpoint=self.repoEndpoint, status=outcome, latency=elapsed,
+                         error=None if outcome == 'complete' else outcome, timestamp=time.time()-elapsed)
+
+
+    def asyncJobStats(self, reset=False):
+        """
+        Returns timing statistics of the asynchronous jobs run by this Synapse object, such as table
+        queries and CSV uploads and downloads, for tuning how often jobs are polled.
+
+        The statistics are a dictionary keyed by the type of job, e.g. '/entity/{id}/table/query/async',
+        of dictionaries with the number of 'jobs', the total number of 'polls', the time spent sleeping
+        between polls ('sleep_time'), the 'total_time' and 'max_time' taken by jobs, their 'mean_time'
+        and 'mean_polls', and how many jobs were 'complete', 'failed', ended in a 'timeout' or in
+        some other 'error'.
+
+        :param reset: Whether to start collecting statistics afresh
+        """
+        with self._async_job_stats_lock:
+            stats = dict((jobType, dict(jobStats,
+                                        mean_time=jobStats['total_time'] / jobStats['jobs'],
+                                        mean_polls=float(jobStats['polls']) / jobStats['jobs']))
+                         for jobType, jobStats in self._async_job_stats.items())
+            if reset:
+                self._async_job_stats.clear()
+            return stats
+
+
     def getColumn(self, id):
         """
         Gets a Column object from Synapse by ID.
@@ -2707,17 +3497,20 @@ class Synapse:
         return Column(**self.restGET(Column.getURI(id)))
 
 
-    def getColumns(self, x, limit=100, offset=0):
+    def getColumns(self, x, limit=100, offset=0, max_threads=1):
         """
         Get all columns defined in Synapse, those corresponding to a set of column
         headers or those whose names start with a given prefix.
 
         :param x: a list of column headers, a Schema, a TableSchema's Synapse ID, or a string prefix
+        :param limit: how many Columns to fetch in each request
+        :param offset: start iterating at a Column offset from the first
+        :param max_threads: how many requests to make at once
         :Return: a generator of Column objects
         """
         if x is None:
             uri = '/column'
-            for result in self._GET_paginated(uri, limit=limit, offset=offset):
+            for result in self._GET_paginated(uri, limit=limit, offset=offset, max_threads=max_threads):
                 yield Column(**result)
         elif isinstance(x, (list, tuple)):
             for header in x:
@@ -2730,22 +3523,26 @@ class Synapse:
                     pass
         elif isinstance(x, Schema) or utils.is_synapse_id(x):
             uri = '/entity/{id}/column'.format(id=id_of(x))
-            for result in self._GET_paginated(uri, limit=limit, offset=offset):
+            for result in self._GET_paginated(uri, limit=limit, offset=offset, max_threads=max_threads):
                 yield Column(**result)
         elif isinstance(x, basestring):
             uri = '/column?prefix=' + x
-            for result in self._GET_paginated(uri, limit=limit, offset=offset):
+            for result in self._GET_paginated(uri, limit=limit, offset=offset, max_threads=max_threads):
                 yield Column(**result)
         else:
             ValueError("Can't get columns for a %s" % type(x))
 
 
-    def getTableColumns(self, table, limit=100, offset=0):
+    def getTableColumns(self, table, limit=100, offset=0, max_threads=1):
         """
         Retrieve the column models used in the given table schema.
+
+        :param limit:       How many Columns to fetch in each request
+        :param offset:      Start iterating at a Column offset from the first
+        :param max_threads: How many requests to make at once
         """
         uri = '/entity/{id}/column'.format(id=id_of(table))
-        for result in self._GET_paginated(uri, limit=limit, offset=offset):
+        for result in self._GET_paginated(uri, limit=limit, offset=offset, max_threads=max_threads):
             yield Column(**result)
 
 
@@ -2775,6 +3572,8 @@ class Synapse:
         :param isConsistent: defaults to True. If set to False, return results based on current
                              state of the index without waiting for pending writes to complete.
                              Only use this if you know what you're doing.
+        :param prefetch: how many pages of rows to fetch in the background ahead of the page being
+                         read, defaults to 0. See :py:class:`synapseclient.table.TableQueryResult`.
 
         For CSV files, there are several parameters to control the format of the resulting file:
 
@@ -2784,6 +3583,15 @@ class Synapse:
         :param separator: defaults to comma
         :param header: True by default
         :param includeRowIdAndRowVersion: True by default
+
+        Either way, how often Synapse is polled for the results can be set for this query alone:
+
+        :param polling: a dictionary with any of the initial 'sleep' between polls, the 'backoff' factor
+                        by which sleeps grow, the 'max_sleep' and the 'timeout' in seconds, defaulting
+                        to the table_query_sleep, table_query_backoff, table_query_max_sleep and
+                        table_query_timeout attributes of this Synapse object. For example::
+
+                            results = syn.tableQuery("select * from syn12345", polling={'sleep': 0.05, 'max_sleep': 1})
         """
         if resultsAs.lower()=="rowset":
             return TableQueryResult(self, query, **kwargs)
@@ -2793,7 +3601,145 @@ class Synapse:
             raise ValueError("Unknown return type requested from tableQuery: " + unicode(resultsAs))
 
 
-    def _queryTable(self, query, limit=None, offset=None, isConsistent=True, partMask=None):
+    def appendToTable(self, schema, data, columnNames=None, partSize=TABLE_PART_SIZE, max_threads=None, retries=2, etag=None, progress=True, polling=None):
+        """
+        Appends rows to a table, streaming them to Synapse in parts so that tables of any size can be uploaded.
+
+        The rows are written to CSV files of about *partSize* bytes, which are uploaded several at a time.
+        Each part is then added to the table by its own UploadToTableRequest, in the order of the rows,
+        each giving the etag of the table left by the part before it.  A part whose upload fails is tried
+        again, as is one whose request fails or times out.  The etag keeps a request that did in fact
+        succeed the first time from adding its rows twice: the retry is refused, and finding that the
+        table has moved on from the etag, the part is taken to have been added.  This assumes nothing
+        else changes the table during the append.
+
+        Unless given, the etag is looked up before the first part is added.  A table that has never
+        had rows added has no etag, so the first part added to it is not tried again.
+
+        :param schema:      A :py:class:`synapseclient.table.Schema` or its Synapse ID.  A new Schema is stored
+                            first, taking its columns from the DataFrame if it has none.
+        :param data:        A Pandas DataFrame or an iterable of rows, each a list of values
+        :param columnNames: The names of the columns of the rows, defaulting to the columns of the DataFrame
+                            or else those of the table
+        :param partSize:    The size of each part in bytes, 100 MB by default
+        :param max_threads: How many parts to upload at once, defaulting to self.max_threads
+        :param retries:     How many more times to try each part
+        :param etag:        The current etag of the table, if known
+        :param progress:    Whether to print each part as it is added
+
+        :returns: A dictionary of the table's 'etag' once all the rows are added, the 'rows' added
+                  and a report of each of the 'parts', with its number of 'rows', 'bytes', 'fileHandleId',
+                  'uploadAttempts', 'requestAttempts' and the 'etag' it left.
+
+        If a part can't be added, the error is raised with the reports of the parts that were added
+        in its *appendedParts*.
+
+        Example::
+
+            schema = syn.store(Schema(name='big table', columns=cols, parent=project))
+            syn.appendToTable(schema, df, partSize=50*MB)
+        """
+        if isinstance(schema, Schema) and schema.get('id', None) is None:
+            if not schema.has_columns() and hasattr(data, 'columns'):
+                schema.addColumns(as_table_columns(data))
+            schema = self.store(schema)
+        if columnNames is None:
+            if hasattr(data, 'columns'):
+                columnNames = list(data.columns)
+            else:
+                columnNames = [column.name for column in self.getTableColumns(schema)]
+        if etag is None:
+            etag = self._getTableEtag(schema, polling=polling)
+
+        max_threads = max_threads or self.max_threads
+        window_size = 2 * max_threads
+        window = threading.Semaphore(window_size)
+        stopped = threading.Event()
+        pending = set()
+
+        def parts():
+            # Only let a window of parts be written ahead of the ones added to the table
+            for i, part in enumerate(csv_parts(data, columnNames, partSize), 1):
+                pending.add(part[0])
+                window.acquire()
+                if stopped.is_set():
+                    return
+                yield i, part
+
+        def upload_part(item):
+            i, (path, rows, size) = item
+            report = {'part': i, 'rows': rows, 'bytes': size, 'uploadAttempts': 0}
+            while True:
+                report['uploadAttempts'] += 1
+                try:
+                    fileHandle = self._chunkedUploadFile(path, mimetype="text/csv", progress=False, max_threads=1, resume=False)
+                    report['fileHandleId'] = fileHandle['id']
+                    return path, report, None
+                except Exception as ex:
+                    if report['uploadAttempts'] > retries:
+                        return path, report, ex
+
+        def add_part(report, etag):
+            report['requestAttempts'] = 0
+            while True:
+                report['requestAttempts'] += 1
+                try:
+                    return self._uploadCsvFileHandle(report['fileHandleId'], schema, updateEtag=etag, polling=polling)
+                except (SynapseTimeoutError, SynapseHTTPError) as ex:
+                    status = getattr(getattr(ex, 'response', None), 'status_code', None)
+                    if status == 412 and report['requestAttempts'] > 1:
+                        # The try before may have added the part after all, moving the table on from the etag
+                        currentEtag = self._getTableEtag(schema, polling=polling)
+                        if currentEtag != etag:
+                            return {'etag': currentEtag}
+                    retriable = isinstance(ex, SynapseTimeoutError) or (status is not None and status >= 500)
+                    # Without an etag, nothing would stop a retry from adding the rows twice
+                    if not retriable or etag is None or report['requestAttempts'] > retries:
+                        raise
+
+        reports = []
+        pool = ThreadPool(max_threads)
+        failed = True
+        try:
+            for path, report, error in pool.imap(upload_part, parts()):
+                try:
+                    if error is not None:
+                        raise error
+                    result = add_part(report, etag)
+                    etag = result.get('etag', etag)
+                    report['etag'] = etag
+                    reports.append(report)
+                    if progress:
+                        sys.stdout.write('Added part %d of %d rows (%s) to %s, %d rows in all\n'
+                                         % (report['part'], report['rows'], utils.humanizeBytes(report['bytes']),
+                                            id_of(schema), sum(r['rows'] for r in reports)))
+                except Exception as ex:
+                    ex.appendedParts = reports
+                    raise
+                finally:
+                    os.remove(path)
+                    pending.discard(path)
+                    window.release()
+            failed = False
+        finally:
+            # Let the parts still being written stop, then clean up after them
+            stopped.set()
+            for i in range(window_size):
+                window.release()
+            if failed:
+                # Don't wait for the parts already queued to be uploaded
+                pool.terminate()
+            else:
+                pool.close()
+                pool.join()
+            for path in list(pending):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        return {'etag': etag, 'rows': sum(report['rows'] for report in reports), 'parts': reports}
+
+
+    def _queryTable(self, query, limit=None, offset=None, isConsistent=True, partMask=None, polling=None):
         """
         Query a table and return the first page of results as a `QueryResultBundle <http://rest.synapse.org/org/sagebionetworks/repo/model/table/QueryResultBundle.html>`_.
         If the result contains a *nextPageToken*, following pages a retrieved
@@ -2805,6 +3751,7 @@ class Synapse:
                             Query Count (queryCount) = 0x2
                             Select Columns (selectColumns) = 0x4
                             Max Rows Per Page (maxRowsPerPage) = 0x8
+        :param polling:  Optional dictionary of how to poll for the result, see :py:meth:`~._waitForAsync`
         """
 
         # See: http://rest.synapse.org/org/sagebionetworks/repo/model/table/QueryBundleRequest.html
@@ -2826,15 +3773,22 @@ class Synapse:
 
         uri = '/entity/{id}/table/query/async'.format(id=_extract_synapse_id_from_query(query))
 
-        return self._waitForAsync(uri=uri, request=query_bundle_request)
+        return self._waitForAsync(uri=uri, request=query_bundle_request, polling=polling)
+
+
+    def _getTableEtag(self, schema, polling=None):
+        """Returns the etag of the latest change to a table, or None if it has never had rows added."""
+
+        result = self._queryTable("select * from %s" % id_of(schema), limit=1, partMask=0x1, polling=polling)
+        return result['queryResult']['queryResults'].get('etag', None)
 
 
-    def _queryTableNext(self, nextPageToken, tableId):
+    def _queryTableNext(self, nextPageToken, tableId, polling=None):
         uri = '/entity/{id}/table/query/nextPage/async'.format(id=tableId)
-        return self._waitForAsync(uri=uri, request=nextPageToken)
+        return self._waitForAsync(uri=uri, request=nextPageToken, polling=polling)
 
 
-    def _uploadCsv(self, filepath, schema, updateEtag=None, quoteCharacter='"', escapeCharacter="\\", lineEnd=os.linesep, separator=",", header=True, linesToSkip=0):
+    def _uploadCsv(self, filepath, schema, updateEtag=None, quoteCharacter='"', escapeCharacter="\\", lineEnd=os.linesep, separator=",", header=True, linesToSkip=0, polling=None):
         """
         Send an `UploadToTableRequest <http://rest.synapse.org/org/sagebionetworks/repo/model/table/UploadToTableRequest.html>`_ to Synapse.
 
@@ -2846,6 +3800,16 @@ class Synapse:
         """
 
         fileHandle = self._chunkedUploadFile(filepath, mimetype="text/csv")
+        return self._uploadCsvFileHandle(fileHandle['id'], schema, updateEtag=updateEtag, quoteCharacter=quoteCharacter,
+                                         escapeCharacter=escapeCharacter, lineEnd=lineEnd, separator=separator,
+                                         header=header, linesToSkip=linesToSkip, polling=polling)
+
+
+    def _uploadCsvFileHandle(self, fileHandleId, schema, updateEtag=None, quoteCharacter='"', escapeCharacter="\\", lineEnd=os.linesep, separator=",", header=True, linesToSkip=0, polling=None):
+        """
+        Send an `UploadToTableRequest <http://rest.synapse.org/org/sagebionetworks/repo/model/table/UploadToTableRequest.html>`_
+        for a CSV file that has already been uploaded, see :py:meth:`~._uploadCsv`.
+        """
 
         request = {
             "concreteType":"org.sagebionetworks.repo.model.table.UploadToTableRequest",
@@ -2857,17 +3821,17 @@ class Synapse:
                 "separator": separator},
             "linesToSkip": linesToSkip,
             "tableId": id_of(schema),
-            "uploadFileHandleId": fileHandle['id']
+            "uploadFileHandleId": fileHandleId
         }
 
         if updateEtag:
             request["updateEtag"] = updateEtag
 
         uri = "/entity/{id}/table/upload/csv/async".format(id=id_of(schema))
-        return self._waitForAsync(uri=uri, request=request)
+        return self._waitForAsync(uri=uri, request=request, polling=polling)
 
 
-    def _queryTableCsv(self, query, quoteCharacter='"', escapeCharacter="\\", lineEnd=os.linesep, separator=",", header=True, includeRowIdAndRowVersion=True):
+    def _queryTableCsv(self, query, quoteCharacter='"', escapeCharacter="\\", lineEnd=os.linesep, separator=",", header=True, includeRowIdAndRowVersion=True, polling=None):
         """
         Query a Synapse Table and download a CSV file containing the results.
 
@@ -2896,7 +3860,7 @@ class Synapse:
             "includeRowIdAndRowVersion": includeRowIdAndRowVersion}
 
         uri = "/entity/{id}/table/download/csv/async".format(id=_extract_synapse_id_from_query(query))
-        download_from_table_result = self._waitForAsync(uri=uri, request=download_from_table_request)
+        download_from_table_result = self._waitForAsync(uri=uri, request=download_from_table_request, polling=polling)
 
         url = '%s/fileHandle/%s/url' % (self.fileHandleEndpoint, download_from_table_result['resultsFileHandleId'])
         cache_dir = cache.determine_cache_directory(download_from_table_result['resultsFileHandleId'])
@@ -3049,7 +4013,11 @@ class Synapse:
         if versionLabel:
             entity['versionLabel'] = str(versionLabel)
 
-        return self.restPUT(uri, body=json.dumps(get_properties(entity)))
+        self._invalidateEntityBundle(entity)
+        try:
+            return self.restPUT(uri, body=json.dumps(get_properties(entity)))
+        finally:
+            self._invalidateEntityBundle(entity)
 
 
     def _findEntityIdByNameAndParent(self, name, parent=None):
@@ -3138,11 +4106,7 @@ class Synapse:
         :returns: JSON encoding of response
         """
 
-        uri, headers = self._build_uri_and_headers(uri, endpoint, headers)
-        retryPolicy = self._build_retry_policy(retryPolicy)
-
-        response = _with_retry(lambda: requests.get(uri, headers=headers, **kwargs), **retryPolicy)
-        exceptions._raise_for_status(response, verbose=self.debug)
+        response = self._rest_call('GET', uri, endpoint, headers, retryPolicy, **kwargs)
         return self._return_rest_body(response)
 
 
@@ -3159,11 +4123,7 @@ class Synapse:
         :returns: JSON encoding of response
         """
 
-        uri, headers = self._build_uri_and_headers(uri, endpoint, headers)
-        retryPolicy = self._build_retry_policy(retryPolicy)
-
-        response = _with_retry(lambda: requests.post(uri, data=body, headers=headers, **kwargs), **retryPolicy)
-        exceptions._raise_for_status(response, verbose=self.debug)
+        response = self._rest_call('POST', uri, endpoint, headers, retryPolicy, data=body, **kwargs)
         return self._return_rest_body(response)
 
 
@@ -3180,11 +4140,7 @@ class Synapse:
         :returns: JSON encoding of response
         """
 
-        uri, headers = self._build_uri_and_headers(uri, endpoint, headers)
-        retryPolicy = self._build_retry_policy(retryPolicy)
-
-        response = _with_retry(lambda: requests.put(uri, data=body, headers=headers, **kwargs), **retryPolicy)
-        exceptions._raise_for_status(response, verbose=self.debug)
+        response = self._rest_call('PUT', uri, endpoint, headers, retryPolicy, data=body, **kwargs)
         return self._return_rest_body(response)
 
 
@@ -3198,11 +4154,50 @@ class Synapse:
         :param kwargs:   Any other arguments taken by a `requests <http://docs.python-requests.org/en/latest/>`_ method
         """
 
+        response = self._rest_call('DELETE', uri, endpoint, headers, retryPolicy, **kwargs)
+
+
+    def _rest_call(self, method, uri, endpoint, headers, retryPolicy, **kwargs):
+        """
+        Makes a REST call through the connection pool, with retries, reporting it to the
+        metrics hooks.  Returns the response, having raised an exception for any error status.
+        """
+        template = uri_template(uri, endpoint or self.repoEndpoint)
         uri, headers = self._build_uri_and_headers(uri, endpoint, headers)
         retryPolicy = self._build_retry_policy(retryPolicy)
 
-        response = _with_retry(lambda: requests.delete(uri, headers=headers, **kwargs), **retryPolicy)
-        exceptions._raise_for_status(response, verbose=self.debug)
+        throttle = self._throttle(endpoint or self.repoEndpoint)
+        attempts = [0]
+        def call():
+            attempts[0] += 1
+            ticket = throttle.acquire()
+            response = None
+            try:
+                response = getattr(self._requests_session, method.lower())(uri, headers=headers, **kwargs)
+                return response
+            finally:
+                throttle.release(ticket, response)
+
+        start = time.time()
+        response, error = None, None
+        try:
+            # The throttle holds back the retries of throttled calls, for every thread at once
+            response = _with_retry(call, throttled=is_throttled, **retryPolicy)
+            exceptions._raise_for_status(response, verbose=self.debug)
+            return response
+        except Exception as ex:
+            error = ex
+            if response is None:
+                response = getattr(ex, 'response', None)
+            raise
+        finally:
+            body = kwargs.get('data', None)
+            self._emitMetric('rest', method, uri, endpoint=endpoint or self.repoEndpoint,
+                             status=getattr(response, 'status_code', None),
+                             bytes_sent=len(body) if isinstance(body, basestring) else None,
+                             bytes_received=len(response.content) if response is not None and not kwargs.get('stream') else None,
+                             latency=time.time()-start, retries=max(0, attempts[0]-1),
+                             error=error, timestamp=start, template=template)
 
 
     def _build_uri_and_headers(self, uri, endpoint=None, headers=None):
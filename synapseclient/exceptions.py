@@ -9,6 +9,7 @@ Exceptions
 .. autoclass:: synapseclient.exceptions.SynapseMalformedEntityError
 .. autoclass:: synapseclient.exceptions.SynapseProvenanceError
 .. autoclass:: synapseclient.exceptions.SynapseHTTPError
+.. autoclass:: synapseclient.exceptions.SynapseMd5MismatchError
 
 """
 
@@ -43,6 +44,9 @@ class SynapseProvenanceError(SynapseError):
 class SynapseHTTPError(SynapseError, requests.exceptions.HTTPError):
     """Wraps recognized HTTP errors.  See `HTTPError <http://docs.python-requests.org/en/latest/api/?highlight=exceptions#requests.exceptions.HTTPError>`_"""
 
+class SynapseMd5MismatchError(SynapseError, IOError):
+    """Error raised when the MD5 of a downloaded file does not match the one recorded by Synapse."""
+
 
 def _raise_for_status(response, verbose=False):
     """
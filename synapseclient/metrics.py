@@ -0,0 +1,167 @@
+"""
+*******
+Metrics
+*******
+
+A :py:class:`synapseclient.Synapse` object describes each call it makes to Synapse, each
+asynchronous job it waits on and each chunk and file it transfers, in an event delivered to
+the hooks added by :py:func:`synapseclient.Synapse.addMetricsHook`.  The events are also
+summarised by a :py:class:`MetricsRegistry`, whose snapshot is returned by
+:py:func:`synapseclient.Synapse.metrics`::
+
+    syn = synapseclient.login()
+    syn.addMetricsHook(lambda event: log.debug('%(method)s %(uri_template)s %(status)s %(latency).3f', event))
+    ...
+    for operation, stats in sorted(syn.metrics().items()):
+        print operation, stats['count'], stats['latency']['p50'], stats['latency']['p99']
+
+Each event is a dictionary with:
+
+    - **kind**: 'rest', 'async_job', 'upload_chunk' or 'download'
+    - **method**: the HTTP method, or 'ASYNC' for asynchronous jobs
+    - **uri**: the URI called
+    - **uri_template**: the URI with IDs and tokens replaced by placeholders, e.g. '/entity/{id}/bundle'
+    - **endpoint**: the server called
+    - **status**: the HTTP status code, or the outcome of an asynchronous job, or None if there was no response
+    - **bytes_sent**, **bytes_received**: the size of the request and response bodies, where known
+    - **latency**: the seconds taken, including any retries
+    - **retries**: how many times the call was retried
+    - **error**: the name of the exception raised, if any
+    - **timestamp**: when the call was started, in seconds from the UNIX epoch
+
+.. autoclass:: synapseclient.metrics.MetricsRegistry
+   :members:
+
+.. autoclass:: synapseclient.metrics.Histogram
+   :members:
+
+.. automethod:: synapseclient.metrics.uri_template
+
+"""
+
+import re
+import bisect
+import threading
+import urlparse
+
+
+_ID_PATTERNS = [
+    (re.compile(r'^syn\d+(\.\d+)?$', re.IGNORECASE), '{id}'),
+    (re.compile(r'^\d+$'), '{id}'),
+    ## UUIDs, hashes and the like
+    (re.compile(r'^[0-9a-f-]{16,}$', re.IGNORECASE), '{token}')]
+
+def uri_template(uri, endpoint=None):
+    """
+    Returns the path of the URI with its Synapse IDs, numeric IDs and tokens replaced by
+    placeholders, so calls of the same kind can be counted together.  The endpoint, if given,
+    and any query string are left off::
+
+        uri_template('/entity/syn123/version/2?limit=10') == '/entity/{id}/version/{id}'
+    """
+    if endpoint and uri.startswith(endpoint):
+        uri = uri[len(endpoint):]
+    path = urlparse.urlparse(uri).path
+    segments = []
+    for segment in path.split('/'):
+        for pattern, placeholder in _ID_PATTERNS:
+            if pattern.match(segment):
+                segment = placeholder
+                break
+        segments.append(segment)
+    return '/'.join(segments)
+
+
+## Bucket boundaries growing by a factor of 2**(1/4) from 0.1 ms to about 3 hours,
+## so quantiles are found to within about 19%
+_BUCKET_BOUNDS = [0.0001 * 2**(i/4.0) for i in range(4*27)]
+
+class Histogram(object):
+    """
+    A histogram of latencies in seconds, kept in a fixed number of buckets of
+    exponentially growing size, so that it takes the same memory however many
+    latencies are recorded.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(_BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Returns an estimate of the value below which the fraction q of the values fall."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = _BUCKET_BOUNDS[i] if i < len(_BUCKET_BOUNDS) else self.max
+                return max(self.min, min(self.max, bound))
+        return self.max
+
+    def summary(self):
+        """Returns a dictionary of the 'count', 'mean', 'min', 'max', 'p50', 'p90' and 'p99'."""
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.quantile(0.50),
+                'p90': self.quantile(0.90),
+                'p99': self.quantile(0.99)}
+
+
+class MetricsRegistry(object):
+    """
+    Summarises events by operation, that is by method and URI template, e.g. 'GET /entity/{id}/bundle'.
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def record(self, event):
+        """Adds an event, as described in :py:mod:`synapseclient.metrics`, to the counts of its operation."""
+        operation = '%s %s' % (event.get('method'), event.get('uri_template'))
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = {
+                    'kind': event.get('kind'), 'count': 0, 'errors': 0, 'retries': 0,
+                    'bytes_sent': 0, 'bytes_received': 0, 'statuses': {}, 'latency': Histogram()}
+            stats['count'] += 1
+            status = event.get('status')
+            if event.get('error') or (isinstance(status, int) and status >= 400):
+                stats['errors'] += 1
+            stats['retries'] += event.get('retries') or 0
+            stats['bytes_sent'] += event.get('bytes_sent') or 0
+            stats['bytes_received'] += event.get('bytes_received') or 0
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            if event.get('latency') is not None:
+                stats['latency'].record(event['latency'])
+
+    def snapshot(self, reset=False):
+        """
+        Returns a dictionary keyed by operation of dictionaries with the 'kind' of operation, its 'count',
+        'errors', 'retries', 'bytes_sent', 'bytes_received', a count of each response status in 'statuses'
+        and a summary of its 'latency', see :py:func:`Histogram.summary`.
+
+        :param reset: Whether to start counting afresh
+        """
+        with self._lock:
+            snapshot = dict((operation, dict(stats, statuses=dict(stats['statuses']), latency=stats['latency'].summary()))
+                            for operation, stats in self._operations.items())
+            if reset:
+                self._operations.clear()
+            return snapshot
@@ -6,7 +6,7 @@ from synapseclient.utils import _is_json
 
 def _with_retry(function, verbose=False, \
         retry_status_codes=[502,503], retry_errors=[], retry_exceptions=[], \
-        retries=3, wait=1, back_off=2, max_wait=30):
+        retries=3, wait=1, back_off=2, max_wait=30, throttled=None):
     """
     Retries the given function under certain conditions.
     
@@ -17,6 +17,8 @@ def _with_retry(function, verbose=False, \
     :param retries:            How many times to retry maximum.
     :param wait:               How many seconds to wait between retries.  
     :param back_off:           Exponential constant to increase wait for between progressive failures.  
+    :param throttled:          A function telling whether a response was throttled, in which case
+                               it is retried without waiting here, as the function paces itself.
     
     :returns: function()
     
@@ -44,7 +46,13 @@ def _with_retry(function, verbose=False, \
                 response = ex.response
 
         # Check if we got a retry-able error
-        if response is not None:
+        throttledResponse = response is not None and throttled is not None and throttled(response)
+        if throttledResponse:
+            if verbose:
+                print "retrying throttled response: " + str(response.status_code)
+            retry = True
+
+        elif response is not None:
             if response.status_code in retry_status_codes:
                 if verbose:
                     print "retrying on status code: " + str(response.status_code)
@@ -80,6 +88,8 @@ def _with_retry(function, verbose=False, \
         # Wait then retry
         retries -= 1
         if retries >= 0 and retry:
+            if throttledResponse:
+                continue
             if verbose:
                 sys.stderr.write('\n... Retrying in %d seconds...\n' % wait)
             time.sleep(wait)
@@ -234,6 +234,9 @@ import os
 import re
 import sys
 import tempfile
+import threading
+import weakref
+import Queue
 from collections import OrderedDict
 from itertools import izip
 
@@ -303,19 +306,92 @@ def df2Table(df, syn, tableName, parentProject):
     schema1 = syn.store(schema1)
 
 
-    #Add data to Table
-    for i in range(0, df.shape[0]/1200+1):
-        start =  i*1200
-        end = min((i+1)*1200, df.shape[0])
-        print start, end
-        rowset1 = RowSet(columns=cols, schema=schema1,
-                         rows=[Row(list(df.ix[j,:])) for j in range(start,end)])
-        #print len(rowset1.rows)
-        rowset1 = syn.store(rowset1)
+    #Add data to Table, in parts uploaded concurrently
+    syn.appendToTable(schema1, df)
 
     return schema1
 
 
+def csv_parts(data, columnNames, partSize=100*synapseclient.utils.MB, quoteCharacter='"', escapeCharacter="\\", lineEnd=os.linesep, separator=","):
+    """
+    Writes rows to a series of CSV files of about *partSize* bytes each, for appending
+    a table too large to upload in one file.  Each file starts with a header line.
+
+    :param data:        A Pandas DataFrame or an iterable of rows, each a list of values
+    :param columnNames: The names of the columns, written in the header of each file
+
+    :returns: A generator of (path, number of rows, number of bytes) for each file, which
+              it is the caller's responsibility to remove
+    """
+    f = None
+    try:
+        for block in _csv_blocks(data, quoteCharacter, escapeCharacter, lineEnd, separator):
+            text, nrows = block
+            if f is None:
+                f = tempfile.NamedTemporaryFile(mode='wb', suffix='.csv', delete=False)
+                writer = csv.writer(f, quotechar=quoteCharacter, escapechar=escapeCharacter,
+                                    lineterminator=lineEnd, delimiter=separator)
+                writer.writerow([_utf8(name) for name in columnNames])
+                rows = 0
+            f.write(text)
+            rows += nrows
+            if f.tell() >= partSize:
+                f.close()
+                yield f.name, rows, os.path.getsize(f.name)
+                f = None
+        if f is not None:
+            f.close()
+            yield f.name, rows, os.path.getsize(f.name)
+            f = None
+    finally:
+        ## a part abandoned half written is removed
+        if f is not None:
+            f.close()
+            os.remove(f.name)
+
+
+## rows of a data frame are written out this many at a time
+CSV_BLOCK_ROWS = 10000
+
+def _csv_blocks(data, quoteCharacter, escapeCharacter, lineEnd, separator):
+    if hasattr(data, 'to_csv'):
+        ## Pandas holds an integer column with missing values as floats, which
+        ## would be written as 1.0, so columns of whole numbers are written as integers
+        wholeNumberColumns = [col for col in data.columns
+                              if data[col].dtype.kind == 'f' and ((data[col].dropna() % 1) == 0).all()]
+        for start in range(0, len(data), CSV_BLOCK_ROWS):
+            block = data.iloc[start:start+CSV_BLOCK_ROWS]
+            if wholeNumberColumns:
+                import pandas as pd
+                block = block.copy()
+                for col in wholeNumberColumns:
+                    block[col] = pd.Series([None if value != value else int(value) for value in block[col]],
+                                           index=block.index, dtype=object)
+            text = block.to_csv(index=False, header=False, sep=separator, quotechar=quoteCharacter,
+                                escapechar=escapeCharacter, line_terminator=lineEnd, na_rep='', encoding='utf-8')
+            yield _utf8(text), len(block)
+    else:
+        from cStringIO import StringIO
+        buffer = StringIO()
+        writer = csv.writer(buffer, quotechar=quoteCharacter, escapechar=escapeCharacter,
+                            lineterminator=lineEnd, delimiter=separator)
+        nrows = 0
+        for row in data:
+            writer.writerow(['' if value is None else _utf8(value) for value in row])
+            nrows += 1
+            if nrows == CSV_BLOCK_ROWS:
+                yield buffer.getvalue(), nrows
+                buffer.seek(0)
+                buffer.truncate()
+                nrows = 0
+        if nrows:
+            yield buffer.getvalue(), nrows
+
+
+def _utf8(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
 def to_boolean(value):
     """
     Convert a string to boolean, case insensitively, where true values are:
@@ -347,47 +423,88 @@ def row_labels_from_id_and_version(rows):
 def row_labels_from_rows(rows):
     return row_labels_from_id_and_version([(row['rowId'], row['versionNumber']) for row in rows])
 
-def cast_values(values, headers):
+def _identity(field):
+    return field
+
+
+def _unknown_column_type(columnType):
+    def convert(field):
+        raise ValueError("Unknown column type: %s" % columnType)
+    return convert
+
+
+## Functions converting the non-empty fields of each type of column, see:
+## http://rest.synapse.org/org/sagebionetworks/repo/model/table/ColumnType.html
+_CONVERTERS = {
+    'STRING': _identity,
+    'ENTITYID': _identity,
+    'FILEHANDLEID': _identity,
+    'DOUBLE': float,
+    'INTEGER': int,
+    'BOOLEAN': to_boolean,
+    'DATE': synapseclient.utils.from_unix_epoch_time}
+
+
+def column_converters(headers):
+    """
+    Returns a function for each column header, converting the non-empty fields of
+    the column from strings to the column's type.  Looking up the converters once,
+    rather than for every field, saves time when casting many rows.
+    """
+    return [_CONVERTERS.get(header.get('columnType', 'STRING'), None) or _unknown_column_type(header.get('columnType'))
+            for header in headers]
+
+
+def cast_values(values, headers, converters=None):
     """
     Convert a row of table query results from strings to the correct column type.
+    Empty strings and None become None.
 
     See: http://rest.synapse.org/org/sagebionetworks/repo/model/table/ColumnType.html
+
+    :param converters: Optionally, the :py:func:`column_converters` of the headers,
+                       to save looking them up for each row
     """
     if len(values) != len(headers):
         raise ValueError('Each field in the row must have a matching column header. %d fields, %d headers' % (len(values), len(headers)))
 
+    if converters is None:
+        converters = column_converters(headers)
+    return [None if field is None or field=='' else convert(field) for convert, field in izip(converters, values)]
+
+
+def cast_columns(columns, headers):
+    """
+    Convert whole columns of table query results from strings to the correct column type,
+    as :py:func:`cast_values` does for each row.
+
+    :param columns: A sequence of fields for each of the headers
+
+    :returns: A list of values for each column
+    """
+    if len(columns) != len(headers):
+        raise ValueError('Each column must have a matching column header. %d columns, %d headers' % (len(columns), len(headers)))
+
     result = []
-    for header, field in izip(headers, values):
-
-        columnType = header.get('columnType', 'STRING')
-
-        ## convert field to column type
-        if field is None or field=='':
-            result.append(None)
-        elif columnType in ['STRING', 'ENTITYID', 'FILEHANDLEID']:
-            result.append(field)
-        elif columnType=='DOUBLE':
-            result.append(float(field))
-        elif columnType=='INTEGER':
-            result.append(int(field))
-        elif columnType=='BOOLEAN':
-            result.append(to_boolean(field))
-        elif columnType=='DATE':
-            result.append(utils.from_unix_epoch_time(field))
+    for convert, column in izip(column_converters(headers), columns):
+        if convert is _identity:
+            result.append([None if field=='' else field for field in column] if '' in column else list(column))
+        elif None in column or '' in column:
+            result.append([None if field is None or field=='' else convert(field) for field in column])
         else:
-            raise ValueError("Unknown column type: %s" % columnType)
-
+            result.append(map(convert, column))
     return result
 
 
-def cast_row(row, headers):
-    row['values'] = cast_values(row['values'], headers)
+def cast_row(row, headers, converters=None):
+    row['values'] = cast_values(row['values'], headers, converters)
     return row
 
 
 def cast_row_set(rowset):
+    converters = column_converters(rowset['headers'])
     for i, row in enumerate(rowset['rows']):
-        rowset['rows'][i]['values'] = cast_row(row, rowset['headers'])
+        rowset['rows'][i]['values'] = cast_row(row, rowset['headers'], converters)
     return rowset
 
 
@@ -557,9 +674,13 @@ class RowSet(DictObject):
     """
 
     @classmethod
-    def from_json(cls, json):
+    def from_json(cls, json, cast=True):
         headers=[SelectColumn(**header) for header in json.get('headers', [])]
-        rows=[cast_row(Row(**row), headers) for row in json.get('rows', [])]
+        if cast:
+            converters = column_converters(headers)
+            rows=[cast_row(Row(**row), headers, converters) for row in json.get('rows', [])]
+        else:
+            rows=[Row(**row) for row in json.get('rows', [])]
         return cls(headers=headers, rows=rows,
             **{ key: json[key] for key in json.keys() if key not in ['headers', 'rows'] })
 
@@ -781,8 +902,9 @@ class RowSetTable(TableAbstractBaseClass):
 
     def __iter__(self):
         def iterate_rows(rows, headers):
+            converters = column_converters(headers)
             for row in rows:
-                yield cast_values(row, headers)
+                yield cast_values(row, headers, converters)
         return iterate_rows(self.rowset['rows'], self.rowset['headers'])
 
 
@@ -795,20 +917,34 @@ class TableQueryResult(TableAbstractBaseClass):
         results = syn.tableQuery("select * from syn1234")
         for row in results:
             print row
+
+    With *prefetch* set, the following pages of results are fetched in a background thread
+    while the rows of the current page are being processed, so iterating over a large table
+    need not wait on every page::
+
+        results = syn.tableQuery("select * from syn1234", resultsAs="rowset", prefetch=2)
+
+    :param prefetch: How many pages to fetch ahead of the page being read, 0 for none.
+                     At most this many pages are held waiting to be read.
+    :param polling:  Optional dictionary of how to poll for each page, see :py:meth:`synapseclient.Synapse.tableQuery`
     """
-    def __init__(self, synapse, query, limit=None, offset=None, isConsistent=True):
+    def __init__(self, synapse, query, limit=None, offset=None, isConsistent=True, prefetch=0, polling=None):
         self.syn = synapse
 
         self.query = query
         self.limit = limit
         self.offset = offset
         self.isConsistent = isConsistent
+        self.prefetch = prefetch
+        self.polling = polling
+        self._prefetcher = None
 
         result = self.syn._queryTable(
             query=query,
             limit=limit,
             offset=offset,
-            isConsistent=isConsistent)
+            isConsistent=isConsistent,
+            polling=polling)
 
         self.rowset = RowSet.from_json(result['queryResult']['queryResults'])
 
@@ -833,9 +969,11 @@ class TableQueryResult(TableAbstractBaseClass):
         test_import_pandas()
         import pandas as pd
 
-        ## To turn a TableQueryResult into a data frame, we add a page of rows
-        ## at a time on the untested theory that it's more efficient than
-        ## adding a single row at a time to the data frame.
+        ## To turn a TableQueryResult into a data frame, the values of each column
+        ## are collected, a page of rows at a time, into a list per column and the
+        ## data frame is made from the lists once all the pages have been read.
+        ## The first page has already been converted to the columns' types, the
+        ## pages after it are converted a whole column at a time.
 
         def construct_rownames(rowset, offset=0):
             try:
@@ -844,29 +982,22 @@ class TableQueryResult(TableAbstractBaseClass):
                 ## if we don't have row id and version, just number the rows
                 return range(offset,offset+len(rowset['rows']))
 
-        ## first page of rows
-        offset = 0
-        rownames = construct_rownames(self.rowset, offset)
-        offset += len(self.rowset['rows'])
-        series = OrderedDict()
-        for i, header in enumerate(self.rowset["headers"]):
-            column_name = header.name
-            series[column_name] = pd.Series(name=column_name, data=[row['values'][i] for row in self.rowset['rows']], index=rownames)
-
-        # subsequent pages of rows
-        while self.nextPageToken:
-            result = self.syn._queryTableNext(self.nextPageToken, self.tableId)
-            self.rowset = RowSet.from_json(result['queryResults'])
-            self.nextPageToken = result.get('nextPageToken', None)
-            self.i = 0
-
-            rownames = construct_rownames(self.rowset, offset)
-            offset += len(self.rowset['rows'])
-            for i, header in enumerate(self.rowset["headers"]):
-                column_name = header.name
-                series[column_name] = series[column_name].append(pd.Series(name=column_name, data=[row['values'][i] for row in self.rowset['rows']], index=rownames), verify_integrity=True)
+        column_names = [header.name for header in self.rowset["headers"]]
+        columns = [[] for name in column_names]
+        rownames = []
+        cast = False
+        while True:
+            rownames.extend(construct_rownames(self.rowset, len(rownames)))
+            values = list(izip(*[row['values'] for row in self.rowset['rows']]))
+            if values and cast:
+                values = cast_columns(values, self.rowset['headers'])
+            for column, column_values in izip(columns, values):
+                column.extend(column_values)
+            if not self._nextPage(cast=False):
+                break
+            cast = True
 
-        return pd.DataFrame(data=series)
+        return pd.DataFrame(data=OrderedDict(izip(column_names, columns)), index=rownames, columns=column_names)
 
     def asRowSet(self):
         ## Note that as of stack 60, an empty query will omit the headers field
@@ -888,15 +1019,84 @@ class TableQueryResult(TableAbstractBaseClass):
     def next(self):
         self.i += 1
         if self.i >= len(self.rowset['rows']):
-            if self.nextPageToken:
-                result = self.syn._queryTableNext(self.nextPageToken, self.tableId)
-                self.rowset = RowSet.from_json(result['queryResults'])
-                self.nextPageToken = result.get('nextPageToken', None)
-                self.i = 0
-            else:
+            if not self._nextPage():
                 raise StopIteration()
         return self.rowset['rows'][self.i]
 
+    def _nextPage(self, cast=True):
+        """
+        Moves on to the next page of rows, returning False if there are no more pages.
+        Unless *cast* is set, the values of the rows are left as strings.
+        """
+        if not self.nextPageToken:
+            return False
+        if self.prefetch:
+            if self._prefetcher is None:
+                self._prefetcher = _PagePrefetcher(self, self.syn, self.nextPageToken, self.tableId, self.prefetch, self.polling)
+            result = self._prefetcher.next()
+        else:
+            result = self.syn._queryTableNext(self.nextPageToken, self.tableId, polling=self.polling)
+        self.rowset = RowSet.from_json(result['queryResults'], cast=cast)
+        self.nextPageToken = result.get('nextPageToken', None)
+        self.i = 0
+        return True
+
+    def close(self):
+        """
+        Stops fetching pages ahead, for when the rest of the results are not going to be read.
+        Any further pages that are read are fetched one at a time.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+        self.prefetch = 0
+
+
+class _PagePrefetcher(object):
+    """
+    Fetches the pages of a query's results one after another in a background thread,
+    starting on each page as soon as the previous one arrives.  Pages are handed over
+    through a queue holding at most *depth* pages.
+
+    The owner, the result reading the pages, is only weakly referenced, so that a result
+    abandoned without being closed is garbage collected, which stops the thread.
+    """
+    def __init__(self, owner, syn, nextPageToken, tableId, depth, polling=None):
+        self._pages = Queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._owner = weakref.ref(owner, lambda ref, stopped=self._stopped: stopped.set())
+        self._thread = threading.Thread(target=self._fetch, args=(syn, nextPageToken, tableId, polling))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fetch(self, syn, nextPageToken, tableId, polling):
+        while nextPageToken and not self._stopped.is_set():
+            try:
+                result = syn._queryTableNext(nextPageToken, tableId, polling=polling)
+            except Exception:
+                self._put((None, sys.exc_info()))
+                return
+            self._put((result, None))
+            nextPageToken = result.get('nextPageToken', None)
+
+    def _put(self, page):
+        # Wait for room in the queue, giving up if the reader has gone away
+        while not self._stopped.is_set():
+            try:
+                self._pages.put(page, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def next(self):
+        result, exc_info = self._pages.get()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return result
+
+    def close(self):
+        self._stopped.set()
+
 
 class CsvFileTable(TableAbstractBaseClass):
     """
@@ -905,7 +1105,7 @@ class CsvFileTable(TableAbstractBaseClass):
     """
 
     @classmethod
-    def from_table_query(cls, synapse, query, quoteCharacter='"', escapeCharacter="\\", lineEnd=os.linesep, separator=",", header=True, includeRowIdAndRowVersion=True):
+    def from_table_query(cls, synapse, query, quoteCharacter='"', escapeCharacter="\\", lineEnd=os.linesep, separator=",", header=True, includeRowIdAndRowVersion=True, polling=None):
         """
         Create a Table object wrapping a CSV file resulting from querying a Synapse table.
         Mostly for internal use.
@@ -918,7 +1118,8 @@ class CsvFileTable(TableAbstractBaseClass):
             lineEnd=os.linesep,
             separator=separator,
             header=header,
-            includeRowIdAndRowVersion=includeRowIdAndRowVersion)
+            includeRowIdAndRowVersion=includeRowIdAndRowVersion,
+            polling=polling)
 
         ## A dirty hack to find out if we got back row ID and Version
         ## in particular, we don't get these back from aggregate queries
@@ -1193,6 +1394,7 @@ class CsvFileTable(TableAbstractBaseClass):
                     quotechar=self.quoteCharacter)
                 if self.header:
                     header = reader.next()
+                converters = column_converters(headers)
                 for row in reader:
-                    yield cast_values(row, headers)
+                    yield cast_values(row, headers, converters)
         return iterate_rows(self.filepath, self.headers)
@@ -0,0 +1,229 @@
+"""
+**********
+Throttling
+**********
+
+A :py:class:`synapseclient.Synapse` object sends its requests to each endpoint through a
+:py:class:`Throttle`, shared by all of the threads using the object, so that parallel work slows
+down together when Synapse asks it to, rather than each thread backing off on its own.
+Throttled requests are retried once the throttle lets them through, after the wait given by
+the response's Retry-After header, or else after a pause that doubles with each throttled
+response in a row.
+
+A throttle combines a :py:class:`TokenBucket`, which limits the rate of requests, with a
+:py:class:`ConcurrencyLimiter`, which limits how many are in flight.  The concurrency limit
+grows by about one request for each round of successful requests and is halved when Synapse
+responds that it is overloaded or throttling the client (additive increase, multiplicative
+decrease), so that a batch job settles near the largest load the server will take.
+
+Both can be set in the [connection] section of the config file::
+
+    [connection]
+    rate_limit = 20
+    max_concurrency = 10
+
+.. autoclass:: synapseclient.throttle.Throttle
+   :members:
+
+.. autoclass:: synapseclient.throttle.TokenBucket
+   :members:
+
+.. autoclass:: synapseclient.throttle.ConcurrencyLimiter
+   :members:
+
+.. automethod:: synapseclient.throttle.is_throttled
+
+"""
+
+import time
+import threading
+
+from synapseclient.utils import _is_json
+
+
+THROTTLED_STATUS_CODES = (429, 503)
+SLOW_DOWN_PAUSE = 16
+MIN_PAUSE = 1
+MAX_PAUSE = 30
+
+
+def is_throttled(response):
+    """
+    Returns whether a response says Synapse is overloaded or throttling the client: a 429 or 503
+    status, or a message telling the client to slow down.
+    """
+    if response is None:
+        return False
+    if response.status_code in THROTTLED_STATUS_CODES:
+        return True
+    if response.status_code >= 400 and _is_json(response.headers.get('content-type', None)):
+        try:
+            return 'slow down' in (response.json().get('reason', None) or '').lower()
+        except (AttributeError, ValueError):
+            pass
+    return False
+
+
+def _pause_for(response, backoff):
+    ## How long every thread should hold off, as told by the response, or else for the backoff
+    retryAfter = response.headers.get('Retry-After', None)
+    if retryAfter is not None:
+        try:
+            return float(retryAfter)
+        except ValueError:
+            pass
+    return SLOW_DOWN_PAUSE if response.status_code not in THROTTLED_STATUS_CODES else backoff
+
+
+class TokenBucket(object):
+    """
+    Limits requests to a steady rate, allowing bursts of up to burst requests after a lull.
+    Each request reserves the next token, so waiting requests go in the order they arrived.
+
+    :param rate:  Requests per second, or None for no limit
+    :param burst: How many requests may be sent at once, defaulting to one second's worth
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a request may be sent, returning the seconds waited."""
+
+        with self._lock:
+            now = time.time()
+            delay = max(0, self._paused_until - now)
+            if self.rate:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    delay = max(delay, -self._tokens / self.rate)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def pause(self, seconds):
+        """Holds back all requests for the given number of seconds."""
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limits how many requests are in flight at once, adjusting the limit by additive increase
+    and multiplicative decrease.
+
+    :param max_limit: The largest and initial limit
+    :param min_limit: The smallest limit
+    :param decrease:  The factor by which the limit is cut when a request is throttled
+    """
+
+    def __init__(self, max_limit, min_limit=1, decrease=0.5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Waits for a free slot, returning a ticket to be passed to :py:func:`release`."""
+
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                # Waiting with a timeout keeps the wait interruptible by Ctrl-C
+                self._cond.wait(1)
+            self.in_flight += 1
+            return self._epoch
+
+    def release(self, ticket, throttled=False, succeeded=True):
+        """
+        Frees the slot taken by :py:func:`acquire`, growing the limit by 1/limit if the request
+        succeeded or cutting it if it was throttled.  Requests sent before the last cut, whose
+        ticket is older, do not cut it again, so a burst of throttled responses counts once.
+        A request that failed without being throttled leaves the limit as it is.
+        """
+
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                if ticket == self._epoch:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self._epoch += 1
+            elif succeeded:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class Throttle(object):
+    """
+    Paces the requests sent to one endpoint.
+
+    :param rate:            Requests per second, or None for no limit
+    :param burst:           How many requests may be sent at once after a lull
+    :param max_concurrency: How many requests may be in flight at once
+    :param min_concurrency: The fewest requests in flight that throttling may cut down to
+    """
+
+    def __init__(self, rate=None, burst=None, max_concurrency=10, min_concurrency=1):
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = ConcurrencyLimiter(max_concurrency, min_concurrency)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self._backoff = 0
+
+    def acquire(self):
+        """Waits until a request may be sent, returning a ticket to be passed to :py:func:`release`."""
+
+        start = time.time()
+        ticket = self.limiter.acquire()
+        try:
+            self.bucket.acquire()
+        except:
+            self.limiter.release(ticket, succeeded=False)
+            raise
+        with self._lock:
+            self.requests += 1
+            self.waited += time.time() - start
+        return ticket
+
+    def release(self, ticket, response=None):
+        """
+        Reports how a request turned out.
+
+        :param ticket:   As returned by :py:func:`acquire`
+        :param response: The response, or None if there was none, as when the connection failed
+        """
+
+        throttled = is_throttled(response)
+        succeeded = response is not None and response.status_code < 500
+        with self._lock:
+            if throttled:
+                self.throttled += 1
+                self._backoff = min(MAX_PAUSE, self._backoff * 2) if self._backoff else MIN_PAUSE
+                backoff = self._backoff
+            elif succeeded:
+                self._backoff = 0
+        if throttled:
+            self.bucket.pause(_pause_for(response, backoff))
+        self.limiter.release(ticket, throttled, succeeded)
+
+    def stats(self):
+        """Returns a dictionary of the counts of 'requests' and 'throttled' responses, the seconds 'waited', and the 'concurrency' limit and requests 'in_flight'."""
+
+        with self._lock:
+            return {'requests': self.requests,
+                    'throttled': self.throttled,
+                    'waited': self.waited,
+                    'concurrency': self.limiter.limit,
+                    'in_flight': self.limiter.in_flight}
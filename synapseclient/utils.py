@@ -37,6 +37,7 @@ Chunking
 
 .. autoclass:: synapseclient.utils.Chunk
 .. automethod:: synapseclient.utils.chunks
+.. autoclass:: synapseclient.utils.ChunkReader
 
 ~~~~~~~
 Testing
@@ -53,10 +54,13 @@ import math, os, sys, urllib, urlparse, hashlib, re
 import random
 import requests
 import collections
+import itertools
 import tempfile
 import platform
 import functools
+import threading
 import warnings
+from multiprocessing.dummy import Pool as ThreadPool
 from datetime import datetime as Datetime
 from datetime import date as Date
 from numbers import Number
@@ -68,29 +72,59 @@ GB = 2**30
 MB = 2**20
 KB = 2**10
 BUFFER_SIZE = 8*KB
+HASH_BLOCK_SIZE = 8*MB
 
 
-def md5_for_file(filename, block_size=2**20):
+def md5_for_file(filename, block_size=HASH_BLOCK_SIZE):
     """
     Calculates the MD5 of the given file.  See `source <http://stackoverflow.com/questions/1131220/get-md5-hash-of-a-files-without-open-it-in-python>`_.
 
     :param filename:   The file to read in
     :param block_size: How much of the file to read in at once (bytes).
-                       Defaults to 1 MB
+                       Defaults to 8 MB
 
     :returns: The MD5
     """
 
     md5 = hashlib.md5()
-    f = open(filename,'rb')
-    while True:
-        data = f.read(block_size)
-        if not data:
-            break
-        md5.update(data)
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            md5.update(data)
     return(md5)
 
 
+def imap_ordered(function, iterable, max_threads, ahead=2):
+    """
+    Yields function(item) for each item of the iterable, in order, calling the function on a
+    pool of threads.  No more than ahead * max_threads items are taken from the iterable before
+    their results have been yielded, so neither the calls nor their results run away from a slow
+    consumer, and an iterable that never ends is fine.  Exceptions are raised as their results
+    are reached.  Closing the generator stops the threads once their calls in flight are done.
+
+    :param function:    Function of one argument
+    :param iterable:    The arguments to call it with
+    :param max_threads: How many calls to make at once
+    :param ahead:       How many results per thread may be waiting to be yielded
+    """
+
+    items = iter(iterable)
+    pool = ThreadPool(max_threads)
+    pending = collections.deque()
+    try:
+        for item in itertools.islice(items, ahead * max_threads):
+            pending.append(pool.apply_async(function, (item,)))
+        while pending:
+            result = pending.popleft().get()
+            for item in itertools.islice(items, 1):
+                pending.append(pool.apply_async(function, (item,)))
+            yield result
+    finally:
+        pool.terminate()
+
+
 def download_file(url, localFilepath=None):
     """
     Downloads a remote file.
@@ -464,6 +498,39 @@ def get_chunk(filepath, chunknumber, chunksize=5*MB):
         return f.read(chunksize)
 
 
+class ChunkReader(object):
+    """
+    Reads numbered chunks of a file through a single open file handle, rather
+    than reopening the file for every chunk as :py:func:`get_chunk` does.
+    Chunks can be read safely from several threads. Use with :py:func:`nchunks`::
+
+        with ChunkReader(filepath) as reader:
+            for i in range(1, nchunks(filepath)+1):
+                upload(reader.read(i))
+    """
+
+    def __init__(self, filepath, chunksize=5*MB):
+        self.filepath = filepath
+        self.chunksize = chunksize
+        self._file = open(filepath, 'rb')
+        self._lock = threading.Lock()
+
+    def read(self, chunknumber):
+        """Returns the contents of the given chunk, numbered from 1."""
+        with self._lock:
+            self._file.seek((chunknumber-1)*self.chunksize)
+            return self._file.read(self.chunksize)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def itersubclasses(cls, _seen=None):
     """
     http://code.activestate.com/recipes/576949/ (r3)
@@ -671,6 +738,18 @@ def humanizeBytes(bytes):
     return 'Oops larger than Exabytes'
 
 
+def parse_bytes(size):
+    """
+    Converts a size such as '500GB', '1.5 TB' or '1024' into a number of bytes.
+    Units are powers of 1024, as in :py:func:`humanizeBytes`.
+    """
+    units = {'': 1, 'B': 1, 'BYTES': 1, 'KB': KB, 'MB': MB, 'GB': GB, 'TB': 2**40, 'PB': 2**50}
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([a-zA-Z]*)\s*$', str(size))
+    if not match or match.group(2).upper() not in units:
+        raise ValueError('Not a size in bytes: "%s"' % size)
+    return int(float(match.group(1)) * units[match.group(2).upper()])
+
+
 def _is_json(content_type):
     """detect if a content-type is JSON"""
     ## The value of Content-Type defined here:
@@ -0,0 +1,87 @@
+"""
+Benchmarks REST calls per second against a local stub server, with a new
+connection per call versus the pooled session owned by a Synapse object.
+"""
+import synapseclient
+import BaseHTTPServer
+import SocketServer
+import threading
+import requests
+import argparse
+import time
+import os
+
+
+N_CALLS = 200
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    ## send each response in a single write, or Nagle's algorithm stalls keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = '{"id":"syn123","name":"stub"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def setup(module):
+    print '\n'
+    print '~' * 60
+    print os.path.basename(__file__)
+    print '~' * 60
+
+
+def _calls_per_second(function, n):
+    start = time.time()
+    for i in range(n):
+        function()
+    return n / (time.time() - start)
+
+
+def test_connection_pool(n=N_CALLS):
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        endpoint = 'http://127.0.0.1:%d/repo/v1' % server.server_address[1]
+        syn = synapseclient.Synapse(repoEndpoint=endpoint, authEndpoint=endpoint,
+                                    fileHandleEndpoint=endpoint, skip_checks=True)
+        syn.username, syn.apiKey = 'benchmark', 'secret'
+        url = endpoint + '/entity/syn123'
+
+        before = _calls_per_second(lambda: requests.get(url, headers=syn._generateSignedHeaders(url)), n)
+        after = _calls_per_second(lambda: syn.restGET('/entity/syn123'), n)
+
+        print 'new connection per call: %8.1f calls/sec' % before
+        print 'pooled session:          %8.1f calls/sec' % after
+    finally:
+        if 'syn' in locals():
+            syn._requests_session.close()
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks pooled REST calls against a local stub server.')
+    parser.add_argument('-n', type=int, default=5000, help='number of calls to make in each mode')
+    args = parser.parse_args()
+    test_connection_pool(n=args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Benchmarks the throughput of hashing large files, comparing the original
+1 MB read loop with md5_for_file, hashing by mmap and hashing several
+files at once with cache.md5_for_files, with the MD5 cache turned off.
+"""
+import synapseclient.cache as cache
+import synapseclient.utils as utils
+from synapseclient.utils import MB, GB
+import argparse
+import hashlib
+import mmap
+import time
+import os
+
+
+FILE_SIZE = 64*MB
+N_FILES = 4
+
+
+def setup(module):
+    print '\n'
+    print '~' * 60
+    print os.path.basename(__file__)
+    print '~' * 60
+
+
+def _md5_in_1mb_blocks(filename):
+    ## how md5_for_file used to read files
+    md5 = hashlib.md5()
+    f = open(filename, 'rb')
+    while True:
+        data = f.read(MB)
+        if not data:
+            break
+        md5.update(data)
+    return md5.hexdigest()
+
+
+def _md5_by_mmap(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            md5.update(mapped)
+        finally:
+            mapped.close()
+    return md5.hexdigest()
+
+
+def _megabytes_per_second(function, filenames):
+    start = time.time()
+    function(filenames)
+    return sum(os.path.getsize(filename) for filename in filenames) / MB / (time.time() - start)
+
+
+def test_hashing(size=FILE_SIZE, n_files=N_FILES):
+    filenames = []
+    cache.MD5_CACHE_ENABLED = False
+    try:
+        for i in range(n_files):
+            filenames.append(utils.make_bogus_binary_file(n=size))
+        expected = dict((filename, _md5_in_1mb_blocks(filename)) for filename in filenames)
+
+        one_at_a_time = lambda md5: lambda filenames: [md5(filename) for filename in filenames]
+        results = [('1 MB blocks',    _megabytes_per_second(one_at_a_time(_md5_in_1mb_blocks), filenames)),
+                   ('md5_for_file',   _megabytes_per_second(one_at_a_time(lambda filename: utils.md5_for_file(filename).hexdigest()), filenames)),
+                   ('mmap',           _megabytes_per_second(one_at_a_time(_md5_by_mmap), filenames)),
+                   ('md5_for_files',  _megabytes_per_second(cache.md5_for_files, filenames))]
+        assert cache.md5_for_files(filenames) == expected
+
+        print '%d files of %d MB' % (n_files, size / MB)
+        for name, rate in results:
+            print '%-15s %8.1f MB/sec' % (name + ':', rate)
+    finally:
+        cache.MD5_CACHE_ENABLED = True
+        for filename in filenames:
+            os.remove(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks hashing large files.')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 10], help='sizes of the files in GB')
+    parser.add_argument('-n', type=int, default=N_FILES, help='number of files of each size')
+    args = parser.parse_args()
+    for size in args.sizes:
+        test_hashing(size=int(size*GB), n_files=args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmarks converting a many-paged table query result to a DataFrame, comparing
+appending each page to a Series per column, as asDataFrame used to, with
+TableQueryResult.asDataFrame.
+"""
+from synapseclient.table import TableQueryResult, RowSet, row_labels_from_rows
+from collections import OrderedDict
+import argparse
+import time
+import os
+
+
+N_PAGES = 50
+ROWS_PER_PAGE = 1000
+
+HEADERS = [{'columnType': 'STRING',  'name': 'name'},
+           {'columnType': 'INTEGER', 'name': 'count'},
+           {'columnType': 'DOUBLE',  'name': 'score'},
+           {'columnType': 'BOOLEAN', 'name': 'flag'}]
+
+
+def setup(module):
+    print '\n'
+    print '~' * 60
+    print os.path.basename(__file__)
+    print '~' * 60
+
+
+class SyntheticSynapse(object):
+    """Serves pages of made up rows in place of a table query"""
+
+    def __init__(self, n_pages, rows_per_page):
+        self.n_pages = n_pages
+        self.rows_per_page = rows_per_page
+
+    def _page(self, i):
+        first = i * self.rows_per_page
+        rows = [{'rowId': n, 'versionNumber': 1,
+                 'values': ['name%d' % n, str(n), str(n / 7.0), 'true' if n % 2 else 'false']}
+                for n in range(first, first + self.rows_per_page)]
+        return {'queryResults': {'etag': 'etag', 'tableId': 'syn123', 'headers': HEADERS, 'rows': rows},
+                'nextPageToken': {'page': i + 1} if i + 1 < self.n_pages else None}
+
+    def _queryTable(self, query, limit=None, offset=None, isConsistent=True, partMask=None, polling=None):
+        return {'queryResult': self._page(0)}
+
+    def _queryTableNext(self, nextPageToken, tableId, polling=None):
+        return self._page(nextPageToken['page'])
+
+
+def _append_pages(result):
+    ## how asDataFrame used to assemble the data frame
+    import pandas as pd
+    series = OrderedDict()
+    for i, header in enumerate(result.rowset["headers"]):
+        series[header.name] = pd.Series(name=header.name, data=[row['values'][i] for row in result.rowset['rows']],
+                                        index=row_labels_from_rows(result.rowset['rows']))
+    while result.nextPageToken:
+        page = result.syn._queryTableNext(result.nextPageToken, result.tableId)
+        result.rowset = RowSet.from_json(page['queryResults'])
+        result.nextPageToken = page.get('nextPageToken', None)
+        rownames = row_labels_from_rows(result.rowset['rows'])
+        for i, header in enumerate(result.rowset["headers"]):
+            series[header.name] = series[header.name].append(
+                pd.Series(name=header.name, data=[row['values'][i] for row in result.rowset['rows']], index=rownames),
+                verify_integrity=True)
+    return pd.DataFrame(data=series)
+
+
+def _seconds(function, syn):
+    result = TableQueryResult(syn, "select * from syn123")
+    start = time.time()
+    df = function(result)
+    return time.time() - start, df
+
+
+def test_table_query_dataframe(n_pages=N_PAGES, rows_per_page=ROWS_PER_PAGE):
+    syn = SyntheticSynapse(n_pages, rows_per_page)
+
+    before, expected = _seconds(_append_pages, syn)
+    after, df = _seconds(lambda result: result.asDataFrame(), syn)
+    assert df.shape == (n_pages * rows_per_page, len(HEADERS))
+    assert df.equals(expected[df.columns])
+
+    print '%d pages of %d rows' % (n_pages, rows_per_page)
+    print 'appending pages: %8.2f sec' % before
+    print 'asDataFrame:     %8.2f sec' % after
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks making a DataFrame of a many-paged table query.')
+    parser.add_argument('--pages', type=int, default=200, help='number of pages of results')
+    parser.add_argument('--rows', type=int, default=5000, help='number of rows in each page')
+    args = parser.parse_args()
+    test_table_query_dataframe(n_pages=args.pages, rows_per_page=args.rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
-import re, os, tempfile, json
+import re, os, tempfile, json, shutil
 import time, calendar
+import threading
 from mock import MagicMock, patch
 from nose.tools import assert_raises
 
 import synapseclient
 import synapseclient.cache as cache
+import synapseclient.utils as utils
 
 
 def setup():
@@ -174,3 +176,341 @@ def test_get_modification_time():
     path = tempfile.mkdtemp()
     # print "Now = %f | File = %f" % (calendar.timegm(time.gmtime()), cache.get_modification_time(path))
     assert cache.get_modification_time(path) - calendar.timegm(time.gmtime()) < ALLOWABLE_TIME_ERROR
+
+
+def test_cache_index():
+    oldCacheDir = cache.CACHE_DIR
+    oldIndexEnabled = cache.CACHE_INDEX_ENABLED
+    try:
+        cache.CACHE_DIR = tempfile.mkdtemp()
+        cache.CACHE_INDEX_ENABLED = True
+
+        # An existing '.cacheMap' is carried over into the index
+        cacheDir = cache.determine_cache_directory('1337')
+        _, oldFile = tempfile.mkstemp()
+        oldFile = utils.normalize_path(oldFile)
+        cache.obtain_lock_and_read_cache(cacheDir)
+        cache.write_cache_then_release_lock(cacheDir, {oldFile: time.strftime(utils.ISO_FORMAT, time.gmtime(os.path.getmtime(oldFile)))})
+        entries = list(cache.iterator_over_cache_map(cacheDir))
+        assert len(entries) == 1
+        assert entries[0][0] == oldFile
+        assert entries[0][1] == cache.get_modification_time(oldFile)
+
+        # New entries go to the index rather than the '.cacheMap'
+        _, newFile = tempfile.mkstemp()
+        newFile = utils.normalize_path(newFile)
+        cache.add_local_file_to_cache(path=newFile, dataFileHandleId='1337')
+        assert sorted(file for file, _, _ in cache.iterator_over_cache_map(cacheDir)) == sorted([oldFile, newFile])
+        assert newFile not in cache.obtain_lock_and_read_cache(cacheDir)
+        cache.write_cache_then_release_lock(cacheDir)
+        assert os.path.exists(os.path.join(cache.CACHE_DIR, cache.CACHE_INDEX_NAME))
+
+        # The index is shared by threads, each with their own connection
+        def remove_from_thread():
+            cache.get_cache_index().remove('1337', oldFile)
+        thread = threading.Thread(target=remove_from_thread)
+        thread.start()
+        thread.join()
+        assert [file for file, _, _ in cache.iterator_over_cache_map(cacheDir)] == [newFile]
+    finally:
+        cache.CACHE_DIR = oldCacheDir
+        cache.CACHE_INDEX_ENABLED = oldIndexEnabled
+
+
+def _add_file_to_cache(fileHandleId, size, lastAccess):
+    cacheDir = cache.determine_cache_directory(fileHandleId)
+    os.makedirs(cacheDir)
+    path = utils.normalize_path(os.path.join(cacheDir, 'file%s.bin' % fileHandleId))
+    with open(path, 'wb') as f:
+        f.write('x' * size)
+    cache.add_local_file_to_cache(path=path, dataFileHandleId=fileHandleId)
+    os.utime(path, (lastAccess, lastAccess))
+    return path
+
+
+def test_purge_cache():
+    oldCacheDir = cache.CACHE_DIR
+    try:
+        cache.CACHE_DIR = tempfile.mkdtemp()
+        now = time.time()
+        oldest = _add_file_to_cache('1001', 1000, now - 300)
+        older = _add_file_to_cache('1002', 1000, now - 200)
+        newest = _add_file_to_cache('1003', 1000, now - 100)
+
+        assert sorted(path for _, path, _, _ in cache.iterator_over_cached_files()) == sorted([oldest, older, newest])
+
+        # A dry run leaves everything in place
+        assert cache.purge_cache(max_size=1500, dry_run=True) == [(oldest, 1000), (older, 1000)]
+        assert os.path.exists(oldest)
+
+        # Least recently used files go first, except the ones to keep
+        assert cache.purge_cache(max_size=1500, keep=[oldest]) == [(older, 1000), (newest, 1000)]
+        assert os.path.exists(oldest)
+        assert not os.path.exists(older)
+        assert list(cache.iterator_over_cache_map(cache.determine_cache_directory('1002'))) == []
+
+        # Purging by age
+        assert cache.purge_cache(accessed_before=now - 250) == [(oldest, 1000)]
+        assert list(cache.iterator_over_cached_files()) == []
+    finally:
+        cache.CACHE_DIR = oldCacheDir
+
+
+def test_purge_cache_leaves_transfers_in_progress():
+    oldCacheDir = cache.CACHE_DIR
+    try:
+        cache.CACHE_DIR = tempfile.mkdtemp()
+        now = time.time()
+        downloading = _add_file_to_cache('1001', 1000, now - 300)
+        resuming = _add_file_to_cache('1002', 1000, now - 200)
+        idle = _add_file_to_cache('1003', 1000, now - 100)
+        ## the sidecar of a download in ranges, and a half written journal
+        cache.write_partial_download(resuming, {'size': 1000}, [])
+        with open(idle + '.tmp', 'w') as f:
+            f.write('{')
+
+        assert sorted(path for _, path, _, _ in cache.iterator_over_cached_files()) == sorted([downloading, resuming, idle])
+        with cache.transfer_in_progress(downloading):
+            assert cache.purge_cache(max_size=0) == [(idle, 1000)]
+        assert os.path.exists(resuming + cache.PARTIAL_DOWNLOAD_SUFFIX)
+        assert cache.purge_cache(max_size=0) == [(downloading, 1000)]
+    finally:
+        shutil.rmtree(cache.CACHE_DIR)
+        cache.CACHE_DIR = oldCacheDir
+
+
+def test_purge_cache_with_index():
+    oldCacheDir = cache.CACHE_DIR
+    oldIndexEnabled = cache.CACHE_INDEX_ENABLED
+    try:
+        cache.CACHE_DIR = tempfile.mkdtemp()
+        cache.CACHE_INDEX_ENABLED = True
+        now = time.time()
+        with patch('time.time', side_effect=[now - 300, now - 200, now - 100]):
+            oldest = _add_file_to_cache('1001', 1000, now)
+            older = _add_file_to_cache('1002', 1000, now)
+            newest = _add_file_to_cache('1003', 1000, now)
+        ## files outside the cache directory are not counted
+        _, outside = tempfile.mkstemp()
+        with open(outside, 'w') as f:
+            f.write('x' * 5000)
+        cache.add_local_file_to_cache(path=outside, dataFileHandleId='1004')
+        index = cache.get_cache_index()
+        assert index.total_size(cache.CACHE_DIR) == 3000
+
+        ## no purge is needed, so the cache directory is not walked
+        with patch('synapseclient.cache.iterator_over_cached_files') as walk:
+            assert cache.purge_cache(max_size=3000) == []
+            assert cache.purge_cache(max_size=1500) == [(oldest, 1000), (older, 1000)]
+            assert not walk.called
+        assert index.total_size(cache.CACHE_DIR) == 1000
+        assert os.path.exists(newest) and os.path.exists(outside)
+
+        ## files removed behind the cache's back are forgotten
+        os.remove(newest)
+        assert cache.purge_cache(max_size=0) == []
+        assert index.total_size(cache.CACHE_DIR) == 0
+        os.remove(outside)
+    finally:
+        shutil.rmtree(cache.CACHE_DIR)
+        cache.CACHE_DIR = oldCacheDir
+        cache.CACHE_INDEX_ENABLED = oldIndexEnabled
+
+
+def test_purge_cache_walks_only_when_it_may_be_too_big():
+    oldCacheDir = cache.CACHE_DIR
+    try:
+        cache.CACHE_DIR = tempfile.mkdtemp()
+        now = time.time()
+        oldest = _add_file_to_cache('1001', 1000, now - 300)
+        walk = MagicMock(side_effect=cache.iterator_over_cached_files)
+        with patch('synapseclient.cache.iterator_over_cached_files', walk):
+            ## the first purge counts the cache, the ones after go by the count
+            assert cache.purge_cache(max_size=2500) == []
+            _add_file_to_cache('1002', 1000, now - 200)
+            assert cache.purge_cache(max_size=2500) == []
+            assert walk.call_count == 1
+
+            ## going over the limit, the cache is walked again
+            _add_file_to_cache('1003', 1000, now - 100)
+            assert cache.purge_cache(max_size=2500) == [(oldest, 1000)]
+            assert cache.purge_cache(max_size=2500) == []
+            assert walk.call_count == 2
+    finally:
+        shutil.rmtree(cache.CACHE_DIR)
+        cache.CACHE_DIR = oldCacheDir
+
+
+def test_purge_cache_with_index_counts_cache_maps():
+    oldCacheDir = cache.CACHE_DIR
+    oldIndexEnabled = cache.CACHE_INDEX_ENABLED
+    try:
+        cache.CACHE_DIR = tempfile.mkdtemp()
+        now = time.time()
+        ## files cached before the index was enabled, which it hasn't looked up yet
+        cache.CACHE_INDEX_ENABLED = False
+        older = _add_file_to_cache('1001', 1000, now - 200)
+        newer = _add_file_to_cache('1002', 1000, now - 100)
+        for fileHandleId, path in [('1001', older), ('1002', newer)]:
+            cache.add_local_file_to_cache(path=path, dataFileHandleId=fileHandleId)
+        cache.CACHE_INDEX_ENABLED = True
+        assert cache.get_cache_index().total_size(cache.CACHE_DIR) == 2000
+        assert cache.purge_cache(max_size=1000) == [(older, 1000)]
+        assert os.path.exists(newer)
+    finally:
+        shutil.rmtree(cache.CACHE_DIR)
+        cache.CACHE_DIR = oldCacheDir
+        cache.CACHE_INDEX_ENABLED = oldIndexEnabled
+
+
+def test_remove_local_file_from_cache_leaves_files_outside_the_cache():
+    oldCacheDir = cache.CACHE_DIR
+    try:
+        cache.CACHE_DIR = tempfile.mkdtemp()
+        _, path = tempfile.mkstemp()
+        cache.add_local_file_to_cache(path=path, dataFileHandleId='1001')
+        assert len(list(cache.iterator_over_cache_map(cache.determine_cache_directory('1001')))) == 1
+
+        cache.remove_local_file_from_cache(path, {'id': '1001'})
+        assert list(cache.iterator_over_cache_map(cache.determine_cache_directory('1001'))) == []
+        assert os.path.exists(path)
+    finally:
+        cache.CACHE_DIR = oldCacheDir
+
+
+def test_md5_cache():
+    oldCacheDir = cache.CACHE_DIR
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache.CACHE_DIR = os.path.join(tmpdir, 'cache')
+        path = os.path.join(tmpdir, 'file.txt')
+        with open(path, 'w') as f:
+            f.write('some content')
+        expected = utils.md5_for_file(path).hexdigest()
+
+        ## A file modified moments ago is hashed but not remembered
+        assert cache.md5_for_file(path) == expected
+        assert cache.lookup_md5(path) is None
+
+        ## Once it is older, its MD5 is remembered and the file isn't hashed again
+        hourAgo = time.time() - 3600
+        os.utime(path, (hourAgo, hourAgo))
+        assert cache.md5_for_file(path) == expected
+        assert cache.lookup_md5(path) == expected
+        assert os.path.exists(os.path.join(cache.CACHE_DIR, cache.MD5_CACHE_NAME))
+        with patch('synapseclient.utils.md5_for_file') as md5_mock:
+            assert cache.md5_for_file(path) == expected
+            assert not md5_mock.called
+
+        ## Moving the file keeps its entry
+        moved = os.path.join(tmpdir, 'moved.txt')
+        os.rename(path, moved)
+        assert cache.lookup_md5(moved) == expected
+
+        ## Modifying the file invalidates it
+        with open(moved, 'a') as f:
+            f.write(' and some more')
+        os.utime(moved, (hourAgo, hourAgo + 1))
+        assert cache.lookup_md5(moved) is None
+        assert cache.md5_for_file(moved) == utils.md5_for_file(moved).hexdigest()
+
+        ## The cache can be turned off
+        cache.MD5_CACHE_ENABLED = False
+        assert cache.lookup_md5(moved) is None
+    finally:
+        cache.MD5_CACHE_ENABLED = True
+        cache.CACHE_DIR = oldCacheDir
+        shutil.rmtree(tmpdir)
+
+
+def test_md5_cache_that_cannot_be_opened():
+    oldCacheDir = cache.CACHE_DIR
+    oldMd5CacheEnabled = cache.MD5_CACHE_ENABLED
+    try:
+        ## the cache directory can't be created, as a file is in its way
+        _, cache.CACHE_DIR = tempfile.mkstemp()
+        cache.CACHE_DIR = os.path.join(cache.CACHE_DIR, 'cache')
+        cache.MD5_CACHE_ENABLED = True
+        _, path = tempfile.mkstemp()
+        with open(path, 'w') as f:
+            f.write('some bytes')
+        os.utime(path, (time.time() - 3600, time.time() - 3600))
+        expected = utils.md5_for_file(path).hexdigest()
+
+        ## the files are hashed, with a warning
+        with patch('warnings.warn') as warn:
+            assert cache.md5_for_file(path) == expected
+            assert cache.lookup_md5(path) is None
+            assert cache.md5_for_files([path]) == {path: expected}
+            assert warn.called
+    finally:
+        os.remove(os.path.dirname(cache.CACHE_DIR))
+        os.remove(path)
+        cache.CACHE_DIR = oldCacheDir
+        cache.MD5_CACHE_ENABLED = oldMd5CacheEnabled
+
+
+def test_md5_for_files():
+    oldCacheDir = cache.CACHE_DIR
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache.CACHE_DIR = os.path.join(tmpdir, 'cache')
+        hourAgo = time.time() - 3600
+        paths = []
+        for i in range(5):
+            path = os.path.join(tmpdir, 'file%d.txt' % i)
+            with open(path, 'w') as f:
+                f.write('contents of file %d' % i)
+            os.utime(path, (hourAgo, hourAgo))
+            paths.append(path)
+        expected = dict((path, utils.md5_for_file(path).hexdigest()) for path in paths)
+
+        ## One file is already known, the others are hashed by a pool of threads
+        cache.md5_for_file(paths[0])
+        assert cache.md5_for_files(paths + [paths[1]], max_threads=2) == expected
+        for path in paths:
+            assert cache.lookup_md5(path) == expected[path]
+
+        with patch('synapseclient.cache.ThreadPool') as pool_mock:
+            assert cache.md5_for_files(paths) == expected
+            assert not pool_mock.called
+        assert cache.md5_for_files([]) == {}
+
+        ## Empty and multi-block files, without the cache
+        cache.MD5_CACHE_ENABLED = False
+        filenames = [utils.make_bogus_binary_file(n=n) for n in (0, 1000, 3*utils.MB)]
+        try:
+            md5s = cache.md5_for_files(filenames, max_threads=2)
+            assert md5s == dict((filename, utils.md5_for_file(filename, block_size=4096).hexdigest()) for filename in filenames)
+            assert md5s[filenames[0]] == 'd41d8cd98f00b204e9800998ecf8427e'
+        finally:
+            for filename in filenames:
+                os.remove(filename)
+    finally:
+        cache.MD5_CACHE_ENABLED = True
+        cache.CACHE_DIR = oldCacheDir
+        shutil.rmtree(tmpdir)
+
+
+def test_user_name_cache():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prod, staging = 'https://repo-prod.example.org', 'https://repo-staging.example.org'
+        userNames = cache.UserNameCache(tmpdir, ttl=60)
+        assert userNames.get_many(['1', '2'], prod) == {}
+        userNames.put_many({1: 'alice', '2': u'b\xf6b'}, prod)
+        assert userNames.get_many([1, '2', '3'], prod) == {'1': 'alice', '2': u'b\xf6b'}
+        assert userNames.get_many([str(i) for i in range(2000)], prod) == {'1': 'alice', '2': u'b\xf6b'}
+
+        ## Principal IDs are only unique within one endpoint
+        assert userNames.get_many(['1', '2'], staging) == {}
+        userNames.put_many({1: 'carol'}, staging)
+        assert userNames.get_many(['1'], staging) == {'1': 'carol'}
+        assert userNames.get_many(['1'], prod) == {'1': 'alice'}
+
+        ## Names are remembered across instances, until they expire
+        assert cache.UserNameCache(tmpdir).get_many(['1'], prod) == {'1': 'alice'}
+        with patch('time.time', return_value=time.time() + 61):
+            assert userNames.get_many(['1', '2'], prod) == {}
+    finally:
+        shutil.rmtree(tmpdir)
@@ -1,7 +1,13 @@
+import synapseclient
 import synapseclient.utils as utils
 import filecmp
 import tempfile
+import threading
+import hashlib
+import json
+from nose.tools import assert_raises
 import os
+from mock import MagicMock, patch
 
 from synapseclient.utils import GB, MB, KB, nchunks, get_chunk
 
@@ -27,3 +33,261 @@ def test_chunks():
         if 'out' in locals() and out:
             os.remove(out.name)
 
+
+
+def test_parallel_chunked_upload():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn._createChunkedFileUploadToken = MagicMock(return_value={'key': 'token'})
+    syn._createChunkedFileUploadChunkURL = MagicMock(side_effect=lambda i, token: 'https://s3/chunk/%d' % i)
+    syn._startCompleteUploadDaemon = MagicMock(return_value={'state': 'COMPLETED', 'fileHandleId': '1234'})
+    syn._getFileHandle = MagicMock(return_value={'id': '1234'})
+
+    put_lock = threading.Lock()
+    chunks_put = {}
+    def put(url, data, headers):
+        with put_lock:
+            chunks_put[url] = data
+        response = MagicMock()
+        response.status_code = 200
+        response.text = ''
+        return response
+    syn._requests_session = MagicMock()
+    syn._requests_session.put.side_effect = put
+
+    try:
+        filepath = utils.make_bogus_binary_file(n=12*MB)
+        fileHandle = syn._chunkedUploadFile(filepath, chunksize=5*MB, max_threads=3, resume=False)
+
+        assert fileHandle == {'id': '1234'}
+        assert syn._startCompleteUploadDaemon.call_args[1]['chunkNumbers'] == [1, 2, 3]
+        with open(filepath, 'rb') as f:
+            assert chunks_put['https://s3/chunk/1'] == f.read(5*MB)
+            assert chunks_put['https://s3/chunk/2'] == f.read(5*MB)
+            assert chunks_put['https://s3/chunk/3'] == f.read(5*MB)
+    finally:
+        if 'filepath' in locals() and filepath:
+            os.remove(filepath)
+
+
+def test_chunked_upload_of_a_file_with_a_known_md5():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn._createChunkedFileUploadToken = MagicMock(return_value={'key': 'token'})
+    syn._createChunkedFileUploadChunkURL = MagicMock(side_effect=lambda i, token: 'https://s3/chunk/%d' % i)
+    syn._startCompleteUploadDaemon = MagicMock(return_value={'state': 'COMPLETED', 'fileHandleId': '1234'})
+    syn._getFileHandle = MagicMock(return_value={'id': '1234'})
+    response = MagicMock()
+    response.status_code = 200
+    response.text = ''
+    syn._requests_session = MagicMock()
+    syn._requests_session.put.return_value = response
+
+    try:
+        filepath = utils.make_bogus_binary_file(n=7*MB)
+        ## the MD5 comes from the MD5 cache, and the file is only read to upload it
+        with patch('synapseclient.cache.md5_for_file', return_value='0123456789abcdef0123456789abcdef'):
+            fileHandle = syn._chunkedUploadFile(filepath, chunksize=5*MB, max_threads=1, resume=False)
+
+        assert fileHandle == {'id': '1234'}
+        assert syn._createChunkedFileUploadToken.call_args[1]['md5'] == '0123456789abcdef0123456789abcdef'
+        assert syn._startCompleteUploadDaemon.call_args[1]['chunkNumbers'] == [1, 2]
+    finally:
+        if 'filepath' in locals() and filepath:
+            os.remove(filepath)
+
+
+def test_chunk_reader():
+    try:
+        filepath = utils.make_bogus_binary_file(n=1*MB)
+        chunksize = 300*KB
+
+        with utils.ChunkReader(filepath, chunksize=chunksize) as reader:
+            ## read out of order to make sure each read seeks
+            for i in reversed(range(1, nchunks(filepath, chunksize=chunksize)+1)):
+                assert reader.read(i) == get_chunk(filepath, i, chunksize=chunksize)
+    finally:
+        if 'filepath' in locals() and filepath:
+            os.remove(filepath)
+
+
+def test_resume_chunked_upload():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn._createChunkedFileUploadToken = MagicMock(side_effect=[{'key': 'token-1'}, {'key': 'token-2'}])
+    syn._createChunkedFileUploadChunkURL = MagicMock(side_effect=lambda i, token: 'https://s3/%s/%d' % (token['key'], i))
+    syn._startCompleteUploadDaemon = MagicMock(return_value={'state': 'COMPLETED', 'fileHandleId': '1234'})
+    syn._getFileHandle = MagicMock(return_value={'id': '1234'})
+
+    urls_put = []
+    failing_urls = set(['https://s3/token-1/3'])
+    def put(url, data, headers):
+        urls_put.append(url)
+        response = MagicMock()
+        response.status_code = 403 if url in failing_urls else 200
+        response.reason = 'Forbidden'
+        response.headers = {}
+        response.text = ''
+        return response
+    syn._requests_session = MagicMock()
+    syn._requests_session.put.side_effect = put
+
+    oldCacheDir = synapseclient.cache.CACHE_DIR
+    try:
+        synapseclient.cache.CACHE_DIR = tempfile.mkdtemp()
+        filepath = utils.make_bogus_binary_file(n=12*MB)
+        journalPath = synapseclient.cache.upload_journal_path(filepath, 5*MB, 'application/octet-stream')
+
+        ## the upload dies on the last chunk, leaving a journal of the first two
+        assert_raises(synapseclient.exceptions.SynapseHTTPError, syn._chunkedUploadFile, filepath, chunksize=5*MB, max_threads=1)
+        with open(journalPath) as f:
+            assert json.load(f)['completedChunks'] == [1, 2]
+
+        ## a second attempt uploads only the missing chunk
+        failing_urls.clear()
+        del urls_put[:]
+        fileHandle = syn._chunkedUploadFile(filepath, chunksize=5*MB, max_threads=1)
+        assert fileHandle == {'id': '1234'}
+        assert urls_put == ['https://s3/token-1/3']
+        assert syn._createChunkedFileUploadToken.call_count == 1
+        assert syn._startCompleteUploadDaemon.call_args[1]['chunkNumbers'] == [1, 2, 3]
+        assert not os.path.exists(journalPath)
+    finally:
+        synapseclient.cache.CACHE_DIR = oldCacheDir
+        if 'filepath' in locals() and filepath:
+            os.remove(filepath)
+
+
+def test_resume_chunked_upload_with_rejected_token():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn._createChunkedFileUploadToken = MagicMock(return_value={'key': 'new-token'})
+    syn._startCompleteUploadDaemon = MagicMock(return_value={'state': 'COMPLETED', 'fileHandleId': '1234'})
+    syn._getFileHandle = MagicMock(return_value={'id': '1234'})
+
+    def chunk_url(i, token):
+        if token['key'] == 'expired-token':
+            response = MagicMock()
+            response.status_code = 404
+            raise synapseclient.exceptions.SynapseHTTPError('Not found', response=response)
+        return 'https://s3/chunk/%d' % i
+    syn._createChunkedFileUploadChunkURL = MagicMock(side_effect=chunk_url)
+
+    response = MagicMock()
+    response.status_code = 200
+    response.text = ''
+    syn._requests_session = MagicMock()
+    syn._requests_session.put.return_value = response
+
+    oldCacheDir = synapseclient.cache.CACHE_DIR
+    try:
+        synapseclient.cache.CACHE_DIR = tempfile.mkdtemp()
+        filepath = utils.make_bogus_binary_file(n=12*MB)
+        md5 = utils.md5_for_file(filepath).hexdigest()
+        fingerprint = {'size': os.stat(filepath).st_size, 'mtime': os.path.getmtime(filepath), 'md5': md5}
+        journalPath = synapseclient.cache.upload_journal_path(filepath, 5*MB, 'application/octet-stream')
+        synapseclient.cache.write_upload_journal(journalPath,
+            {'fingerprint': fingerprint, 'token': {'key': 'expired-token'}, 'completedChunks': [1]})
+
+        fileHandle = syn._chunkedUploadFile(filepath, chunksize=5*MB, max_threads=1)
+        assert fileHandle == {'id': '1234'}
+        assert syn._startCompleteUploadDaemon.call_args[1]['chunkedFileToken'] == {'key': 'new-token'}
+        assert syn._startCompleteUploadDaemon.call_args[1]['chunkNumbers'] == [1, 2, 3]
+        assert syn._requests_session.put.call_count == 3
+    finally:
+        synapseclient.cache.CACHE_DIR = oldCacheDir
+        if 'filepath' in locals() and filepath:
+            os.remove(filepath)
+
+
+def _mock_ranged_download_session(content, failing_ranges):
+    ## Mimics the redirect from Synapse to S3, followed by range requests to S3
+    ranges_requested = []
+    def get(url, headers=None, allow_redirects=True, stream=False):
+        response = MagicMock()
+        response.headers = {}
+        if not allow_redirects:
+            response.status_code = 302
+            response.headers['location'] = 'https://s3/file.bin'
+        elif 'Range' in headers:
+            ranges_requested.append(headers['Range'])
+            start, end = [int(x) for x in headers['Range'][len('bytes='):].split('-')]
+            response.status_code = 403 if headers['Range'] in failing_ranges else 206
+            response.reason = 'Forbidden'
+            response.content = content[start:end+1]
+        else:
+            response.status_code = 200
+            response.headers['content-length'] = str(len(content))
+            response.headers['accept-ranges'] = 'bytes'
+        return response
+    session = MagicMock()
+    session.get.side_effect = get
+    return session, ranges_requested
+
+
+def test_ranged_download_with_resume():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn._generateSignedHeaders = MagicMock(return_value={})
+    content = os.urandom(12*MB)
+    expected_md5 = hashlib.md5(content).hexdigest()
+    failing_ranges = set(['bytes=%d-%d' % (5*MB, 10*MB-1)])
+    syn._requests_session, ranges_requested = _mock_ranged_download_session(content, failing_ranges)
+
+    try:
+        destination = tempfile.mktemp()
+
+        ## the second part fails, leaving the others recorded in the sidecar
+        assert_raises(synapseclient.exceptions.SynapseHTTPError, syn._downloadFile,
+                      'https://repo/entity/syn123/file', destination, expected_md5=expected_md5, max_threads=1)
+        assert os.path.exists(destination + '.partial')
+        assert sorted(ranges_requested) == sorted(['bytes=0-%d' % (5*MB-1), 'bytes=%d-%d' % (5*MB, 10*MB-1)])
+
+        ## resuming fetches only the missing parts
+        failing_ranges.clear()
+        del ranges_requested[:]
+        result = syn._downloadFile('https://repo/entity/syn123/file', destination, expected_md5=expected_md5, max_threads=3)
+        assert result['path'] == os.path.abspath(destination)
+        assert sorted(ranges_requested) == ['bytes=%d-%d' % (10*MB, 12*MB-1), 'bytes=%d-%d' % (5*MB, 10*MB-1)]
+        assert not os.path.exists(destination + '.partial')
+        with open(destination, 'rb') as f:
+            assert f.read() == content
+    finally:
+        for path in [destination, destination + '.partial']:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def test_ranged_download_does_not_resume_another_version():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn._generateSignedHeaders = MagicMock(return_value={})
+    oldContent = os.urandom(12*MB)
+    content = os.urandom(12*MB)
+    failing_ranges = set(['bytes=%d-%d' % (5*MB, 10*MB-1)])
+
+    try:
+        destination = tempfile.mktemp()
+
+        ## an interrupted download of a different version of the file, of the same size
+        syn._requests_session, _ = _mock_ranged_download_session(oldContent, failing_ranges)
+        assert_raises(synapseclient.exceptions.SynapseHTTPError, syn._downloadFile,
+                      'https://repo/entity/syn123/file', destination,
+                      expected_md5=hashlib.md5(oldContent).hexdigest(), max_threads=1)
+        assert os.path.exists(destination + '.partial')
+
+        ## the new version is fetched in full
+        syn._requests_session, ranges_requested = _mock_ranged_download_session(content, set())
+        syn._downloadFile('https://repo/entity/syn123/file', destination,
+                          expected_md5=hashlib.md5(content).hexdigest(), max_threads=1)
+        assert len(ranges_requested) == 3
+        with open(destination, 'rb') as f:
+            assert f.read() == content
+    finally:
+        for path in [destination, destination + '.partial']:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def test_download_md5_mismatch():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn._generateSignedHeaders = MagicMock(return_value={})
+    syn._requests_session, _ = _mock_ranged_download_session(os.urandom(6*MB), set())
+    destination = tempfile.mktemp()
+    assert_raises(synapseclient.exceptions.SynapseMd5MismatchError, syn._downloadFile,
+                  'https://repo/entity/syn123/file', destination, expected_md5='0'*32)
+    assert not os.path.exists(destination)
@@ -1,4 +1,5 @@
-import os, json, tempfile, filecmp
+import os, json, tempfile, filecmp, shutil
+import threading
 from nose.tools import assert_raises
 from mock import MagicMock, patch
 import unit
@@ -192,3 +193,374 @@ def test_submit(*mocks):
     assert submission.submitterAlias == 'Team X'
 
     print submission
+
+
+def test_rest_calls_use_pooled_session():
+    session = MagicMock()
+    session.get.return_value.status_code = 200
+    session.get.return_value.headers = {'content-type': 'application/json'}
+    session.get.return_value.json.return_value = {'foo': 'bar'}
+
+    syn2 = synapseclient.Synapse(debug=False, skip_checks=True, requests_session=session)
+    syn2.username, syn2.apiKey = 'foo', 'bar'
+
+    assert syn2.restGET('/entity/syn1') == {'foo': 'bar'}
+    assert session.get.call_count == 1
+    assert session.get.call_args[0][0] == syn2.repoEndpoint + '/entity/syn1'
+
+    ## each service endpoint gets its own pool, plus the defaults for other URLs
+    mounted = [call[0][0] for call in session.mount.call_args_list]
+    for prefix in [syn2.repoEndpoint, syn2.authEndpoint, syn2.fileHandleEndpoint, 'https://', 'http://']:
+        assert prefix in mounted
+
+
+@patch('synapseclient.Synapse.restGET')
+@patch('synapseclient.Synapse.restPUT')
+def test_entity_bundle_cache(put_mock, get_mock):
+    bundle = {'entity': {'id': 'syn123', 'etag': 'etag-1', 'name': 'foo'}, 'annotations': {}, 'fileHandles': []}
+    def get(uri):
+        if '/bundle' in uri:
+            return json.loads(json.dumps(bundle))
+        return {'id': 'syn123', 'etag': bundle['entity']['etag']}
+    get_mock.side_effect = get
+    put_mock.return_value = {'id': 'syn123', 'etag': 'etag-2'}
+
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    try:
+        syn.enableEntityBundleCache(ttl=300)
+        first = syn._getEntityBundle('syn123')
+        first['entity']['name'] = 'modified by the caller'
+        second = syn._getEntityBundle('syn123')
+        assert second['entity']['name'] == 'foo'
+        assert get_mock.call_count == 1
+        assert syn.entityBundleCacheStats()['hits'] == 1
+        assert syn.entityBundleCacheStats()['misses'] == 1
+
+        # Changing the annotations forgets the bundle
+        syn.setAnnotations('syn123', {'bar': 1})
+        syn._getEntityBundle('syn123')
+        assert get_mock.call_count == 2
+
+        # Expired bundles are revalidated by etag
+        syn.enableEntityBundleCache(ttl=0, revalidate=True)
+        syn._getEntityBundle('syn123')
+        syn._getEntityBundle('syn123')
+        assert get_mock.call_args[0][0] == '/entity/syn123'
+        assert syn.entityBundleCacheStats()['revalidations'] == 1
+
+        bundle['entity']['etag'] = 'etag-2'
+        assert syn._getEntityBundle('syn123')['entity']['etag'] == 'etag-2'
+        assert syn.entityBundleCacheStats()['misses'] == 2
+    finally:
+        syn.disableEntityBundleCache()
+    assert syn.entityBundleCacheStats() is None
+
+
+@patch('synapseclient.Synapse.restGET')
+@patch('synapseclient.Synapse.restPUT')
+def test_entity_bundle_cache_forgets_bundles_fetched_during_a_write(put_mock, get_mock):
+    bundle = {'entity': {'id': 'syn123', 'etag': 'etag-1', 'name': 'foo'}, 'annotations': {}, 'fileHandles': []}
+    get_mock.side_effect = lambda uri: json.loads(json.dumps(bundle))
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn.enableEntityBundleCache(ttl=300)
+
+    ## another thread caches the old bundle while the annotations are being changed
+    def put(uri, body):
+        syn._getEntityBundle('syn123')
+        bundle['annotations'] = {'bar': [1]}
+        return {'id': 'syn123', 'etag': 'etag-2'}
+    put_mock.side_effect = put
+    syn.setAnnotations('syn123', {'bar': 1})
+    assert syn._getEntityBundle('syn123')['annotations'] == {'bar': [1]}
+
+    ## a failed write may still have been applied
+    put_mock.side_effect = SynapseHTTPError('504 Gateway Timeout')
+    syn._getEntityBundle('syn123')
+    assert_raises(SynapseHTTPError, syn.setAnnotations, 'syn123', {'bar': 2})
+    assert syn.entityBundleCacheStats()['size'] == 0
+
+    ## no cached bundle is served while a delete is in flight, nor kept once it is done
+    syn._getEntityBundle('syn123')
+    cached = []
+    def delete(uri):
+        cached.append(syn.entityBundleCacheStats()['size'])
+        syn._getEntityBundle('syn123')
+    with patch.object(syn, 'restDELETE', side_effect=delete):
+        syn.delete('syn123')
+    assert cached == [0]
+    assert syn.entityBundleCacheStats()['size'] == 0
+
+
+def test_entity_bundle_cache_evicts_least_recently_used():
+    bundle_cache = synapseclient.bundle_cache.EntityBundleCache(max_entries=2)
+    fetch = MagicMock(side_effect=lambda: {'entity': {'etag': 'x'}})
+    bundle_cache.get(('syn1', None, 1), fetch)
+    bundle_cache.get(('syn2', None, 1), fetch)
+    bundle_cache.get(('syn1', None, 1), fetch)
+    bundle_cache.get(('syn3', None, 1), fetch)
+    bundle_cache.get(('syn1', None, 1), fetch)
+    bundle_cache.get(('syn2', None, 1), fetch)
+    assert fetch.call_count == 4
+    assert bundle_cache.stats()['evictions'] == 2
+    assert bundle_cache.stats()['size'] == 2
+
+
+def test_getMany():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    ## count calls under a lock, as a MagicMock's call_count may miss calls made from several threads at once
+    calls = []
+    lock = threading.Lock()
+    def get(entity, **kwargs):
+        with lock:
+            calls.append(entity)
+        return {'id': entity, 'downloaded': kwargs['downloadFile']}
+    syn.get = get
+
+    ids = ['syn%d' % i for i in range(20)]
+    requested = ids + ['syn3', {'id': 'syn5'}]
+    results = list(syn.getMany(requested, downloadFile=False, max_workers=4))
+
+    assert [result['id'] for result in results] == ids + ['syn3', 'syn5']
+    assert all(not result['downloaded'] for result in results)
+    assert sorted(calls) == sorted(ids)
+    assert results[-1] is results[5]
+    assert list(syn.getMany([])) == []
+
+
+@patch('synapseclient.Synapse.restGET')
+@patch('synapseclient.Synapse.restPOST')
+@patch('synapseclient.Synapse.restPUT')
+def test_storeMany_shares_one_activity(put_mock, post_mock, get_mock):
+    def post(uri, body):
+        if uri == '/activity':
+            return dict(json.loads(body), id='42', etag='activity-etag')
+        entity = json.loads(body)
+        if entity['name'] == 'bad':
+            response = MagicMock()
+            response.status_code = 400
+            raise SynapseHTTPError('400 Client Error: bad entity', response=response)
+        return dict(entity, id='syn%d' % (100 + int(entity['name'][len('folder'):])), etag='etag-1')
+    post_mock.side_effect = post
+    put_mock.side_effect = lambda uri, body=None: dict(json.loads(body), etag='etag-2') if body else {'id': '42'}
+    get_mock.side_effect = lambda uri: {'id': uri.split('/')[-1], 'etag': 'etag-3', 'name': 'x', 'parentId': 'syn1',
+                                        'concreteType': 'org.sagebionetworks.repo.model.Folder'}
+
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    folders = [synapseclient.Folder('folder%d' % i, parentId='syn1') for i in range(5)]
+    folders.insert(2, synapseclient.Folder('bad', parentId='syn1'))
+    results = syn.storeMany(folders, used='syn7', executed='syn8', max_workers=3)
+
+    assert len(results) == 6
+    assert isinstance(results[2], SynapseHTTPError)
+    assert [r.id for r in results if not isinstance(r, Exception)] == ['syn100', 'syn101', 'syn102', 'syn103', 'syn104']
+    assert all(r.etag == 'etag-3' for r in results if not isinstance(r, Exception))
+
+    # One Activity, saved once an entity has been created and linked to each entity created
+    uri_of = lambda call: call[1]['uri'] if 'uri' in call[1] else call[0][0]
+    post_uris = [uri_of(c) for c in post_mock.call_args_list]
+    assert post_uris.count('/activity') == 1
+    assert post_uris.index('/activity') > 0
+    assert all(uri == '/entity' for uri in post_uris if uri != '/activity')
+    put_uris = [uri_of(c) for c in put_mock.call_args_list]
+    assert sorted(uri for uri in put_uris if 'generatedBy' in uri) == \
+           ['/entity/syn%d/generatedBy?generatedBy=42' % i for i in range(100, 105)]
+
+
+@patch('synapseclient.Synapse.restPOST')
+def test_store_saves_no_activity_for_an_entity_it_fails_to_create(post_mock):
+    response = MagicMock()
+    response.status_code = 400
+    post_mock.side_effect = SynapseHTTPError('400 Client Error: bad entity', response=response)
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    assert_raises(SynapseHTTPError, syn.store, synapseclient.Folder('bad', parentId='syn1'), used='syn7')
+    assert [c[1].get('uri', c[0][0] if c[0] else None) for c in post_mock.call_args_list] == ['/entity']
+
+
+@patch('synapseclient.Synapse.restGET')
+@patch('synapseclient.Synapse.restPOST')
+@patch('synapseclient.Synapse.restPUT')
+def test_store_without_provenance_does_not_fetch_the_entity_again(put_mock, post_mock, get_mock):
+    post_mock.side_effect = lambda uri, body: dict(json.loads(body), id='syn100', etag='etag-1')
+    put_mock.side_effect = lambda uri, body=None: dict(json.loads(body), etag='etag-2')
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    folder = syn.store(synapseclient.Folder('folder', parentId='syn1'))
+    assert folder.etag == 'etag-2'
+    assert not get_mock.called
+
+
+def test_async_synapse():
+    from synapseclient.async_client import AsyncSynapse
+
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    started = threading.Event()
+    release = threading.Event()
+    def get(entity, **kwargs):
+        if entity == 'syn1':
+            started.set()
+            release.wait(5)
+        return {'id': entity}
+    syn.get = MagicMock(side_effect=get)
+    syn.chunkedQuery = MagicMock(return_value=iter([{'entity.id': 'syn1'}, {'entity.id': 'syn2'}]))
+    syn.restGET = MagicMock(side_effect=SynapseHTTPError('404 Client Error'))
+
+    with AsyncSynapse(syn, max_workers=4) as async_syn:
+        # A slow call doesn't hold up the others
+        slow = async_syn.get('syn1')
+        assert started.wait(5)
+        callback_results = []
+        fast = async_syn.get('syn2', downloadFile=False, callback=callback_results.append)
+        assert fast.get(5) == {'id': 'syn2'}
+        assert not slow.ready()
+        release.set()
+        assert slow.get(5) == {'id': 'syn1'}
+        assert callback_results == [{'id': 'syn2'}]
+
+        assert async_syn.chunkedQuery('select id from entity').get(5) == [{'entity.id': 'syn1'}, {'entity.id': 'syn2'}]
+        assert_raises(SynapseHTTPError, async_syn.restGET('/entity/syn3').get, 5)
+
+
+def _fake_query_service(total, max_page=None):
+    """Returns a restGET answering entity queries of the given size, too large beyond max_page rows"""
+    import re, urllib
+    lock = threading.Lock()
+    pages = []
+    def restGET(uri):
+        query = urllib.unquote(uri[len('/query?query='):])
+        limit, offset = map(int, re.search(r'limit (\d+) offset (\d+)$', query).groups())
+        with lock:
+            pages.append((offset, limit))
+        if max_page is not None and limit > max_page:
+            response = MagicMock()
+            response.status_code = 400
+            response.json.return_value = {'reason': 'The results of this query exceeded the max'}
+            raise SynapseHTTPError('400 Client Error', response=response)
+        results = [{'entity.id': 'syn%d' % i} for i in range(offset, min(offset + limit, total + 1))]
+        return {'results': results, 'totalNumberOfResults': total}
+    return restGET, pages
+
+
+def test_chunkedQuery_in_parallel():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    expected = [{'entity.id': 'syn%d' % i} for i in range(1, 2501)]
+
+    syn.restGET, pages = _fake_query_service(2500)
+    assert list(syn.chunkedQuery('select id from entity', max_threads=4)) == expected
+    assert sorted(pages) == [(1, 1000), (1001, 1000), (2001, 500)]
+
+    ## the user's limit and offset are respected
+    syn.restGET, pages = _fake_query_service(2500)
+    assert list(syn.chunkedQuery('select id from entity limit 150 offset 101', max_threads=4)) == expected[100:250]
+
+    ## pages that are too large are split
+    syn.restGET, pages = _fake_query_service(2500, max_page=300)
+    assert list(syn.chunkedQuery('select id from entity', max_threads=4)) == expected
+    assert (1001, 500) in pages and (1501, 250) in pages and (1751, 250) in pages
+
+    ## the same results as fetching one page at a time
+    syn.restGET, pages = _fake_query_service(2500, max_page=300)
+    assert list(syn.chunkedQuery('select id from entity')) == expected
+
+
+def test_GET_paginated_in_parallel():
+    import urlparse
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    lock = threading.Lock()
+    requests = []
+    def restGET(uri):
+        query = urlparse.parse_qs(urlparse.urlparse(uri).query)
+        limit, offset = int(query['limit'][0]), int(query['offset'][0])
+        with lock:
+            requests.append((offset, limit))
+        ## the service returns no more than 50 at once, and only 10 from offset 230
+        end = min(offset + min(limit, 50), 1234)
+        if offset == 230:
+            end = offset + 10
+        return {'results': [{'id': i, 'evaluationId': '123', 'entityId': 'syn%d' % i, 'versionNumber': 1}
+                            for i in range(offset, end)], 'totalNumberOfResults': 1234}
+    syn.restGET = MagicMock(side_effect=restGET)
+
+    submissions = list(syn.getSubmissions(123, limit=100, offset=30, max_threads=4))
+    assert [submission['id'] for submission in submissions] == range(30, 1234)
+    assert requests[0] == (30, 100)
+    assert (240, 40) in requests
+    assert max(offset for offset, limit in requests) == 1230
+
+    ## the same results as fetching one page at a time
+    del requests[:]
+    assert [result['id'] for result in syn._GET_paginated('/column', limit=100, offset=30)] == range(30, 1234)
+
+
+def test_list_recursive():
+    import StringIO
+    tree = {'syn1': ['syn2', 'syn5', 'syn6'], 'syn2': ['syn3', 'syn4'], 'syn5': ['syn7'], 'syn6': []}
+    def entity(id):
+        return {'entity.id': id, 'entity.name': 'name%s' % id[3:],
+                'entity.nodeType': 'folder' if id in tree else 'file',
+                'entity.concreteType': ['org.sagebionetworks.repo.model.%s' % ('Folder' if id in tree else 'FileEntity')],
+                'entity.createdByPrincipalId': int(id[3:]) % 3, 'entity.createdOn': 1420070400000,
+                'entity.versionNumber': 1}
+    def chunkedQuery(query):
+        id = query.rsplit('"', 2)[-2]
+        if 'parentId' in query:
+            return iter([entity(child) for child in tree[id]])
+        return iter([entity(id)])
+
+    oldCacheDir = synapseclient.cache.CACHE_DIR
+    synapseclient.cache.CACHE_DIR = tempfile.mkdtemp()
+    try:
+        lock = threading.Lock()
+        headerRequests = []
+        def restGET(uri):
+            ids = uri.split('ids=')[1].split(',')
+            with lock:
+                headerRequests.append(sorted(ids))
+            return {'children': [{'ownerId': id, 'userName': 'user%s' % id} for id in ids]}
+
+        listings = []
+        for run in range(2):
+            synapseclient.Synapse._user_name_cache.clear()
+            syn = synapseclient.Synapse(debug=False, skip_checks=True)
+            syn.chunkedQuery = MagicMock(side_effect=chunkedQuery)
+            syn.restGET = MagicMock(side_effect=restGET)
+            out = StringIO.StringIO()
+            syn._list('syn1', recursive=True, long_format=True, out=out, max_threads=3)
+            listings.append(out.getvalue())
+
+        lines = listings[0].splitlines()
+        assert [line.split()[0] for line in lines] == ['syn1', 'syn2', 'syn3', 'syn4', 'syn5', 'syn7', 'syn6']
+        assert lines[0].endswith('  name1/') and lines[2].endswith('      name3')
+        assert lines[2].split()[2] == 'user0'
+        ## Names are looked up once per listing query at most, and not at all the second time
+        assert sorted(id for ids in headerRequests for id in ids) == ['0', '1', '2']
+        assert listings[1] == listings[0]
+
+        ## Not recursive, only the parent and its children are listed
+        out = StringIO.StringIO()
+        syn._list('syn1', out=out)
+        assert [line.split()[0] for line in out.getvalue().splitlines()] == ['syn1', 'syn2', 'syn5', 'syn6']
+    finally:
+        shutil.rmtree(synapseclient.cache.CACHE_DIR)
+        synapseclient.cache.CACHE_DIR = oldCacheDir
+
+
+def test_get_user_names_without_a_user_name_cache():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    oldCacheDir = synapseclient.cache.CACHE_DIR
+    ## the cache directory can't be created, as a file is in its way
+    _, path = tempfile.mkstemp()
+    synapseclient.cache.CACHE_DIR = os.path.join(path, 'cache')
+    try:
+        syn.restGET = MagicMock(return_value={'children': [{'ownerId': 7, 'userName': 'dave'}]})
+        with patch('warnings.warn') as warn:
+            assert syn._get_user_names(['7']) == {'7': 'dave'}
+            assert warn.called
+
+        ## names remembered in memory are kept apart by endpoint
+        syn.repoEndpoint = 'https://repo-other.example.org'
+        syn.restGET.return_value = {'children': [{'ownerId': 7, 'userName': 'erin'}]}
+        with patch('warnings.warn'):
+            assert syn._get_user_names([7]) == {'7': 'erin'}
+    finally:
+        synapseclient.Synapse._user_name_cache.clear()
+        synapseclient.cache.CACHE_DIR = oldCacheDir
+        os.remove(path)
@@ -0,0 +1,139 @@
+import os, shutil, tempfile, time
+from mock import MagicMock, patch
+
+import synapseclient
+import synapseclient.__main__ as cmdline
+
+
+def setup():
+    print '\n'
+    print '~' * 60
+    print os.path.basename(__file__)
+    print '~' * 60
+
+
+def test_recursive_get():
+    ## syn1 holds files syn2 and syn6 and folder syn3, which holds files syn4 and syn5
+    children = {'syn1': [('syn2', 'a.txt', 'file', 102), ('syn6', 'd.txt', 'file', 106), ('syn3', 'sub', 'folder', None)],
+                'syn3': [('syn4', 'b.txt', 'file', 104), ('syn5', 'c.txt', 'file', 105)]}
+    def chunkedQuery(query):
+        parentId = query.split("'")[1]
+        return iter([{'entity.id': id, 'entity.name': name, 'entity.dataFileHandleId': fileHandleId,
+                      'entity.concreteType': ['org.sagebionetworks.repo.model.%s' % type.capitalize()]}
+                     for id, name, type, fileHandleId in children.get(parentId, [])])
+
+    oldCacheDir = synapseclient.cache.CACHE_DIR
+    synapseclient.cache.CACHE_DIR = tempfile.mkdtemp()
+    destination = os.path.join(tempfile.mkdtemp(), 'download')
+    os.mkdir(destination)
+
+    ## a.txt is up to date in the destination
+    up_to_date = os.path.join(destination, 'a.txt')
+    with open(up_to_date, 'w') as f:
+        f.write('already here')
+    synapseclient.cache.add_local_file_to_cache(path=up_to_date, dataFileHandleId='102')
+
+    ## d.txt was restored from a backup with its original modification time, and is up to date elsewhere in the cache
+    restored = os.path.join(destination, 'd.txt')
+    with open(restored, 'w') as f:
+        f.write('restored')
+    os.utime(restored, (time.time() + 60, time.time() + 60))
+
+    def get(id, downloadLocation):
+        if id == 'syn5':
+            raise synapseclient.exceptions.SynapseHTTPError('403 Client Error: Forbidden')
+        path = os.path.join(downloadLocation, {'syn4': 'b.txt', 'syn6': 'd.txt'}[id])
+        if id == 'syn4':
+            with open(path, 'w') as f:
+                f.write('downloaded')
+            syn._emitMetric('download', 'GET', 'https://s3/b.txt', status=200, bytes_received=10)
+        return {'id': id, 'path': path, 'fileSize': 10}
+
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn.chunkedQuery = MagicMock(side_effect=chunkedQuery)
+    syn.get = MagicMock(side_effect=get)
+    try:
+        summary = cmdline._recursiveGet('syn1', destination, syn, max_workers=3)
+
+        assert os.path.isdir(os.path.join(destination, 'sub'))
+        assert os.path.exists(os.path.join(destination, 'sub', 'b.txt'))
+        assert 'syn2' not in [call[0][0] for call in syn.get.call_args_list]
+        assert summary['folders'] == 1
+        assert summary['files'] == 3
+        assert summary['downloaded'] == 1
+        assert summary['bytes'] == 10
+        assert [id for id, ex in summary['errors']] == ['syn5']
+        assert syn._metrics_hooks == []
+
+        ## a missing download location is created
+        missing = os.path.join(destination, 'missing', 'dir')
+        summary = cmdline._recursiveGet('syn7', missing, syn)
+        assert os.path.isdir(missing)
+        assert summary['files'] == 0
+    finally:
+        shutil.rmtree(os.path.dirname(destination))
+        shutil.rmtree(synapseclient.cache.CACHE_DIR)
+        synapseclient.cache.CACHE_DIR = oldCacheDir
+
+
+def test_sync_directory():
+    ## local tree:  a.txt (unchanged), b.txt (changed), c.txt (new), sub/d.txt (new), existing/e.txt (new),
+    ##              clash.txt (a folder in Synapse), notes/f.txt (notes is a file in Synapse)
+    localdir = tempfile.mkdtemp()
+    for path in ['a.txt', 'b.txt', 'c.txt', 'sub/d.txt', 'existing/e.txt', 'clash.txt', 'notes/f.txt']:
+        path = os.path.join(localdir, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('contents of %s' % os.path.basename(path))
+
+    children = {'syn1': {'a.txt': ('syn2', False), 'b.txt': ('syn3', False), 'existing': ('syn4', True),
+                         'clash.txt': ('syn5', True), 'notes': ('syn6', False)}}
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn.chunkedQuery = MagicMock(side_effect=lambda query: iter(
+        [{'entity.id': id, 'entity.name': name,
+          'entity.concreteType': ['org.sagebionetworks.repo.model.%s' % ('Folder' if container else 'FileEntity')]}
+         for name, (id, container) in children.get(query.split("'")[1], {}).items()]))
+
+    def bundle(id, bitFlags):
+        path = os.path.join(localdir, {'syn2': 'a.txt', 'syn3': 'b.txt'}[id])
+        md5 = synapseclient.utils.md5_for_file(path).hexdigest() if id == 'syn2' else 'stale'
+        return {'entity': {'id': id, 'name': os.path.basename(path), 'parentId': 'syn1', 'etag': '0',
+                           'dataFileHandleId': '10%s' % id[3:],
+                           'concreteType': 'org.sagebionetworks.repo.model.FileEntity'},
+                'annotations': {},
+                'fileHandles': [{'id': '10%s' % id[3:], 'contentSize': os.path.getsize(path), 'contentMd5': md5}]}
+    syn._getEntityBundle = MagicMock(side_effect=bundle)
+
+    stored = []
+    def store(entity, **kwargs):
+        stored.append(entity)
+        entity = synapseclient.Entity.create(dict(entity.properties, id=entity.get('id', 'syn%d' % (100 + len(stored)))),
+                                             local_state=entity.local_state())
+        return entity
+    syn.store = MagicMock(side_effect=store)
+
+    oldCacheDir = synapseclient.cache.CACHE_DIR
+    try:
+        synapseclient.cache.CACHE_DIR = tempfile.mkdtemp()
+        manifest = cmdline._syncDirectory(localdir, 'syn1', syn, max_workers=2)
+        actions = dict((os.path.relpath(item['path'], localdir), item['action']) for item in manifest)
+        assert actions == {'a.txt': 'unchanged', 'b.txt': 'updated', 'c.txt': 'created', 'existing': 'unchanged',
+                           'sub': 'created', os.path.join('sub', 'd.txt'): 'created',
+                           os.path.join('existing', 'e.txt'): 'created',
+                           'clash.txt': 'failed', 'notes': 'failed'}, actions
+        ## entities of the other type are reported, not updated
+        assert not any(entity['name'] in ('clash.txt', 'notes', 'f.txt') for entity in stored)
+        assert syn._getEntityBundle.call_count == 2
+        parents = dict((entity['name'], entity['parentId']) for entity in stored)
+        assert parents['e.txt'] == 'syn4'
+        assert parents['d.txt'] == [entity['id'] for entity in manifest if entity['path'].endswith('sub')][0]
+
+        ## the unchanged file was hashed once and is now known to the cache, so it isn't hashed again
+        unchanged_bundle = bundle('syn2', 0)
+        with patch('synapseclient.utils.md5_for_file') as md5_mock:
+            assert not cmdline._localFileHasChanged(unchanged_bundle, os.path.join(localdir, 'a.txt'))
+            assert not md5_mock.called
+    finally:
+        synapseclient.cache.CACHE_DIR = oldCacheDir
+        shutil.rmtree(localdir)
@@ -0,0 +1,125 @@
+import os
+import json
+import warnings
+from mock import MagicMock, patch
+from nose.tools import assert_raises
+
+import synapseclient
+from synapseclient.metrics import uri_template, Histogram, MetricsRegistry
+from synapseclient.exceptions import *
+
+
+def setup(module):
+    print '\n'
+    print '~' * 60
+    print os.path.basename(__file__)
+    print '~' * 60
+
+
+def test_uri_template():
+    assert uri_template('/entity/syn123/version/2?limit=10') == '/entity/{id}/version/{id}'
+    assert uri_template('https://repo-prod.prod.sagebase.org/repo/v1/entity/syn1.2/bundle',
+                        'https://repo-prod.prod.sagebase.org/repo/v1') == '/entity/{id}/bundle'
+    assert uri_template('/entity/syn9/table/query/async/get/0f9e3a12-4b6c-4d4e-9a3b-1c2d3e4f5a6b') == \
+           '/entity/{id}/table/query/async/get/{token}'
+    assert uri_template('/userProfile') == '/userProfile'
+
+
+def test_histogram():
+    histogram = Histogram()
+    assert histogram.quantile(0.5) is None
+    for i in range(1, 101):
+        histogram.record(i / 100.0)
+    summary = histogram.summary()
+    assert summary['count'] == 100
+    assert summary['min'] == 0.01 and summary['max'] == 1.0
+    assert abs(summary['mean'] - 0.505) < 1e-9
+    ## quantiles are found to within the width of a bucket
+    assert 0.5 <= summary['p50'] <= 0.5 * 1.19, summary
+    assert 0.99 <= summary['p99'] <= 1.0, summary
+    assert summary['p50'] <= summary['p90'] <= summary['p99']
+
+
+def test_registry():
+    registry = MetricsRegistry()
+    registry.record({'kind': 'rest', 'method': 'GET', 'uri_template': '/entity/{id}', 'status': 200, 'latency': 0.1, 'bytes_received': 10})
+    registry.record({'kind': 'rest', 'method': 'GET', 'uri_template': '/entity/{id}', 'status': 404, 'latency': 0.2, 'error': 'SynapseHTTPError'})
+    registry.record({'kind': 'rest', 'method': 'POST', 'uri_template': '/entity', 'status': 201, 'latency': 0.3, 'retries': 2, 'bytes_sent': 5})
+
+    snapshot = registry.snapshot(reset=True)
+    assert sorted(snapshot) == ['GET /entity/{id}', 'POST /entity']
+    assert snapshot['GET /entity/{id}']['count'] == 2
+    assert snapshot['GET /entity/{id}']['errors'] == 1
+    assert snapshot['GET /entity/{id}']['statuses'] == {200: 1, 404: 1}
+    assert snapshot['GET /entity/{id}']['bytes_received'] == 10
+    assert snapshot['GET /entity/{id}']['latency']['max'] == 0.2
+    assert snapshot['POST /entity']['retries'] == 2
+    assert registry.snapshot() == {}
+
+
+def _response(status_code, body):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = {'content-type': 'application/json'}
+    response.content = json.dumps(body)
+    response.json.return_value = body
+    return response
+
+
+def test_rest_call_events():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn._generateSignedHeaders = MagicMock(return_value={})
+    syn._requests_session = MagicMock()
+    ## the first GET is retried
+    syn._requests_session.get.side_effect = [_response(503, {'reason': 'busy'}), _response(200, {'id': 'syn1'})]
+    syn._requests_session.post.return_value = _response(403, {'reason': 'forbidden'})
+
+    events = []
+    syn.addMetricsHook(events.append)
+    with patch('time.sleep'):
+        assert syn.restGET('/entity/syn1') == {'id': 'syn1'}
+    assert_raises(SynapseHTTPError, syn.restPOST, '/entity/syn2/acl', body='{"a": 1}')
+
+    assert len(events) == 2
+    get, post = events
+    assert get['kind'] == 'rest'
+    assert get['method'] == 'GET'
+    assert get['uri'] == syn.repoEndpoint + '/entity/syn1'
+    assert get['uri_template'] == '/entity/{id}'
+    assert get['endpoint'] == syn.repoEndpoint
+    assert get['status'] == 200
+    assert get['retries'] == 1
+    assert get['bytes_received'] == len('{"id": "syn1"}')
+    assert get['latency'] >= 0 and get['error'] is None
+    assert post['status'] == 403
+    assert post['error'] == 'SynapseHTTPError'
+    assert post['bytes_sent'] == len('{"a": 1}')
+
+    metrics = syn.metrics()
+    assert metrics['GET /entity/{id}']['count'] == 1
+    assert metrics['GET /entity/{id}']['retries'] == 1
+    assert metrics['POST /entity/{id}/acl']['errors'] == 1
+
+    ## a failing hook doesn't fail the call
+    syn.removeMetricsHook(events.append)
+    syn.addMetricsHook(MagicMock(side_effect=ValueError('broken hook')))
+    syn._requests_session.get.side_effect = [_response(200, {'id': 'syn1'})]
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert syn.restGET('/entity/syn1') == {'id': 'syn1'}
+    assert any('broken hook' in str(warning.message) for warning in caught)
+    assert len(events) == 2
+    assert syn.metrics(reset=True)['GET /entity/{id}']['count'] == 2
+    assert syn.metrics() == {}
+
+
+def test_async_job_events():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True)
+    syn.restPOST = MagicMock(return_value={'token': '1234'})
+    syn.restGET = MagicMock(side_effect=[{'jobState': 'PROCESSING'}, {'jobState': 'COMPLETE'}])
+    events = []
+    syn.addMetricsHook(events.append)
+    with patch('time.sleep'):
+        syn._waitForAsync(uri='/entity/syn123/table/query/async', request={})
+    assert [(event['kind'], event['method'], event['uri_template'], event['status']) for event in events] == \
+           [('async_job', 'ASYNC', '/entity/{id}/table/query/async', 'complete')]
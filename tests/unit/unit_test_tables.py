@@ -2,9 +2,10 @@ import math
 import csv
 import os
 import sys
+import gc
 import tempfile
 from itertools import izip
-from mock import MagicMock
+from mock import MagicMock, patch
 from nose.tools import assert_raises
 
 import synapseclient
@@ -349,7 +350,7 @@ def test_aggregate_query_result_to_data_frame():
         import pandas as pd
 
         class MockSynapse(object):
-            def _queryTable(self, query, limit=None, offset=None, isConsistent=True, partMask=None):
+            def _queryTable(self, query, limit=None, offset=None, isConsistent=True, partMask=None, polling=None):
                 return {'concreteType': 'org.sagebionetworks.repo.model.table.QueryResultBundle',
                         'maxRowsPerPage': 2,
                         'queryCount': 4,
@@ -370,7 +371,7 @@ def test_aggregate_query_result_to_data_frame():
                          'columnType': 'STRING',
                          'id': '1387',
                          'name': 'State'}]}
-            def _queryTableNext(self, nextPageToken, tableId):
+            def _queryTableNext(self, nextPageToken, tableId, polling=None):
                 return {'concreteType': 'org.sagebionetworks.repo.model.table.QueryResult',
                         'queryResults': {'etag': 'aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee',
                          'headers': [
@@ -423,3 +424,338 @@ def test_waitForAsync():
         "errorDetails": "Totally fubared error details"})
 
     assert_raises(synapseclient.exceptions.SynapseTimeoutError, syn._waitForAsync, uri="foo/bar", request={"foo": "bar"})
+
+
+def test_prefetching_query_result():
+    import threading, time
+
+    N_PAGES = 10
+    fetched = []
+    lock = threading.Lock()
+
+    def page(i):
+        return {'queryResults': {'etag': 'aaaaaaaa', 'tableId': 'syn123',
+                                 'headers': [{'columnType': 'INTEGER', 'name': 'x'}],
+                                 'rows': [{'values': [str(2*i)]}, {'values': [str(2*i+1)]}]},
+                'nextPageToken': {'token': i+1} if i+1 < N_PAGES else None}
+
+    def queryTableNext(nextPageToken, tableId, polling=None):
+        assert tableId == 'syn123'
+        with lock:
+            fetched.append(nextPageToken['token'])
+        if nextPageToken['token'] == failAt[0]:
+            raise synapseclient.exceptions.SynapseHTTPError('page failed')
+        return page(nextPageToken['token'])
+
+    syn = MagicMock()
+    syn._queryTable = MagicMock(side_effect=lambda **kwargs: {'queryResult': page(0), 'queryCount': 2*N_PAGES})
+    syn._queryTableNext = MagicMock(side_effect=queryTableNext)
+
+    ## all rows arrive in order
+    failAt = [None]
+    result = TableQueryResult(synapse=syn, query="select x from syn123", prefetch=2)
+    assert [row['values'][0] for row in result] == range(2*N_PAGES)
+    assert fetched == range(1, N_PAGES)
+
+    ## pages are fetched ahead of the reader, but no more than the queue holds
+    del fetched[:]
+    result = TableQueryResult(synapse=syn, query="select x from syn123", prefetch=2)
+    rows = [result.next() for i in range(3)]
+    for i in range(50):
+        if len(fetched) >= 4:
+            break
+        time.sleep(0.01)
+    time.sleep(0.05)
+    ## page 1 is being read, pages 2 and 3 are queued and page 4 is waiting for room
+    assert fetched == [1, 2, 3, 4], fetched
+    prefetcher = result._prefetcher
+    result.close()
+    prefetcher._thread.join(5)
+    assert not prefetcher._thread.is_alive()
+
+    ## reading on after closing fetches the remaining pages one at a time
+    del fetched[:]
+    assert [row['values'][0] for row in result] == range(3, 2*N_PAGES)
+    assert fetched == range(2, N_PAGES)
+
+    ## a result abandoned without being closed stops its prefetcher once it is garbage collected
+    result = TableQueryResult(synapse=syn, query="select x from syn123", prefetch=1)
+    rows = [result.next() for i in range(3)]
+    thread = result._prefetcher._thread
+    del result
+    gc.collect()
+    thread.join(5)
+    assert not thread.is_alive()
+
+    ## errors in the background are raised to the reader, after the pages before them
+    failAt = [3]
+    result = TableQueryResult(synapse=syn, query="select x from syn123", prefetch=1)
+    assert [result.next()['values'][0] for i in range(6)] == range(6)
+    assert_raises(synapseclient.exceptions.SynapseHTTPError, result.next)
+
+
+def test_waitForAsync_polls_adaptively():
+    syn = synapseclient.client.Synapse(debug=True, skip_checks=True)
+    syn.restPOST = MagicMock(return_value={"token":"1234567"})
+
+    sleeps = []
+    statuses = [{"jobState": "PROCESSING"}] * 4 + [{"jobState": "COMPLETE", "results": "done"}]
+    syn.restGET = MagicMock(side_effect=statuses)
+    with patch('time.sleep', side_effect=sleeps.append):
+        result = syn._waitForAsync(uri="/entity/syn123/table/query/async", request={})
+    assert result['results'] == 'done'
+
+    ## the first poll is made right away, then sleeps grow geometrically from a short one
+    assert syn.restGET.call_count == 5
+    assert len(sleeps) == 4
+    assert sleeps[0] == syn.table_query_sleep < 1
+    assert all(abs(b - a*syn.table_query_backoff) < 1e-9 for a, b in zip(sleeps, sleeps[1:])), sleeps
+
+    ## polling can be set for a single call
+    del sleeps[:]
+    syn.restGET = MagicMock(side_effect=[{"jobState": "PROCESSING"}] * 3 + [{"jobState": "COMPLETE"}])
+    with patch('time.sleep', side_effect=sleeps.append):
+        syn._waitForAsync(uri="/entity/syn456/table/query/async", request={},
+                          polling={'sleep': 1, 'backoff': 3, 'max_sleep': 5})
+    assert sleeps == [1, 3, 5]
+
+    ## a job reporting progress isn't left sleeping long after it should have finished
+    del sleeps[:]
+    progress = [{"jobState": "PROCESSING", "progressMessage": "", "progressCurrent": p, "progressTotal": 100}
+                for p in (0, 10, 20, 30, 40)]
+    syn.restGET = MagicMock(side_effect=progress + [{"jobState": "COMPLETE"}])
+    clock = [1000.0]
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+    with patch('time.sleep', side_effect=sleep), patch('time.time', side_effect=lambda: clock[0]):
+        syn._waitForAsync(uri="/entity/syn789/table/download/csv/async", request={},
+                          polling={'sleep': 10, 'backoff': 10, 'max_sleep': 1000})
+    ## at 10 percent in 10 seconds, 90 seconds are left after the second poll, which is less than the next sleep of 100
+    assert sleeps[:2] == [10, 90], sleeps
+
+    ## the timing of jobs is kept by type of job
+    stats = syn.asyncJobStats()
+    assert stats['/entity/{id}/table/query/async']['jobs'] == 2
+    assert stats['/entity/{id}/table/query/async']['polls'] == 9
+    assert stats['/entity/{id}/table/query/async']['complete'] == 2
+    assert stats['/entity/{id}/table/download/csv/async']['jobs'] == 1
+    assert stats['/entity/{id}/table/download/csv/async']['mean_polls'] == 6.0
+
+    syn.restGET = MagicMock(return_value={"jobState": "FAILED", "errorMessage": "bad", "errorDetails": "details"})
+    try:
+        syn._waitForAsync(uri="/entity/syn1/table/query/async", request={})
+        assert False, 'expected a SynapseError'
+    except synapseclient.exceptions.SynapseError as ex:
+        assert ex.asynchronousJobStatus['errorMessage'] == 'bad'
+    stats = syn.asyncJobStats(reset=True)
+    assert stats['/entity/{id}/table/query/async']['failed'] == 1
+    assert syn.asyncJobStats() == {}
+
+
+def test_query_result_to_data_frame_with_row_ids():
+    try:
+        import pandas as pd
+    except ImportError:
+        sys.stderr.write('Pandas is apparently not installed, skipping test_query_result_to_data_frame_with_row_ids.\n\n')
+        return
+
+    headers = [{'columnType': 'STRING', 'name': 'name'}, {'columnType': 'INTEGER', 'name': 'n'}]
+    def page(i):
+        return {'queryResults': {'etag': 'aaaaaaaa', 'tableId': 'syn123', 'headers': headers,
+                                 'rows': [{'rowId': 2*i+j, 'versionNumber': 1,
+                                           'values': ['row%d' % (2*i+j), None if 2*i+j == 3 else str(2*i+j)]}
+                                          for j in range(2)]},
+                'nextPageToken': {'token': i+1} if i < 2 else None}
+
+    syn = MagicMock()
+    syn._queryTable = MagicMock(return_value={'queryResult': page(0)})
+    syn._queryTableNext = MagicMock(side_effect=lambda nextPageToken, tableId, polling=None: page(nextPageToken['token']))
+
+    df = TableQueryResult(synapse=syn, query="select name, n from syn123").asDataFrame()
+    assert list(df.columns) == ['name', 'n']
+    assert list(df.index) == ['%d_1' % i for i in range(6)]
+    assert list(df['name']) == ['row%d' % i for i in range(6)]
+    assert df['n'].isnull().tolist() == [False, False, False, True, False, False]
+    assert df['n'][5] == 5
+
+
+def test_cast_columns():
+    headers = [{'columnType': 'STRING'}, {'columnType': 'DOUBLE'}, {'columnType': 'INTEGER'},
+               {'columnType': 'BOOLEAN'}, {'columnType': 'DATE'}, {'columnType': 'ENTITYID'}]
+    rows = [['a', '1.5', '1', 'true', '1421365000000', 'syn1'],
+            ['',  '',    None, 'F',   '',              None],
+            ['c', '-2',  '3', '0',    None,            'syn3']]
+
+    ## whole columns are cast as each row would be
+    columns = synapseclient.table.cast_columns(zip(*rows), headers)
+    assert [list(row) for row in zip(*columns)] == [cast_values(row, headers) for row in rows]
+    assert columns[1] == [1.5, None, -2.0]
+    assert columns[3] == [True, False, False]
+
+    ## columns without empty fields are cast in one go
+    columns = synapseclient.table.cast_columns([('1', '2'), ('t', 'false')], [{'columnType': 'INTEGER'}, {'columnType': 'BOOLEAN'}])
+    assert columns == [[1, 2], [True, False]]
+
+    converters = synapseclient.table.column_converters(headers)
+    assert cast_values(rows[0], headers, converters) == cast_values(rows[0], headers)
+
+    ## unknown column types fail only on non-empty fields
+    assert cast_values(['', None], [{'columnType': 'SPARKLY'}, {'columnType': 'SPARKLY'}]) == [None, None]
+    assert_raises(ValueError, cast_values, ['x'], [{'columnType': 'SPARKLY'}])
+    assert_raises(ValueError, synapseclient.table.cast_columns, [('x',)], [{'columnType': 'SPARKLY'}])
+    assert_raises(ValueError, synapseclient.table.cast_columns, [('x',)], headers)
+
+
+def test_csv_parts():
+    rows = [['row%d' % i, i, None if i % 3 else 'x,y'] for i in range(25)]
+    oldBlockRows = synapseclient.table.CSV_BLOCK_ROWS
+    try:
+        synapseclient.table.CSV_BLOCK_ROWS = 4
+        parts = list(synapseclient.table.csv_parts(iter(rows), ['name', 'n', 'other'], partSize=100))
+        try:
+            assert len(parts) > 1
+            assert sum(nrows for path, nrows, size in parts) == 25
+            readback = []
+            for path, nrows, size in parts:
+                assert size == os.path.getsize(path)
+                with open(path) as f:
+                    lines = list(csv.reader(f))
+                assert lines[0] == ['name', 'n', 'other']
+                assert len(lines) - 1 == nrows
+                readback.extend(lines[1:])
+            assert readback == [[row[0], str(row[1]), row[2] or ''] for row in rows]
+        finally:
+            for path, nrows, size in parts:
+                os.remove(path)
+
+        try:
+            import pandas as pd
+            ## an integer column with a missing value is held as floats, but written as integers
+            df = pd.DataFrame({'name': ['a', 'b', 'c'], 'n': [1, 2, None], 'x': [0.5, 1.0, None]}, columns=['name', 'n', 'x'])
+            parts = list(synapseclient.table.csv_parts(df, list(df.columns)))
+            assert [nrows for path, nrows, size in parts] == [3]
+            with open(parts[0][0]) as f:
+                assert list(csv.reader(f)) == [['name', 'n', 'x'], ['a', '1', '0.5'], ['b', '2', '1.0'], ['c', '', '']]
+            os.remove(parts[0][0])
+        except ImportError:
+            sys.stderr.write('Pandas is apparently not installed, skipping DataFrame portion of test_csv_parts.\n\n')
+    finally:
+        synapseclient.table.CSV_BLOCK_ROWS = oldBlockRows
+
+
+def test_appendToTable():
+    import threading
+
+    syn = synapseclient.client.Synapse(debug=True, skip_checks=True)
+    uploaded = {}
+    attempts = {}
+    lock = threading.Lock()
+
+    def chunkedUploadFile(path, **kwargs):
+        with lock:
+            attempts[path] = attempts.get(path, 0) + 1
+            ## the second part fails the first time it is uploaded
+            if len(attempts) == 2 and attempts[path] == 1:
+                raise IOError('upload failed')
+            with open(path) as f:
+                fileHandleId = str(100 + len(uploaded))
+                uploaded[fileHandleId] = list(csv.reader(f))
+        return {'id': fileHandleId}
+    syn._chunkedUploadFile = MagicMock(side_effect=chunkedUploadFile)
+
+    requests = []
+    def uploadCsvFileHandle(fileHandleId, schema, updateEtag=None, polling=None):
+        requests.append((fileHandleId, updateEtag))
+        if len(requests) == 1:
+            ## a request that times out is tried again, with the same etag
+            raise synapseclient.exceptions.SynapseTimeoutError('slow')
+        return {'etag': 'etag%d' % len(requests)}
+    syn._uploadCsvFileHandle = MagicMock(side_effect=uploadCsvFileHandle)
+
+    oldBlockRows = synapseclient.table.CSV_BLOCK_ROWS
+    try:
+        synapseclient.table.CSV_BLOCK_ROWS = 3
+        rows = [['row%d' % i, i] for i in range(20)]
+        result = syn.appendToTable('syn123', iter(rows), columnNames=['name', 'n'], partSize=50,
+                                   max_threads=3, etag='etag0', progress=False)
+    finally:
+        synapseclient.table.CSV_BLOCK_ROWS = oldBlockRows
+
+    assert result['rows'] == 20
+    parts = result['parts']
+    assert len(parts) == len(attempts) > 2
+    assert [part['part'] for part in parts] == range(1, len(parts) + 1)
+    assert parts[1]['uploadAttempts'] == 2
+    assert parts[0]['requestAttempts'] == 2
+
+    ## the parts are added in order, each after the etag left by the one before
+    assert requests[0] == requests[1] == (parts[0]['fileHandleId'], 'etag0')
+    assert [etag for fileHandleId, etag in requests[2:]] == ['etag%d' % i for i in range(2, len(requests))]
+    assert result['etag'] == 'etag%d' % len(requests)
+    added = []
+    for part in parts:
+        assert uploaded[part['fileHandleId']][0] == ['name', 'n']
+        added.extend(uploaded[part['fileHandleId']][1:])
+    assert added == [[name, str(n)] for name, n in rows]
+
+    ## the temporary files are gone
+    assert not any(os.path.exists(path) for path in attempts)
+
+
+def test_appendToTable_stops_at_a_failed_part():
+    syn = synapseclient.client.Synapse(debug=True, skip_checks=True)
+    syn._getTableEtag = MagicMock(return_value='etag0')
+    paths = []
+    def chunkedUploadFile(path, **kwargs):
+        paths.append(path)
+        return {'id': path}
+    syn._chunkedUploadFile = MagicMock(side_effect=chunkedUploadFile)
+
+    response = MagicMock()
+    response.status_code = 412
+    def uploadCsvFileHandle(fileHandleId, schema, updateEtag=None, polling=None):
+        if syn._uploadCsvFileHandle.call_count == 3:
+            raise synapseclient.exceptions.SynapseHTTPError('412 Client Error: etag conflict', response=response)
+        return {'etag': 'etag'}
+    syn._uploadCsvFileHandle = MagicMock(side_effect=uploadCsvFileHandle)
+
+    oldBlockRows = synapseclient.table.CSV_BLOCK_ROWS
+    try:
+        synapseclient.table.CSV_BLOCK_ROWS = 1
+        syn.appendToTable('syn123', ([i] for i in range(100)), columnNames=['n'], partSize=10, max_threads=2, progress=False)
+        assert False, 'expected a SynapseHTTPError'
+    except synapseclient.exceptions.SynapseHTTPError as ex:
+        ## conflicts aren't retried
+        assert syn._uploadCsvFileHandle.call_count == 3
+        assert [part['part'] for part in ex.appendedParts] == [1, 2]
+    finally:
+        synapseclient.table.CSV_BLOCK_ROWS = oldBlockRows
+
+    ## not every part was written, and the ones that were are gone
+    assert len(paths) < 50
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def test_appendToTable_without_an_etag():
+    syn = synapseclient.client.Synapse(debug=True, skip_checks=True)
+    syn._chunkedUploadFile = MagicMock(side_effect=lambda path, **kwargs: {'id': path})
+    response = MagicMock()
+    response.status_code = 412
+
+    ## the etag is looked up first, and a timed out request that did add its part is not added again
+    syn._getTableEtag = MagicMock(side_effect=['etag0', 'etag1'])
+    syn._uploadCsvFileHandle = MagicMock(side_effect=[
+        synapseclient.exceptions.SynapseTimeoutError('slow'),
+        synapseclient.exceptions.SynapseHTTPError('412 Client Error: etag conflict', response=response)])
+    result = syn.appendToTable('syn123', iter([[1], [2]]), columnNames=['n'], progress=False)
+    assert [call[1]['updateEtag'] for call in syn._uploadCsvFileHandle.call_args_list] == ['etag0', 'etag0']
+    assert result['rows'] == 2
+    assert result['etag'] == 'etag1'
+
+    ## a table that has never had rows added has no etag to guard a retry, so there is none
+    syn._getTableEtag = MagicMock(return_value=None)
+    syn._uploadCsvFileHandle = MagicMock(side_effect=synapseclient.exceptions.SynapseTimeoutError('slow'))
+    assert_raises(synapseclient.exceptions.SynapseTimeoutError, syn.appendToTable, 'syn123', iter([[1]]),
+                  columnNames=['n'], progress=False)
+    assert syn._uploadCsvFileHandle.call_count == 1
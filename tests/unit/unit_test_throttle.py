@@ -0,0 +1,180 @@
+import os
+import json
+import threading
+import requests
+from mock import MagicMock, patch
+
+import synapseclient
+from synapseclient.throttle import Throttle, TokenBucket, ConcurrencyLimiter, is_throttled
+
+
+def setup(module):
+    print '\n'
+    print '~' * 60
+    print os.path.basename(__file__)
+    print '~' * 60
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+    def time(self):
+        return self.now
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def _response(status_code, reason=None, headers={}):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = dict(headers, **{'content-type': 'application/json'})
+    response.content = json.dumps({'reason': reason})
+    response.json.return_value = {'reason': reason}
+    return response
+
+
+def test_is_throttled():
+    assert not is_throttled(None)
+    assert not is_throttled(_response(200))
+    assert not is_throttled(_response(404, 'Not found'))
+    assert is_throttled(_response(429))
+    assert is_throttled(_response(503))
+    assert is_throttled(_response(403, 'Please slow down.  You may send a maximum of 10 message(s) in 60 second(s)'))
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    with patch('time.time', side_effect=clock.time), patch('time.sleep', side_effect=clock.sleep):
+        bucket = TokenBucket(rate=10, burst=5)
+        ## a burst goes straight through, then requests are spaced at the rate
+        assert [bucket.acquire() for i in range(5)] == [0] * 5
+        start = clock.now
+        for i in range(20):
+            bucket.acquire()
+        assert abs(clock.now - start - 2.0) < 1e-6
+
+        ## after a lull, the bucket has filled up again, but no further
+        clock.now += 60
+        start = clock.now
+        for i in range(6):
+            bucket.acquire()
+        assert abs(clock.now - start - 0.1) < 1e-6
+
+        ## a pause holds up every request
+        bucket.pause(16)
+        start = clock.now
+        bucket.acquire()
+        assert abs(clock.now - start - 16) < 1e-6
+
+        assert TokenBucket().acquire() == 0
+
+
+def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(8, min_limit=2)
+    tickets = [limiter.acquire() for i in range(8)]
+    assert limiter.in_flight == 8
+
+    ## throttled responses to requests sent at the same time cut the limit once
+    for ticket in tickets[:4]:
+        limiter.release(ticket, throttled=True)
+    assert limiter.limit == 4
+    limiter.release(tickets[4])
+    assert limiter.limit == 4.25
+    ticket = limiter.acquire()
+    limiter.release(ticket, throttled=True)
+    assert limiter.limit == 2.125
+    for ticket in tickets[5:]:
+        limiter.release(ticket, throttled=True)
+    assert limiter.limit == 2.125
+    ticket = limiter.acquire()
+    limiter.release(ticket, throttled=True)
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+    ## successes grow it back by about one per round of requests
+    for i in range(2):
+        limiter.release(limiter.acquire())
+    assert abs(limiter.limit - 2.9) < 1e-9
+    for i in range(100):
+        limiter.release(limiter.acquire())
+    assert limiter.limit == 8
+
+    ## failures that weren't throttled leave it be
+    limiter.release(limiter.acquire(), throttled=True)
+    limiter.release(limiter.acquire(), succeeded=False)
+    assert limiter.limit == 4
+
+    ## requests beyond the limit wait for a free slot
+    limiter = ConcurrencyLimiter(1)
+    ticket = limiter.acquire()
+    acquired = threading.Event()
+    def acquire():
+        limiter.acquire()
+        acquired.set()
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release(ticket)
+    assert acquired.wait(5)
+    thread.join()
+
+
+def test_throttle():
+    clock = FakeClock()
+    with patch('time.time', side_effect=clock.time), patch('time.sleep', side_effect=clock.sleep):
+        throttle = Throttle(max_concurrency=4)
+        throttle.release(throttle.acquire(), _response(429, headers={'Retry-After': '30'}))
+        start = clock.now
+        throttle.release(throttle.acquire(), _response(200))
+        assert abs(clock.now - start - 30) < 1e-6
+        stats = throttle.stats()
+        assert stats['requests'] == 2 and stats['throttled'] == 1 and stats['in_flight'] == 0
+        assert 2 < stats['concurrency'] < 3
+
+        ## without a Retry-After, the pause doubles with each throttled response in a row
+        pauses = []
+        for i in range(3):
+            throttle.release(throttle.acquire(), _response(503))
+            start = clock.now
+            ticket = throttle.acquire()
+            pauses.append(clock.now - start)
+            if i < 2:
+                throttle.limiter.release(ticket, succeeded=False)
+        assert pauses == [1, 2, 4]
+        throttle.release(ticket, _response(200))
+        throttle.release(throttle.acquire(), _response(503))
+        start = clock.now
+        throttle.release(throttle.acquire(), _response(200))
+        assert clock.now - start == 1
+
+        ## a request that got no response leaves the concurrency limit be
+        limit = throttle.stats()['concurrency']
+        throttle.release(throttle.acquire(), None)
+        assert throttle.stats()['concurrency'] == limit
+
+
+def test_rest_calls_are_throttled():
+    syn = synapseclient.Synapse(debug=False, skip_checks=True, max_concurrency=6)
+    syn._generateSignedHeaders = MagicMock(return_value={})
+    syn._requests_session = MagicMock()
+    ok = _response(200)
+    ok.content = '{"id": "syn1"}'
+    ok.json.return_value = {'id': 'syn1'}
+    slow_down = _response(403, 'Please slow down.  You may send a maximum of 10 message(s) in 60 second(s)')
+    syn._requests_session.get.side_effect = [_response(429, headers={'Retry-After': '5'}), slow_down, ok]
+    clock = FakeClock()
+    with patch('time.time', side_effect=clock.time), patch('time.sleep', side_effect=clock.sleep):
+        start = clock.now
+        assert syn.restGET('/entity/syn1') == {'id': 'syn1'}
+        ## only the throttle waits, for as long as each response asked
+        assert clock.now - start == 5 + 16
+    stats = syn.throttleStats()[syn.repoEndpoint]
+    assert stats['requests'] == 3
+    assert stats['throttled'] == 2
+    assert 2 < stats['concurrency'] < 3
+
+    ## connection errors are retried as before, without growing the concurrency limit
+    syn._requests_session.get.side_effect = [requests.exceptions.ConnectionError('reset'), ok]
+    with patch('time.sleep'):
+        assert syn.restGET('/entity/syn1') == {'id': 'syn1'}
+    assert syn.throttleStats()[syn.repoEndpoint]['concurrency'] == stats['concurrency'] + 1.0 / stats['concurrency']
@@ -308,3 +308,38 @@ def test_as_urls():
     assert utils.as_url("http://foo/bar/bat/zoinks.txt") == "http://foo/bar/bat/zoinks.txt"
     assert utils.as_url("ftp://foo/bar/bat/zoinks.txt") == "ftp://foo/bar/bat/zoinks.txt"
     assert utils.as_url("sftp://foo/bar/bat/zoinks.txt") == "sftp://foo/bar/bat/zoinks.txt"
+
+def test_parse_bytes():
+    assert utils.parse_bytes("1024") == 1024
+    assert utils.parse_bytes("500GB") == 500*utils.GB
+    assert utils.parse_bytes("1.5 kb") == 1536
+    assert_raises(ValueError, utils.parse_bytes, "lots")
+    assert_raises(ValueError, utils.parse_bytes, "12 parsecs")
+
+def test_imap_ordered():
+    import itertools, random, time, threading
+    lock = threading.Lock()
+    called = []
+    def slow_square(x):
+        time.sleep(random.random() / 100)
+        with lock:
+            called.append(x)
+        return x * x
+
+    assert list(utils.imap_ordered(slow_square, range(50), max_threads=4)) == [x * x for x in range(50)]
+    assert sorted(called) == range(50)
+
+    ## items are taken no more than ahead * max_threads beyond those consumed
+    del called[:]
+    results = utils.imap_ordered(slow_square, itertools.count(), max_threads=3, ahead=2)
+    assert [next(results) for i in range(5)] == [0, 1, 4, 9, 16]
+    results.close()
+    assert len(called) <= 5 + 6
+
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError('three')
+        return x
+    results = utils.imap_ordered(fail_on_three, range(10), max_threads=2)
+    assert [next(results) for i in range(3)] == [0, 1, 2]
+    assert_raises(ValueError, next, results)